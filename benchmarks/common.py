@@ -0,0 +1,56 @@
+"""
+Shared helpers for the benchmark scripts. The benchmarks run the backend modules
+against fakeredis (``pip install fakeredis lupa``) so that they can be executed on a
+laptop without the Redis cluster.
+"""
+import os
+import sys
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "app", "backend")
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+import fakeredis
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """
+    FakeRedis client that counts round trips: every command, script call and
+    pipeline execution counts as one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("decode_responses", True)
+        super().__init__(*args, **kwargs)
+        self.round_trips = 0
+
+    def execute_command(self, *args, **options):
+        self.round_trips += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipeline = super().pipeline(transaction, shard_hint)
+        execute = pipeline.execute
+
+        def counted_execute(*args, **kwargs):
+            self.round_trips += 1
+            return execute(*args, **kwargs)
+
+        pipeline.execute = counted_execute
+        return pipeline
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def print_table(headers, rows):
+    widths = [
+        max(len(str(value)) for value in column) for column in zip(headers, *rows)
+    ]
+    line = "  ".join(f"{{:>{width}}}" for width in widths)
+    print(line.format(*headers))
+    for row in rows:
+        print(line.format(*row))
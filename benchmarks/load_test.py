@@ -0,0 +1,486 @@
+"""
+End-to-end load test of the backend with simulated Socket.IO clients.
+
+Starts a local stack: a Redis server (a redis-server binary on the PATH, or an
+in-process fakeredis TCP server when there is none) that holds the user state and
+doubles as the Kombu broker instead of RabbitMQ, and the backend app under gunicorn
+with one gevent worker, as in its Docker image. Every simulated pair of users then
+runs the lobby -> chat_request -> chat_response -> join_room -> send_message ->
+leave_room flow with python-socketio clients
+(``pip install "python-socketio[asyncio_client]"``).
+
+Reports message latency between the clients, handled events per second, Redis
+round trips per event (from the backend's /api/metrics) and backend memory per
+connected socket. Results can be saved and compared against a saved baseline:
+
+    python benchmarks/load_test.py --pairs 500 --output baseline.json
+    python benchmarks/load_test.py --pairs 500 --baseline baseline.json \\
+        --max-regression 10
+
+With --pods, several backends share the Redis server and the message queue, and
+--placement decides whether both users of a pair connect to the same pod, so that
+their messages can be delivered in-process with the routed exchange, or to
+different pods:
+
+    python benchmarks/load_test.py --pods 2 --placement colocated \\
+        --backend-env MESSAGE_ROUTING=routed
+    python benchmarks/load_test.py --pods 2 --placement spread \\
+        --backend-env MESSAGE_ROUTING=routed
+
+With --workers, every backend runs that many gevent workers, between which the
+kernel spreads the connections, and whose sockets reach each other through the
+message queue:
+
+    python benchmarks/load_test.py --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import requests
+import socketio
+
+from common import BACKEND_DIR, print_table
+
+# the socketserver default backlog of 5 would stall connects under load
+FAKE_REDIS_SERVER = """
+import sys
+from fakeredis import TcpFakeServer
+TcpFakeServer.request_queue_size = 1024
+TcpFakeServer(("127.0.0.1", int(sys.argv[1])), server_type="redis").serve_forever()
+"""
+
+WORKER_METRICS_INTERVAL = 0.5
+
+# metric -> whether a higher value is better
+METRICS = {
+    "message_p50_ms": False,
+    "message_p99_ms": False,
+    "events_per_sec": True,
+    "redis_ops_per_event": False,
+    "memory_per_connection_kb": False,
+}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing is listening on port {port}")
+
+
+class LocalStack:
+    def __init__(self, redis_url=None, backend_env=None, pods=1, workers=1):
+        self.redis_url = redis_url
+        self.backend_env = backend_env or {}
+        self.workers = workers
+        self.backend_ports = [_free_port() for _ in range(pods)]
+        self.backend_urls = [f"http://127.0.0.1:{port}" for port in self.backend_ports]
+        self.backends = []
+        self._processes = []
+        self.log_dir = tempfile.gettempdir()
+        self.metrics_dir = tempfile.mkdtemp(prefix="load_test_metrics_")
+
+    def __enter__(self):
+        if not self.redis_url:
+            self.redis_url = self._start_redis()
+        for index, port in enumerate(self.backend_ports):
+            self.backends.append(self._start_backend(index, port))
+        for port in self.backend_ports:
+            _wait_for_port(port)
+        return self
+
+    def __exit__(self, *exc):
+        for process in reversed(self._processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+    def _start_backend(self, index, port):
+        env = {
+            **os.environ,
+            "FLASK_ENV": "production",
+            "FLASK_DEBUG": "false",
+            "FLASK_SECRET_KEY": uuid.uuid4().hex,
+            "ALB_DNS": "localhost",
+            "CONTAINER_PORT": str(port),
+            "REDIS_URL": self.redis_url,
+            "MESSAGE_QUEUE_URL": self.redis_url,
+            "DISCONNECT_GRACE_SECONDS": "1",
+            "WORKERS": str(self.workers),
+            "WORKER_METRICS_DIR": os.path.join(self.metrics_dir, str(index)),
+            "WORKER_METRICS_INTERVAL": str(WORKER_METRICS_INTERVAL),
+            **self.backend_env,
+        }
+        log_path = os.path.join(self.log_dir, f"load_test_backend_{index}.log")
+        with open(log_path, "w") as log:
+            backend = subprocess.Popen(
+                [
+                    "gunicorn",
+                    "-w", str(self.workers),
+                    "-k", "gevent",
+                    "-b", f"127.0.0.1:{port}",
+                    "app:app",
+                ],
+                cwd=BACKEND_DIR,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        self._processes.append(backend)
+        return backend
+
+    def _start_redis(self):
+        port = _free_port()
+        if shutil.which("redis-server"):
+            command = [
+                "redis-server",
+                "--port", str(port),
+                "--save", "",
+                "--appendonly", "no",
+            ]
+        else:
+            print("redis-server not found, using a fakeredis server")
+            command = [sys.executable, "-c", FAKE_REDIS_SERVER, str(port)]
+        self._processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL))
+        _wait_for_port(port)
+        return f"redis://127.0.0.1:{port}/0"
+
+    def backend_rss_kb(self):
+        """
+        Resident memory of the gunicorn workers serving the sockets.
+        """
+        return sum(_worker_rss_kb(backend.pid) for backend in self.backends)
+
+    def redis_commands(self):
+        """
+        Commands and pipelines the backends have sent to Redis so far.
+        """
+        return self._sum_metric("chat_redis_commands_total")
+
+    def local_emits(self):
+        return self._sum_metric("chat_local_emits_total")
+
+    def _sum_metric(self, name):
+        if self.workers > 1:
+            # let every worker export its latest metrics
+            time.sleep(2 * WORKER_METRICS_INTERVAL)
+        total = 0.0
+        for url in self.backend_urls:
+            text = requests.get(f"{url}/api/metrics", timeout=10).text
+            for line in text.splitlines():
+                if line.startswith(name + " "):
+                    total += float(line.split()[1])
+        return total
+
+
+def _worker_rss_kb(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        children = f.read().split()
+    total = 0
+    for worker in children or [pid]:
+        with open(f"/proc/{worker}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+    return total
+
+
+class SimulatedUser:
+    def __init__(self, stats, username):
+        self.stats = stats
+        self.username = username
+        self.client = socketio.AsyncClient(reconnection=False)
+        self.inbox = {}
+        self.messages = asyncio.Queue()
+        for event in (
+            "lobby_page",
+            "chat_request",
+            "chat_response",
+            "join_room_success",
+        ):
+            self.client.on(event, self._waiter(event))
+        self.client.on("receive_message", self._on_message)
+
+    def _waiter(self, event):
+        async def handler(data=None):
+            self._queue(event).put_nowait(data)
+        return handler
+
+    def _queue(self, event):
+        return self.inbox.setdefault(event, asyncio.Queue())
+
+    async def _on_message(self, data):
+        if data.get("type") == "user":
+            sent_at = json.loads(bytes(data["message"]))["sent_at"]
+            self.stats.latencies.append(time.perf_counter() - sent_at)
+            self.messages.put_nowait(data)
+
+    async def expect(self, event, timeout):
+        return await asyncio.wait_for(self._queue(event).get(), timeout)
+
+    async def emit(self, event, data=None):
+        self.stats.events += 1
+        await self.client.emit(event, data)
+
+    async def join_lobby(self, timeout):
+        """
+        Join the lobby the way lobby.js does, which works the same with either
+        LOBBY_PROTOCOL, and wait until the user's own page shows them in it. The
+        server handles the events of a socket concurrently, so the first page may
+        be fetched before the join has added the user.
+        """
+        await self.emit("join_lobby", {"paged": True})
+        deadline = time.perf_counter() + timeout
+        while True:
+            await self.emit("fetch_lobby_page", {"prefix": self.username, "limit": 1})
+            page = await self.expect("lobby_page", deadline - time.perf_counter())
+            if self.username in page["users"]:
+                return
+            await asyncio.sleep(0.05)
+
+    async def connect(self, url):
+        self.stats.events += 1
+        await self.client.connect(
+            f"{url}?username={self.username}", transports=["websocket"]
+        )
+
+
+class Stats:
+    def __init__(self):
+        self.events = 0
+        self.errors = 0
+        self.error_types = {}
+        self.latencies = []
+
+
+def pair_urls(stack, index, placement):
+    """
+    Backends the two users of a pair connect to. Pairs are spread evenly over the
+    pods either way.
+    """
+    urls = stack.backend_urls
+    first = index % len(urls)
+    if placement == "spread":
+        return urls[first], urls[(first + 1) % len(urls)]
+    return urls[first], urls[first]
+
+
+def envelope(encryption, message):
+    """
+    send_message payload of the shape the chat room page sends, with the plain message
+    in place of the ciphertext.
+    """
+    payload = {"iv": os.urandom(12), "message": message}
+    if encryption == "session":
+        payload["epoch"] = 0
+    else:
+        payload["aes_key"] = os.urandom(256)
+    return payload
+
+
+async def run_pair(
+    stack, stats, connected, start, index, messages, timeout, placement
+):
+    prefix = uuid.uuid4().hex[:8]
+    alice = SimulatedUser(stats, f"load-{prefix}-{index}a")
+    bob = SimulatedUser(stats, f"load-{prefix}-{index}b")
+    try:
+        for user, url in zip((alice, bob), pair_urls(stack, index, placement)):
+            await user.connect(url)
+        connected.release()
+        await start.wait()
+
+        for user in (alice, bob):
+            await user.join_lobby(timeout)
+
+        await alice.emit("chat_request", {"to_user": bob.username})
+        await bob.expect("chat_request", timeout)
+        await bob.emit("chat_response", {"from_user": alice.username, "accepted": True})
+        response = await alice.expect("chat_response", timeout)
+        await bob.expect("chat_response", timeout)
+        if not response.get("accepted"):
+            raise RuntimeError(f"Chat request declined: {response}")
+
+        for user in (alice, bob):
+            await user.emit("join_room", {"room_id": response["room_id"]})
+            joined = await user.expect("join_room_success", timeout)
+
+        for i in range(messages):
+            sender, receiver = (alice, bob) if i % 2 == 0 else (bob, alice)
+            message = json.dumps({"sent_at": time.perf_counter()}).encode()
+            await sender.emit(
+                "send_message", envelope(joined.get("encryption"), message)
+            )
+            await asyncio.wait_for(receiver.messages.get(), timeout)
+
+        for user in (alice, bob):
+            await user.emit("leave_room")
+            await user.emit("leave_server")
+    except Exception as e:
+        stats.errors += 1
+        stats.error_types[repr(e)] = stats.error_types.get(repr(e), 0) + 1
+        connected.release()
+    finally:
+        for user in (alice, bob):
+            await user.client.disconnect()
+
+
+async def run_load(stack, pairs, messages, ramp, timeout, placement="colocated"):
+    stats = Stats()
+    connected = asyncio.Semaphore(0)
+    start = asyncio.Event()
+    rss_before = stack.backend_rss_kb()
+
+    tasks = []
+    for index in range(pairs):
+        tasks.append(asyncio.create_task(
+            run_pair(
+                stack, stats, connected, start, index, messages, timeout, placement
+            )
+        ))
+        await asyncio.sleep(1 / ramp)
+    for _ in range(pairs):
+        await connected.acquire()
+    rss_connected = stack.backend_rss_kb()
+
+    redis_before = stack.redis_commands()
+    local_before = stack.local_emits()
+    events_before = stats.events
+    started = time.perf_counter()
+    start.set()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    events = stats.events - events_before
+    redis_ops = stack.redis_commands() - redis_before
+    local_emits = stack.local_emits() - local_before
+    for error, count in sorted(stats.error_types.items(), key=lambda e: -e[1])[:5]:
+        print(f"{count} pairs failed with {error}")
+
+    latencies = sorted(stats.latencies)
+
+    def percentile(q):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+
+    return {
+        "message_p50_ms": percentile(0.5),
+        "message_p99_ms": percentile(0.99),
+        "events_per_sec": events / elapsed,
+        "messages_per_sec": len(latencies) / elapsed,
+        "redis_ops_per_event": redis_ops / events if events else 0.0,
+        "memory_per_connection_kb": (rss_connected - rss_before) / (pairs * 2),
+        "messages": len(latencies),
+        "local_emits": local_emits,
+        "errors": stats.errors,
+    }
+
+
+def compare(baseline, results, max_regression):
+    rows = []
+    regressions = []
+    for metric, higher_is_better in METRICS.items():
+        before, after = baseline["results"][metric], results[metric]
+        change = (after - before) / before * 100 if before else 0.0
+        worse = -change if higher_is_better else change
+        if max_regression is not None and worse > max_regression:
+            regressions.append(metric)
+        rows.append([metric, f"{before:,.2f}", f"{after:,.2f}", f"{change:+.1f}%"])
+    print_table(["metric", "baseline", "current", "change"], rows)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--pairs", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--ramp", type=float, default=200, help="pairs per second")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--redis-url", help="use a running Redis instead")
+    parser.add_argument("--pods", type=int, default=1, help="backends to start")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="gunicorn workers per backend"
+    )
+    parser.add_argument(
+        "--placement",
+        choices=["colocated", "spread"],
+        default="colocated",
+        help="whether the users of a pair connect to the same pod",
+    )
+    parser.add_argument(
+        "--backend-env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="extra environment for the backend, e.g. LOBBY_PROTOCOL=full",
+    )
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--baseline", help="compare against saved results")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        help="exit with an error if a metric is this many percent worse",
+    )
+    args = parser.parse_args()
+
+    backend_env = dict(item.split("=", 1) for item in args.backend_env)
+    with LocalStack(args.redis_url, backend_env, args.pods, args.workers) as stack:
+        results = asyncio.run(
+            run_load(
+                stack,
+                args.pairs,
+                args.messages,
+                args.ramp,
+                args.timeout,
+                args.placement,
+            )
+        )
+
+    print(
+        f"{args.pairs} pairs, {args.messages} messages each, {args.pods} pods "
+        f"with {args.workers} workers, {args.placement} "
+        f"(backend logs in {stack.log_dir}):"
+    )
+    print_table(
+        ["metric", "value"],
+        [[metric, f"{value:,.2f}"] for metric, value in results.items()],
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\nCompared to {args.baseline}:")
+        regressions = compare(baseline, results, args.max_regression)
+        if regressions:
+            print(f"Regressed beyond {args.max_regression}%: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Bytes on the wire per lobby event for the "full" and "delta" lobby protocols.
+
+Each lobby event is fanned out to every backend pod through the Kombu exchange and
+from there to every lobby socket. The sizes below are the encoded Socket.IO packets
+and the pickled broker messages that the backend actually produces.
+
+    python benchmarks/lobby_broadcast.py --users 1000 10000 --pods 4
+"""
+import argparse
+import pickle
+
+import common  # noqa: F401  (puts the backend on sys.path)
+from common import print_table
+from socketio import packet
+
+
+def socketio_bytes(event, data):
+    return len(packet.Packet(packet.EVENT, data=[event, data]).encode())
+
+
+def broker_bytes(event, data):
+    message = {
+        "method": "emit", "event": event, "data": data, "namespace": "/",
+        "room": None, "skip_sid": None, "callback": None, "host_id": "0" * 32
+    }
+    return len(pickle.dumps(message))
+
+
+def measure(num_users, num_pods):
+    users = [f"user-{i:06d}" for i in range(num_users)]
+    events = {
+        "full": ("update_user_list", users),
+        "delta": ("user_joined", {"username": users[-1], "seq": 123456}),
+    }
+    rows = []
+    for protocol, (event, data) in events.items():
+        sockets = socketio_bytes(event, data) * num_users
+        broker = broker_bytes(event, data) * num_pods
+        rows.append([
+            num_users,
+            protocol,
+            f"{sockets / 1024:,.1f}",
+            f"{broker / 1024:,.1f}",
+            f"{(sockets + broker) / 1024:,.1f}",
+        ])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--pods", type=int, default=4)
+    args = parser.parse_args()
+
+    rows = []
+    for num_users in args.users:
+        rows.extend(measure(num_users, args.pods))
+    print(f"KiB on the wire per lobby event ({args.pods} backend pods):")
+    print_table(["lobby users", "protocol", "sockets", "broker", "total"], rows)
+
+
+if __name__ == "__main__":
+    main()
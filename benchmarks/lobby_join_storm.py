@@ -0,0 +1,237 @@
+"""
+Lobby broadcasts, Redis round trips and bytes on the wire during a storm of joins
+spread evenly over several backend pods, with every change broadcast on its own
+(window 0) and coalesced into one broadcast per window (lobby_broadcaster).
+
+The pods share a fakeredis and exchange roster deltas instantly; their background
+tasks run as greenlets on a simulated clock. Socket.IO bytes are those sent to all
+lobby sockets, broker bytes those of the broadcasts published to the other pods. A
+simulated client follows the broadcasts and must end up with the final roster.
+
+    python benchmarks/lobby_join_storm.py --joins 500 --seconds 1 --pods 4
+"""
+import argparse
+import heapq
+import itertools
+
+import greenlet
+from common import CountingRedis, print_table
+from lobby_broadcast import broker_bytes, socketio_bytes
+
+import lobby_broadcaster
+from lobby_broadcaster import LobbyBroadcaster
+from roster import LobbyRoster
+
+
+class Simulation:
+    """
+    Runs callbacks and sleeping greenlets in the order of the simulated clock.
+    """
+
+    def __init__(self):
+        self.now = 1_000_000.0
+        self._events = []
+        self._order = itertools.count()
+        self._main = greenlet.getcurrent()
+
+    def time(self):
+        return self.now
+
+    def at(self, when, callback):
+        heapq.heappush(self._events, (when, next(self._order), callback))
+
+    def spawn(self, fn):
+        self.at(self.now, greenlet.greenlet(fn, parent=self._main).switch)
+
+    def sleep(self, seconds):
+        self.at(self.now + seconds, greenlet.getcurrent().switch)
+        self._main.switch()
+
+    def run(self):
+        while self._events:
+            self.now, _, callback = heapq.heappop(self._events)
+            callback()
+
+
+class Exchange:
+    """
+    Delivers the internal messages of each pod to all the other pods.
+    """
+
+    def __init__(self):
+        self.handlers = []
+
+    def pod(self):
+        exchange = self
+
+        class ClientManager:
+            def on_internal(self, name, handler):
+                exchange.handlers.append((self, handler))
+
+            def publish_internal(self, name, data):
+                for pod, handler in exchange.handlers:
+                    if pod is not self:
+                        handler(data)
+
+        return ClientManager()
+
+
+class Server:
+    """
+    The parts of the Socket.IO server the broadcaster uses, counting the bytes of
+    every broadcast.
+    """
+
+    def __init__(self, simulation, roster, wire):
+        self.simulation = simulation
+        self.roster = roster
+        self.wire = wire
+
+    def emit(self, event, data, room=None):
+        # the lobby sockets all keep the whole lobby, none of them is paged
+        if room == lobby_broadcaster.PAGED_LOBBY_ROOM:
+            return
+        self.wire.emit(event, data, len(self.roster.list_users()))
+
+    def start_background_task(self, fn):
+        self.simulation.spawn(fn)
+
+    def sleep(self, seconds):
+        self.simulation.sleep(seconds)
+
+
+class Wire:
+    def __init__(self, num_pods, client):
+        self.num_pods = num_pods
+        self.client = client
+        self.broadcasts = 0
+        self.socket_bytes = 0
+        self.broker_bytes = 0
+
+    def emit(self, event, data, num_sockets):
+        self.broadcasts += 1
+        self.socket_bytes += socketio_bytes(event, data) * num_sockets
+        self.broker_bytes += broker_bytes(event, data) * (self.num_pods - 1)
+        self.client.receive(event, data)
+
+
+class Client:
+    """
+    The lobby.js handling of the lobby broadcasts.
+    """
+
+    def __init__(self, roster):
+        self.seq, users = roster.snapshot()
+        self.users = set(users)
+
+    def receive(self, event, data):
+        if event == "update_user_list":
+            self.users = set(data)
+        elif event == "user_list_snapshot":
+            self.seq, self.users = data["seq"], set(data["users"])
+        elif event == "user_list_deltas":
+            for seq, op, username in data["deltas"]:
+                self.apply(seq, op, username)
+        else:
+            op = "add" if event == "user_joined" else "remove"
+            self.apply(data["seq"], op, data["username"])
+
+    def apply(self, seq, op, username):
+        if seq <= self.seq:
+            return
+        assert seq == self.seq + 1, f"missed lobby updates {self.seq} -> {seq}"
+        if op == "add":
+            self.users.add(username)
+        else:
+            self.users.discard(username)
+        self.seq = seq
+
+
+def run(protocol, window, num_joins, seconds, num_pods, lobby_size):
+    simulation = Simulation()
+    lobby_broadcaster.time = simulation
+    redis = CountingRedis()
+    exchange = Exchange()
+
+    rosters = [LobbyRoster(redis) for _ in range(num_pods)]
+    for roster in rosters:
+        roster.bind(exchange.pod())
+        roster.load_snapshot()
+    rosters[0].apply([("add", f"user-{i:06d}") for i in range(lobby_size)])
+
+    wire = Wire(num_pods, Client(rosters[0]))
+    broadcasters = []
+    for roster in rosters:
+        broadcaster = LobbyBroadcaster(
+            Server(simulation, roster, wire),
+            roster,
+            redis,
+            protocol=protocol,
+            window=window,
+        )
+        roster.add_listener(broadcaster.notify)
+        broadcasters.append(broadcaster)
+
+    redis.round_trips = 0
+    for i in range(num_joins):
+        roster = rosters[i % num_pods]
+        simulation.at(
+            simulation.now + i * seconds / num_joins,
+            lambda roster=roster, i=i: roster.add(f"storm-{i:06d}"),
+        )
+    simulation.run()
+
+    assert wire.client.users == set(rosters[0].list_users())
+    return [
+        protocol,
+        f"{window * 1000:g}",
+        wire.broadcasts,
+        sum(broadcaster.skipped for broadcaster in broadcasters),
+        f"{redis.round_trips / num_joins:.2f}",
+        f"{wire.socket_bytes / 1024 ** 2:,.1f}",
+        f"{wire.broker_bytes / 1024:,.1f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--joins", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=1.0)
+    parser.add_argument("--pods", type=int, default=4)
+    parser.add_argument("--lobby", type=int, default=1000)
+    parser.add_argument(
+        "--windows-ms", type=float, nargs="+", default=[0, 50, 100, 200]
+    )
+    args = parser.parse_args()
+
+    rows = []
+    for protocol in ("delta", "full"):
+        for window_ms in args.windows_ms:
+            rows.append(run(
+                protocol,
+                window_ms / 1000,
+                args.joins,
+                args.seconds,
+                args.pods,
+                args.lobby,
+            ))
+    print(
+        f"{args.joins} joins in {args.seconds:g}s over {args.pods} pods, "
+        f"{args.lobby} users already in the lobby:"
+    )
+    print_table(
+        [
+            "protocol",
+            "window ms",
+            "broadcasts",
+            "skipped",
+            "round trips/join",
+            "socket.io MiB",
+            "broker KiB",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Bytes and server time of what a client gets when it opens the lobby, as lobbies grow:
+the whole lobby as one user_list_snapshot, against a lobby_page of the users in view
+and a prefix search, both served from the sorted index of the pod-local roster.
+
+Also times a roster delta, which now also keeps the sorted index current.
+
+    python benchmarks/lobby_page.py --users 1000 10000 100000 --queries 200
+"""
+import argparse
+import random
+import time
+
+from common import CountingRedis, print_table
+from message_serialization import websocket_bytes
+from socketio import packet
+
+from roster import LobbyRoster
+
+
+def fill(roster, num_users, batch=1000):
+    for start in range(0, num_users, batch):
+        end = min(num_users, start + batch)
+        roster.apply([("add", f"user-{i:07d}") for i in range(start, end)])
+
+
+def encode_snapshot(snapshot):
+    return packet.Packet(
+        packet.EVENT, data=["user_list_snapshot", snapshot], namespace="/"
+    ).encode()
+
+
+def encode_page(page):
+    return packet.Packet(
+        packet.EVENT, data=["lobby_page", page], namespace="/"
+    ).encode()
+
+
+def measure(query, queries):
+    start = time.perf_counter()
+    for _ in range(queries):
+        encoded = query()
+    elapsed = time.perf_counter() - start
+    return websocket_bytes(encoded), elapsed / queries
+
+
+def run(num_users, queries, limit):
+    roster = LobbyRoster(CountingRedis())
+    roster.load_snapshot()
+    fill(roster, num_users)
+    prefixes = [f"user-{random.randrange(num_users):07d}"[:-2] for _ in range(queries)]
+    offsets = [random.randrange(num_users) for _ in range(queries)]
+
+    variants = {
+        "snapshot": lambda: encode_snapshot(
+            dict(zip(("seq", "users"), roster.snapshot()))
+        ),
+        "page": lambda: encode_page(
+            roster.page(offset=offsets[random.randrange(queries)], limit=limit)
+        ),
+        "prefix search": lambda: encode_page(
+            roster.page(prefix=prefixes[random.randrange(queries)], limit=limit)
+        ),
+    }
+    rows = []
+    for name, query in variants.items():
+        size, cost = measure(query, queries)
+        rows.append([num_users, name, f"{size / 1024:,.1f}", f"{cost * 1000:,.3f}"])
+
+    start = time.perf_counter()
+    for i in range(queries):
+        roster._apply_deltas([(roster.version + 1, "add", f"joined-{i}")])
+    delta_ms = (time.perf_counter() - start) / queries * 1000
+    return rows, delta_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--users", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=60)
+    args = parser.parse_args()
+
+    rows = []
+    delta_rows = []
+    for num_users in args.users:
+        user_rows, delta_ms = run(num_users, args.queries, args.limit)
+        rows.extend(user_rows)
+        delta_rows.append([num_users, f"{delta_ms:.4f}"])
+    print(f"Opening the lobby (pages of {args.limit} users):")
+    print_table(["lobby users", "query", "KiB", "ms/query"], rows)
+    print()
+    print("Applying a roster delta:")
+    print_table(["lobby users", "ms/delta"], delta_rows)
+
+
+if __name__ == "__main__":
+    main()
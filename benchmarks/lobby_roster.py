@@ -0,0 +1,52 @@
+"""
+Redis round trips per lobby event with the legacy 100-partition SMEMBERS scan versus
+the pod-local lobby roster.
+
+    python benchmarks/lobby_roster.py --users 1000
+"""
+import argparse
+
+from common import CountingRedis, print_table
+
+from state_manager import RedisChatManager
+
+
+def run(num_users):
+    redis = CountingRedis()
+    manager = RedisChatManager(client=redis)
+    manager.list_users_in_lobby()  # cold start, loads the roster snapshot once
+
+    legacy_calls = 0
+    roster_calls = 0
+    for i in range(num_users):
+        redis.round_trips = 0
+        manager.add_user(f"user-{i}")
+        writes = redis.round_trips
+
+        redis.round_trips = 0
+        manager._scan_lobby_partitions()
+        legacy_calls += writes + redis.round_trips
+
+        redis.round_trips = 0
+        users = manager.list_users_in_lobby()
+        roster_calls += writes + redis.round_trips
+
+    assert sorted(users) == sorted(manager._scan_lobby_partitions())
+    return legacy_calls / num_users, roster_calls / num_users
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000)
+    args = parser.parse_args()
+
+    legacy, roster = run(args.users)
+    print(f"Redis round trips per join_lobby event ({args.users} joins):")
+    print_table(
+        ["path", "round trips/event"],
+        [["partition scan", f"{legacy:.1f}"], ["roster", f"{roster:.1f}"]],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Cost of logging on the backend's hot path, before and after the sampled logging
+pipeline.
+
+"before" logs the way the backend used to: every record of every event formatted as
+text and written to stdout by the greenlet that logs it, and the Socket.IO and
+Engine.IO loggers on, though it also logs the latency of every handler, which the
+backend did not. "after" uses the defaults: JSON records sampled per event and
+written from a thread of their own. Both run the load test flow against a local
+stack, and the logging of the pipeline alone is timed in-process as well, with the
+records written to a file.
+
+    python benchmarks/logging_overhead.py --pairs 50 --messages 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from common import print_table
+from load_test import LocalStack, run_load
+
+from logs import TEXT_FORMAT, BackgroundHandler, EventFilter, JsonFormatter, logged
+
+VARIANTS = {
+    "before": {
+        "LOG_HANDLER": "stream",
+        "LOG_FORMAT": "text",
+        "LOG_SAMPLING": "",
+        "SOCKETIO_LOGGING": "true",
+    },
+    "after": {},
+}
+
+
+def time_calls(handler, log_filter, calls):
+    """
+    Microseconds the caller spends logging per send_message event.
+    """
+    logger = logging.getLogger(f"logging_overhead.{id(handler)}")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    def send_message(i):
+        logger.info("User '%s' sent a message to room '%s'", f"user-{i}", "room-1")
+
+    handle = send_message
+    if log_filter:
+        handle = logged(logger, log_filter, "send_message", send_message)
+    start = time.perf_counter()
+    for i in range(calls):
+        handle(i)
+    elapsed = time.perf_counter() - start
+    handler.close()
+    return elapsed / calls * 1e6
+
+
+def in_process(calls):
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in VARIANTS:
+            with open(os.path.join(directory, name), "w") as stream:
+                if name == "before":
+                    handler = logging.StreamHandler(stream)
+                    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+                    log_filter = None
+                else:
+                    handler = BackgroundHandler(stream)
+                    handler.setFormatter(JsonFormatter())
+                    log_filter = EventFilter(sampling={"send_message": 0.01})
+                    handler.addFilter(log_filter)
+                cost = time_calls(handler, log_filter, calls)
+                rows.append([name, f"{cost:.2f}"])
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pairs", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--ramp", type=float, default=100, help="pairs per second")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--calls", type=int, default=100000)
+    args = parser.parse_args()
+
+    rows = []
+    for name, backend_env in VARIANTS.items():
+        with LocalStack(backend_env=backend_env) as stack:
+            results = asyncio.run(
+                run_load(stack, args.pairs, args.messages, args.ramp, args.timeout)
+            )
+            with open(os.path.join(stack.log_dir, "load_test_backend_0.log")) as f:
+                log_lines = sum(1 for _ in f)
+        rows.append([
+            name,
+            f"{results['messages_per_sec']:,.1f}",
+            f"{results['events_per_sec']:,.1f}",
+            f"{results['message_p99_ms']:,.1f}",
+            f"{log_lines:,}",
+            results["errors"],
+        ])
+    print(f"{args.pairs} pairs, {args.messages} messages each:")
+    print_table(
+        ["logging", "messages/s", "events/s", "p99 ms", "log lines", "errors"], rows
+    )
+    print()
+    print(f"Logging a handled send_message, {args.calls:,} calls in-process:")
+    print_table(["logging", "µs/call"], in_process(args.calls))
+
+
+if __name__ == "__main__":
+    main()
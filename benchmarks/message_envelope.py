@@ -0,0 +1,127 @@
+"""
+Per-message cost of the two encryption schemes of the chat room page: "rsa", which
+sends every message with a fresh AES key wrapped with the recipient's RSA-2048 key,
+and "session", which encrypts with an AES key derived from a per-room ECDH secret
+and rotated every --rekey-interval messages.
+
+Reports the bytes of the send_message packet that the backend receives and relays
+through the message queue, the backend CPU to validate and encode it, and as a proxy
+for the client CPU, the same cryptography in Python (``pip install cryptography``).
+
+    python benchmarks/message_envelope.py --messages 2000
+"""
+import argparse
+import json
+import os
+import time
+
+from common import print_table
+
+from envelopes import validate_envelope
+
+
+def envelope(scheme, plaintext):
+    # AES-GCM appends a 16 byte tag to the ciphertext
+    payload = {
+        "iv": list(os.urandom(12)),
+        "message": list(os.urandom(len(plaintext.encode()) + 16)),
+    }
+    if scheme == "session":
+        payload["epoch"] = 0
+    else:
+        payload["aes_key"] = list(os.urandom(256))
+    return payload
+
+
+def packet(event, data):
+    # a Socket.IO EVENT packet as python-socketio encodes it
+    return "2" + json.dumps([event, data], separators=(",", ":"))
+
+
+def backend_cost(scheme, plaintext, messages):
+    data = envelope(scheme, plaintext)
+    start = time.perf_counter()
+    for _ in range(messages):
+        relayed = validate_envelope(data, scheme)
+        packet("receive_message", {**relayed, "username": "alice", "type": "user"})
+    elapsed = time.perf_counter() - start
+    return len(packet("send_message", data)), elapsed / messages
+
+
+def client_cost(scheme, plaintext, messages, rekey_interval):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    oaep = padding.OAEP(
+        mgf=padding.MGF1(algorithm=hashes.SHA256()),
+        algorithm=hashes.SHA256(),
+        label=None,
+    )
+    recipient = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    sender = ec.generate_private_key(ec.SECP256R1())
+    receiver = ec.generate_private_key(ec.SECP256R1())
+    plaintext = plaintext.encode()
+
+    def session_key(private_key, peer_key, epoch):
+        secret = private_key.exchange(ec.ECDH(), peer_key.public_key())
+        return HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=b"room",
+            info=f"alice:{epoch}".encode(),
+        ).derive(secret)
+
+    start = time.perf_counter()
+    for i in range(messages):
+        iv = os.urandom(12)
+        if scheme == "session":
+            if i % rekey_interval == 0:
+                send_key = AESGCM(session_key(sender, receiver, i // rekey_interval))
+                receive_key = AESGCM(
+                    session_key(receiver, sender, i // rekey_interval)
+                )
+            ciphertext = send_key.encrypt(iv, plaintext, None)
+            receive_key.decrypt(iv, ciphertext, None)
+        else:
+            key = AESGCM.generate_key(bit_length=256)
+            ciphertext = AESGCM(key).encrypt(iv, plaintext, None)
+            wrapped = recipient.public_key().encrypt(key, oaep)
+            AESGCM(recipient.decrypt(wrapped, oaep)).decrypt(iv, ciphertext, None)
+    return (time.perf_counter() - start) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--rekey-interval", type=int, default=100)
+    args = parser.parse_args()
+
+    try:
+        import cryptography  # noqa: F401
+        with_client = True
+    except ImportError:
+        print("cryptography is not installed, skipping the client CPU\n")
+        with_client = False
+
+    rows = []
+    for length in (20, 200, 2000):
+        plaintext = "x" * length
+        for scheme in ("rsa", "session"):
+            size, backend = backend_cost(scheme, plaintext, args.messages)
+            row = [length, scheme, f"{size:,}", f"{backend * 1e6:,.1f}"]
+            if with_client:
+                client = client_cost(
+                    scheme, plaintext, args.messages, args.rekey_interval
+                )
+                row.append(f"{client * 1e6:,.1f}")
+            rows.append(row)
+    headers = ["plaintext bytes", "scheme", "packet bytes", "backend us/msg"]
+    if with_client:
+        headers.append("client us/msg")
+    print_table(headers, rows)
+
+
+if __name__ == "__main__":
+    main()
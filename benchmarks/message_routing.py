@@ -0,0 +1,141 @@
+"""
+Inter-pod message deliveries of chat room messages with the fanout exchange versus
+the routed exchange, for an increasing number of backend pods. Every pod is a client
+manager on Kombu's in-memory transport; users are spread randomly over the pods in
+pairs sharing a chat room, and each message is published to its room.
+
+Deliveries back to the publishing pod, which has already emitted the message to its
+own sockets, and to pods without sockets in the room are wasted: the pod only
+deserializes the message to drop it.
+
+    python benchmarks/message_routing.py --pairs 2000 --messages 20000
+"""
+import argparse
+import pickle
+import random
+import time
+import uuid
+from queue import Empty
+
+import kombu
+
+import common  # noqa: F401  (puts the backend on sys.path)
+from common import print_table
+
+from pubsub import ChatKombuManager, RoutedKombuManager
+
+
+def make_pod(routed, exchange):
+    if routed:
+        manager = RoutedKombuManager(
+            url="memory://",
+            channel=exchange,
+            exchange_options={"type": "direct", "durable": False},
+        )
+    else:
+        manager = ChatKombuManager(
+            url="memory://",
+            channel=exchange,
+            exchange_options={"type": "fanout", "durable": False},
+        )
+    connection = kombu.Connection("memory://")
+    reader = connection.SimpleQueue(manager._queue())
+    return manager, reader
+
+
+def run(num_pods, num_pairs, num_messages, routed):
+    random.seed(0)
+    exchange = f"bench-{uuid.uuid4().hex}"
+    pods = [make_pod(routed, exchange) for _ in range(num_pods)]
+
+    rooms = []
+    for i in range(num_pairs):
+        room_id = str(uuid.uuid4())
+        members = []
+        for username in (f"user-{i}a", f"user-{i}b"):
+            pod = random.randrange(num_pods)
+            manager = pods[pod][0]
+            sid = uuid.uuid4().hex
+            manager.basic_enter_room(sid, "/", None, eio_sid=sid)
+            manager.basic_enter_room(sid, "/", sid)
+            manager.basic_enter_room(sid, "/", username)
+            manager.basic_enter_room(sid, "/", room_id)
+            members.append((pod, sid))
+        rooms.append((room_id, members))
+
+    for _ in range(num_messages):
+        room_id, members = random.choice(rooms)
+        pod, sid = random.choice(members)
+        manager = pods[pod][0]
+        manager._publish({
+            "method": "emit",
+            "event": "receive_message",
+            "data": {"message": "x" * 200, "type": "user"},
+            "namespace": "/",
+            "room": room_id,
+            "skip_sid": sid,
+            "callback": None,
+            "host_id": manager.host_id,
+        })
+
+    deliveries = echoed = unneeded = 0
+    start = time.process_time()
+    for manager, reader in pods:
+        while True:
+            try:
+                message = reader.get(block=False)
+            except Empty:
+                break
+            message.ack()
+            data = pickle.loads(message.body)
+            deliveries += 1
+            if data["host_id"] == manager.host_id:
+                echoed += 1
+            elif not manager.rooms["/"].get(data["room"]):
+                unneeded += 1
+    consume_us = (time.process_time() - start) / num_messages * 1e6
+    for _, reader in pods:
+        reader.close()
+    return [
+        deliveries / num_messages,
+        echoed / num_messages,
+        unneeded / num_messages,
+        consume_us,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pairs", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--pods", type=int, nargs="+", default=[2, 4, 8, 16])
+    args = parser.parse_args()
+
+    rows = []
+    for num_pods in args.pods:
+        for name, routed in [("fanout", False), ("routed", True)]:
+            *per_message, consume_us = run(
+                num_pods, args.pairs, args.messages, routed
+            )
+            rows.append([
+                num_pods,
+                name,
+                *(f"{value:.2f}" for value in per_message),
+                f"{consume_us:.1f}",
+            ])
+    print(f"Room messages ({args.pairs} pairs, {args.messages} messages):")
+    print_table(
+        [
+            "pods",
+            "exchange",
+            "deliveries/msg",
+            "to publisher/msg",
+            "to pods w/o recipients/msg",
+            "consumer CPU us/msg",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Bytes and CPU per relayed chat message for the two wire formats of the encrypted
+envelope, JSON arrays of byte values or Socket.IO binary attachments, and for the
+two serializers of the messages between pods (encoding.SERIALIZERS).
+
+Socket.IO bytes are those of the websocket frames the backend sends to the
+recipient, and broker bytes those of the message a pod publishes to the others.
+
+    python benchmarks/message_serialization.py --messages 5000
+"""
+import argparse
+import os
+import time
+
+from common import print_table
+from socketio import packet
+
+import encoding
+
+HOST_ID = "0123456789abcdef0123456789abcdef"
+ROOM_ID = "6f1c3f0e-8a0c-4e4e-9a57-3f0b7f1d2c11"
+
+
+def envelope(scheme, length, binary):
+    # AES-GCM appends a 16 byte tag to the ciphertext
+    fields = {"iv": os.urandom(12), "message": os.urandom(length + 16)}
+    if scheme == "session":
+        fields["epoch"] = 0
+    else:
+        fields["aes_key"] = os.urandom(256)
+    if not binary:
+        fields = {
+            field: list(value) if isinstance(value, bytes) else value
+            for field, value in fields.items()
+        }
+    return {**fields, "username": "alice", "type": "user"}
+
+
+def websocket_bytes(encoded):
+    # an engine.io message frame per packet part, with its websocket header
+    parts = encoded if isinstance(encoded, list) else [encoded]
+    total = 0
+    for part in parts:
+        size = len(part.encode()) + 1 if isinstance(part, str) else len(part)
+        total += size + (2 if size < 126 else 4)
+    return total
+
+
+def socketio_cost(message, messages):
+    start = time.perf_counter()
+    for _ in range(messages):
+        encoded = packet.Packet(
+            packet.EVENT, data=["receive_message", message], namespace="/"
+        ).encode()
+    return websocket_bytes(encoded), (time.perf_counter() - start) / messages
+
+
+def broker_cost(serializer, message, messages):
+    emit = {
+        "method": "emit",
+        "event": "receive_message",
+        "data": message,
+        "namespace": "/",
+        "room": ROOM_ID,
+        "skip_sid": "Zq0Hc3kQ9GxA1bLfAAAB",
+        "callback": None,
+        "host_id": HOST_ID,
+    }
+    start = time.perf_counter()
+    for _ in range(messages):
+        serializer.loads(serializer.dumps(emit))
+    return len(serializer.dumps(emit)), (time.perf_counter() - start) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--scheme", choices=["rsa", "session"], default="session")
+    args = parser.parse_args()
+
+    rows = []
+    for length in (20, 200, 2000):
+        for binary in (False, True):
+            message = envelope(args.scheme, length, binary)
+            size, cost = socketio_cost(message, args.messages)
+            for name in encoding.SERIALIZERS:
+                serializer = encoding.get_serializer(name)
+                broker_size, broker = broker_cost(serializer, message, args.messages)
+                rows.append([
+                    length,
+                    "binary" if binary else "json",
+                    name,
+                    f"{size:,}",
+                    f"{cost * 1e6:,.1f}",
+                    f"{broker_size:,}",
+                    f"{broker * 1e6:,.1f}",
+                ])
+    print(f"Per relayed message ({args.scheme} encryption):")
+    print_table(
+        [
+            "plaintext bytes",
+            "envelope",
+            "serializer",
+            "socket.io bytes",
+            "encode us",
+            "broker bytes",
+            "dumps+loads us",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
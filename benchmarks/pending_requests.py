@@ -0,0 +1,66 @@
+"""
+Cost of cleaning up the pending chat requests of a disconnecting user: the legacy
+scan over all request partitions versus the reverse index of senders.
+
+    python benchmarks/pending_requests.py --requests 10000 --disconnects 200
+"""
+import argparse
+import random
+
+from common import CountingRedis, print_table, timed
+
+from state_manager import RedisChatManager
+
+
+def legacy_remove_all_pending_requests(manager, username):
+    for partition in range(manager.num_partitions):
+        key = f"pending_requests{{partition_{partition}}}"
+        pending_requests = manager.redis.hgetall(key)
+        for from_username, request_data in pending_requests.items():
+            request = manager.codec.decode_request(from_username, request_data)
+            if (
+                request["from_username"] == username
+                or request["to_username"] == username
+            ):
+                manager.redis.hdel(key, from_username)
+
+
+def run(num_requests, num_disconnects, cleanup):
+    random.seed(0)
+    redis = CountingRedis()
+    manager = RedisChatManager(client=redis)
+    num_users = num_requests * 2
+    for i in range(num_requests):
+        manager.add_pending_request(f"user-{i}", f"user-{random.randrange(num_users)}")
+
+    disconnecting = random.sample(range(num_users), num_disconnects)
+    redis.round_trips = 0
+    total_time = 0
+    for i in disconnecting:
+        _, elapsed = timed(cleanup, manager, f"user-{i}")
+        total_time += elapsed
+    return total_time / num_disconnects * 1000, redis.round_trips / num_disconnects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--disconnects", type=int, default=200)
+    args = parser.parse_args()
+
+    paths = {
+        "partition scan": legacy_remove_all_pending_requests,
+        "reverse index": RedisChatManager.remove_all_pending_requests,
+    }
+    rows = []
+    for name, cleanup in paths.items():
+        ms, round_trips = run(args.requests, args.disconnects, cleanup)
+        rows.append([name, f"{ms:.3f}", f"{round_trips:.1f}"])
+    print(
+        f"Pending request cleanup per disconnect ({args.requests} pending requests):"
+    )
+    print_table(["path", "ms/disconnect", "round trips/disconnect"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Redis load on the remaining pods when the autoscaler removes a pod with thousands of
+sockets, with and without draining it first.
+
+"abrupt" is the pod going away with all its sockets: every client reconnects after
+the Socket.IO client's first reconnect delay of 0.5-1.5 seconds. "drain" is the pod
+sending server_draining to its sockets and every client moving after the delay it
+was given, while the pod keeps serving the others. Either way each client
+disconnects, reconnects and rejoins the lobby or its room, and the users stay in
+Redis. Every Redis round trip of the handlers involved runs against fakeredis on a
+simulated clock, including the disconnect grace checks of the pod while it is up.
+
+    python benchmarks/pod_drain.py --clients 1000 5000 --in-rooms 0.5 --spread 20
+"""
+import argparse
+import heapq
+import math
+import random
+
+from common import CountingRedis, print_table
+
+from drain import Drain
+from sessions import SessionRegistry
+from state_manager import RedisChatManager
+
+# first reconnect delay of the Socket.IO client: reconnectionDelay of 1000 ms with
+# a randomizationFactor of 0.5
+CLIENT_RECONNECT = (0.5, 1.5)
+DISCONNECT_GRACE_SECONDS = 10
+
+
+class RecordingServer:
+    def __init__(self):
+        self.emits = []
+
+    def emit(self, event, data, room=None, ignore_queue=False):
+        self.emits.append((event, data, room))
+
+    def sleep(self, seconds):
+        pass
+
+
+def populate(manager, sessions, clients, in_rooms):
+    rooms = {}
+    usernames = [f"user-{i}" for i in range(clients)]
+    for i, username in enumerate(usernames):
+        manager.add_user(username)
+        manager.add_socket(username)
+        sessions.open(f"sid-{i}", username)
+    for i in range(0, int(clients * in_rooms) // 2 * 2, 2):
+        chatroom = manager.create_chatroom(
+            {"username": usernames[i]}, {"username": usernames[i + 1]}
+        )
+        rooms[usernames[i]] = rooms[usernames[i + 1]] = chatroom["id"]
+    return usernames, rooms
+
+
+def move_delays(mode, sessions, spread, rng):
+    """
+    Seconds after the start of the shutdown at which each user's socket moves.
+    """
+    if mode == "abrupt":
+        return {
+            session.username: rng.uniform(*CLIENT_RECONNECT) for session in sessions
+        }
+    server = RecordingServer()
+    Drain(server, sessions, None, None, spread=spread).notify()
+    by_sid = {session.sid: session.username for session in sessions}
+    return {
+        by_sid[sid]: data["reconnect_delay_ms"] / 1000
+        for event, data, sid in server.emits
+        if event == "server_draining"
+    }
+
+
+def run(mode, clients, in_rooms, spread, bucket, seed):
+    rng = random.Random(seed)
+    redis = CountingRedis()
+    manager = RedisChatManager(client=redis)
+    manager.scripts.load()
+    sessions = SessionRegistry()
+    usernames, rooms = populate(manager, sessions, clients, in_rooms)
+    delays = move_delays(mode, sessions, spread, rng)
+
+    # (time, action, username); the client disconnects as it moves, when the pod
+    # goes away in the abrupt case
+    events = []
+    for username, delay in delays.items():
+        disconnect_at = 0.0 if mode == "abrupt" else delay
+        events.append((disconnect_at, "disconnect", username))
+        events.append((delay, "reconnect", username))
+    pod_up_until = 0.0 if mode == "abrupt" else max(delays.values())
+    heapq.heapify(events)
+
+    ops = {}  # bucket -> round trips
+    while events:
+        at, action, username = heapq.heappop(events)
+        redis.round_trips = 0
+        if action == "disconnect":
+            if manager.remove_socket(username) == 0:
+                # the pod checks whether the user came back after the grace period,
+                # if it is still up by then
+                check_at = at + DISCONNECT_GRACE_SECONDS
+                if check_at < pod_up_until:
+                    heapq.heappush(events, (check_at, "grace_check", username))
+        elif action == "grace_check":
+            if not manager.count_sockets(username):
+                raise AssertionError(f"{username} would have been released")
+        else:
+            manager.add_socket(username)
+            if username in rooms:
+                assert manager.get_chatroom(rooms[username], username), "room lost"
+            else:
+                assert manager.get_user(username), "user lost"
+        index = int(at / bucket)
+        ops[index] = ops.get(index, 0) + redis.round_trips
+
+    assert all(manager.count_sockets(username) == 1 for username in usernames)
+    total = sum(ops.values())
+    last = max(delays.values())
+    return {
+        "total": total,
+        "peak": max(ops.values()),
+        "moved by s": last,
+        "mean": total / max(1, math.ceil(last / bucket)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--in-rooms", type=float, default=0.5)
+    parser.add_argument("--spread", type=float, default=20.0)
+    parser.add_argument("--bucket", type=float, default=1.0, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = []
+    for clients in args.clients:
+        for mode in ("abrupt", "drain"):
+            result = run(
+                mode, clients, args.in_rooms, args.spread, args.bucket, args.seed
+            )
+            if mode == "drain":
+                # moves are spread uniformly, so the busiest second stays close to
+                # the average one
+                assert result["peak"] <= 1.5 * result["mean"], "peak not bounded"
+            rows.append([
+                clients,
+                mode,
+                f"{result['moved by s']:.1f}",
+                f"{result['total']:,}",
+                f"{result['peak']:,}",
+                f"{result['peak'] / args.bucket:,.0f}",
+            ])
+    print(
+        f"Removing a pod, {args.in_rooms:.0%} of its users in rooms, drain spread "
+        f"over {args.spread:g}s (all users kept their lobby or room):"
+    )
+    print_table(
+        [
+            "clients",
+            "shutdown",
+            "moved by s",
+            "Redis trips",
+            f"peak per {args.bucket:g}s",
+            "peak trips/s",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
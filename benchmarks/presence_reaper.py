@@ -0,0 +1,132 @@
+"""
+Records left behind by users who never left the server, e.g. because their tab
+crashed, and how the presence reaper removes them while live users stay.
+
+Starts with --live users whose sockets keep them seen and --dead users who stopped
+being seen at once, a quarter of whom are in chat rooms and a quarter have a pending
+chat request. --legacy more dead users were added before presence was tracked. The
+pod heartbeats and reaps every 10 simulated seconds with the default settings, and
+the table shows the state of Redis after each pass.
+
+    python benchmarks/presence_reaper.py --live 2000 --dead 5000 --legacy 1000
+"""
+import argparse
+
+from common import CountingRedis, print_table
+
+import presence as presence_module
+import state_manager
+from presence import Presence
+from sessions import SocketSession
+from state_manager import RedisChatManager
+
+
+class SimulatedTime:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+def users_in_redis(manager):
+    return sum(
+        manager.redis.hlen(manager._keys_of_partition(partition).users)
+        for partition in range(manager.num_partitions)
+    )
+
+
+def run(live, dead, legacy, ttl, interval, batch_size, duration):
+    clock = SimulatedTime()
+    presence_module.time = clock
+    state_manager.time = clock
+
+    redis = CountingRedis()
+    manager = RedisChatManager(client=redis)
+    sessions = [SocketSession(f"sid-{i}", f"live-{i}") for i in range(live)]
+    for session in sessions:
+        manager.add_user(session.username)
+
+    dead_users = [f"dead-{i}" for i in range(dead + legacy)]
+    for username in dead_users:
+        manager.add_user(username)
+    for i in range(0, dead // 4, 2):
+        manager.create_chatroom(
+            {"username": dead_users[i]}, {"username": dead_users[i + 1]}
+        )
+    for i in range(dead // 2, dead // 2 + dead // 4):
+        manager.add_pending_request(dead_users[i], sessions[i % live].username)
+    for username in dead_users[dead:]:
+        redis.zrem(manager._partition_keys(username).presence, username)
+
+    presence = Presence(None, manager, sessions, ttl=ttl, batch_size=batch_size)
+    rows = []
+    elapsed = 0
+    while elapsed <= duration:
+        redis.round_trips = 0
+        presence.heartbeat()
+        heartbeat_trips = redis.round_trips
+
+        redis.round_trips = 0
+        presence.reap()
+        reap_trips = redis.round_trips
+
+        live_left = sum(1 for s in sessions if manager.get_user(s.username))
+        rows.append([
+            elapsed,
+            f"{users_in_redis(manager):,}",
+            f"{len(manager.list_users_in_lobby()):,}",
+            f"{live_left:,}",
+            f"{presence.reaped['users']:,}",
+            presence.reaped["pending_requests"],
+            presence.reaped["chatrooms"],
+            heartbeat_trips,
+            reap_trips,
+        ])
+        clock.now += interval
+        elapsed += interval
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--live", type=int, default=2000)
+    parser.add_argument("--dead", type=int, default=5000)
+    parser.add_argument("--legacy", type=int, default=1000)
+    parser.add_argument("--ttl", type=float, default=60.0)
+    parser.add_argument("--interval", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--duration", type=int, default=300)
+    args = parser.parse_args()
+
+    rows = run(
+        args.live,
+        args.dead,
+        args.legacy,
+        args.ttl,
+        args.interval,
+        args.batch_size,
+        args.duration,
+    )
+    print(
+        f"{args.live} live and {args.dead + args.legacy} dead users, "
+        f"TTL {args.ttl:g}s, reaping {args.batch_size} users per pass:"
+    )
+    print_table(
+        [
+            "seconds",
+            "users in Redis",
+            "lobby",
+            "live users",
+            "reaped",
+            "requests",
+            "rooms",
+            "heartbeat trips",
+            "reap trips",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
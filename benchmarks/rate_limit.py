@@ -0,0 +1,104 @@
+"""
+Cost and accuracy of the Socket.IO event rate limits: the time to check an event
+against the per-pod token buckets and against the shared ones in Redis (fakeredis,
+with an optional artificial round-trip time), and how many events of a flood get
+through, on a simulated clock, compared to the configured rate and burst.
+
+    python benchmarks/rate_limit.py --events 20000 --rtt-ms 0.5
+"""
+import argparse
+import time
+
+from common import CountingRedis, print_table
+
+import rate_limit
+from rate_limit import RedisTokenBucketLimiter, TokenBucketLimiter, parse_limits
+
+LIMITS = "send_message=10/30,join_lobby=0.5/5"
+
+
+class LatencyRedis(CountingRedis):
+    rtt = 0.0
+
+    def execute_command(self, *args, **options):
+        if self.rtt:
+            time.sleep(self.rtt)
+        return super().execute_command(*args, **options)
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+
+def check_cost(limiter, events):
+    start = time.perf_counter()
+    for i in range(events):
+        limiter.allow(f"sid-{i % 100}", f"user-{i % 100}", "send_message")
+    return (time.perf_counter() - start) / events
+
+
+def flood(limiter, clock, event, per_second, seconds):
+    clock.now = 1_000_000.0
+    allowed = 0
+    for _ in range(int(per_second * seconds)):
+        clock.now += 1 / per_second
+        allowed += limiter.allow("sid-flood", "flooder", event)
+    return allowed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--rtt-ms", type=float, default=0.0)
+    parser.add_argument("--flood-per-second", type=float, default=200)
+    parser.add_argument("--flood-seconds", type=float, default=10)
+    args = parser.parse_args()
+
+    limits = parse_limits(LIMITS)
+    redis = LatencyRedis()
+    limiters = {
+        "local": lambda: TokenBucketLimiter(limits),
+        "redis": lambda: RedisTokenBucketLimiter(redis, limits),
+    }
+
+    rows = []
+    for name, create in limiters.items():
+        redis.rtt = args.rtt_ms / 1000
+        redis.round_trips = 0
+        cost = check_cost(create(), args.events)
+        rows.append([
+            name, f"{cost * 1e6:,.1f}", f"{redis.round_trips / args.events:.1f}"
+        ])
+    print(f"Checking an event (Redis RTT {args.rtt_ms}ms):")
+    print_table(["store", "us/event", "round trips/event"], rows)
+
+    redis.rtt = 0.0
+    clock = SimulatedClock()
+    rate_limit.time = clock
+    rows = []
+    for event, (rate, burst) in limits.items():
+        expected = min(
+            args.flood_per_second * args.flood_seconds,
+            burst + rate * args.flood_seconds,
+        )
+        for name, create in limiters.items():
+            allowed = flood(
+                create(), clock, event, args.flood_per_second, args.flood_seconds
+            )
+            rows.append([event, name, allowed, f"{expected:,.0f}"])
+    print(
+        f"\nFlood of {args.flood_per_second:,.0f} events/s for "
+        f"{args.flood_seconds:,.0f}s from one socket:"
+    )
+    print_table(["event", "store", "allowed", "rate * seconds + burst"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Pool saturation of one gevent pod: greenlets issuing Redis commands through the
+metered blocking pool against a local fakeredis TCP server, for different pool sizes.
+Shows the pool wait and command latency histograms and the peak of connections in
+use that the backend reports at /api/redis_pool_stats.
+
+    python benchmarks/redis_pool.py --greenlets 200 --commands 50
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import argparse
+import threading
+import time
+
+import gevent
+from fakeredis import TcpFakeServer
+from redis import Redis
+
+from common import print_table
+
+from redis_client import MeteredConnectionPool, RedisPoolMetrics
+
+HOST, PORT = "127.0.0.1", 16399
+
+
+def run(pool_size, num_greenlets, num_commands, pool_timeout):
+    metrics = RedisPoolMetrics()
+    pool = MeteredConnectionPool(
+        metrics,
+        host=HOST,
+        port=PORT,
+        max_connections=pool_size,
+        timeout=pool_timeout,
+        decode_responses=True,
+    )
+    redis = Redis(connection_pool=pool)
+
+    def worker(i):
+        for j in range(num_commands):
+            try:
+                redis.hset("connected_users{partition_0}", f"user-{i}", j)
+                redis.hget("connected_users{partition_0}", f"user-{i}")
+            except Exception:
+                pass
+
+    start = time.perf_counter()
+    gevent.joinall([gevent.spawn(worker, i) for i in range(num_greenlets)])
+    elapsed = time.perf_counter() - start
+    pool.disconnect()
+    stats = metrics.stats()
+    return [
+        pool_size,
+        f"{num_greenlets * num_commands * 2 / elapsed:,.0f}",
+        stats["max_in_use"],
+        f"{stats['pool_wait']['p50_ms']:.1f}",
+        f"{stats['pool_wait']['p99_ms']:.1f}",
+        f"{stats['command_latency']['p50_ms']:.1f}",
+        f"{stats['command_latency']['p99_ms']:.1f}",
+        stats["pool_timeouts"],
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--greenlets", type=int, default=200)
+    parser.add_argument("--commands", type=int, default=50)
+    parser.add_argument("--pool-sizes", type=int, nargs="+", default=[5, 20, 50, 200])
+    parser.add_argument("--pool-timeout", type=float, default=5.0)
+    args = parser.parse_args()
+
+    # the socketserver default backlog of 5 would stall connects of larger pools
+    TcpFakeServer.request_queue_size = 1024
+    server = TcpFakeServer((HOST, PORT), server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    rows = [
+        run(size, args.greenlets, args.commands, args.pool_timeout)
+        for size in args.pool_sizes
+    ]
+    server.shutdown()
+    print(f"{args.greenlets} greenlets x {args.commands * 2} commands:")
+    print_table(
+        [
+            "max conns",
+            "commands/sec",
+            "max in use",
+            "wait p50 ms",
+            "wait p99 ms",
+            "cmd p50 ms",
+            "cmd p99 ms",
+            "timeouts",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Expiry of unanswered chat requests on a simulated clock, checked against what should
+have happened, and the requests an expiry pass reads against the pending requests a
+full-hash scan of every partition would read to find the due ones.
+
+--requests users send a chat request at random times over --spread seconds and half
+of them are answered before the deadline. The pod runs an expiry pass every
+--interval seconds. Every unanswered request must time out once, within one interval
+after its deadline, the requester must be told, and nothing of the request may be
+left in Redis. Runs against fakeredis, or against a local Redis given by
+--redis-url, e.g. redis://127.0.0.1:6379/0 (which is flushed first).
+
+    python benchmarks/request_expiry.py --requests 5000 --ttl 30 --interval 1
+"""
+import argparse
+import random
+
+import redis
+from common import CountingRedis, print_table
+
+import request_expiry
+import state_manager
+from request_expiry import RequestExpiry
+from state_manager import RedisChatManager
+
+
+class SimulatedTime:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+class RecordingServer:
+    def __init__(self):
+        self.emits = []
+
+    def emit(self, event, data, room=None):
+        self.emits.append((event, data, room))
+
+
+def leftovers(manager):
+    """
+    Pending requests, deadlines and reverse index entries still in Redis.
+    """
+    total = 0
+    for partition in range(manager.num_partitions):
+        keys = manager._keys_of_partition(partition)
+        total += manager.redis.hlen(keys.requests)
+        total += manager.redis.zcard(keys.request_deadlines)
+        pattern = f"incoming_requests{{partition_{partition}}}:*"
+        for key in manager.redis.scan_iter(pattern):
+            total += manager.redis.scard(key)
+    return total
+
+
+def run(client, requests, ttl, interval, spread, seed):
+    rng = random.Random(seed)
+    clock = SimulatedTime()
+    state_manager.time = clock
+    request_expiry.time = clock
+    start = clock.now
+
+    manager = RedisChatManager(client=client, request_ttl=ttl)
+    manager.scripts.load()
+    server = RecordingServer()
+    expiry = RequestExpiry(server, manager, interval=interval)
+
+    # (time, action, requester) in time order; the recipients are other users
+    events = []
+    for i in range(requests):
+        sent_at = start + rng.uniform(0, spread)
+        events.append((sent_at, "request", i))
+        if i % 2 == 0:
+            events.append((sent_at + rng.uniform(0, ttl * 0.9), "answer", i))
+    events.sort()
+    sent_at = {i: t for t, action, i in events if action == "request"}
+
+    round_trips = []
+    due_reads = []  # requests an expiry pass reads
+    scan_reads = []  # requests a scan of every partition's requests would read
+    outstanding = 0
+    expired_at = {}
+    next_pass = start + interval
+    pending = iter(events)
+    event = next(pending, None)
+    while event is not None or len(expired_at) < requests // 2:
+        while event is not None and event[0] <= next_pass:
+            clock.now, action, i = event
+            if action == "request":
+                manager.add_pending_request(f"requester-{i}", f"recipient-{i}")
+                outstanding += 1
+            else:
+                manager.remove_pending_request(f"requester-{i}", f"recipient-{i}")
+                outstanding -= 1
+            event = next(pending, None)
+        clock.now = next_pass
+        counted = isinstance(client, CountingRedis)
+        if counted:
+            client.round_trips = 0
+        scan_reads.append(outstanding)
+        expired = expiry.expire()
+        for from_username, _ in expired:
+            i = int(from_username.split("-")[1])
+            if i in expired_at:
+                raise AssertionError(f"Request {i} expired twice")
+            expired_at[i] = clock.now
+        outstanding -= len(expired)
+        due_reads.append(len(expired))
+        if counted:
+            round_trips.append(client.round_trips)
+        next_pass += interval
+
+    answered = {i for t, action, i in events if action == "answer"}
+    assert not answered & expired_at.keys(), "answered requests expired"
+    assert len(expired_at) == requests - len(answered), "requests did not expire"
+    lateness = [expired_at[i] - (sent_at[i] + ttl) for i in expired_at]
+    assert min(lateness) >= 0, "requests expired before their deadline"
+    assert max(lateness) <= interval + 1e-6, "requests expired too late"
+    told = {room for event, data, room in server.emits if data.get("timed_out")}
+    assert told == {f"requester-{i}" for i in expired_at}, "requesters not told"
+    assert all(
+        manager.get_pending_request(f"requester-{i}") is None for i in expired_at
+    ), "requesters still blocked"
+    assert leftovers(manager) == 0, "requests left in Redis"
+
+    return {
+        "requests": requests,
+        "answered": len(answered),
+        "expired": len(expired_at),
+        "max late s": f"{max(lateness):.2f}",
+        "passes": len(due_reads),
+        "trips/pass": (
+            f"{sum(round_trips) / len(round_trips):.2f}" if round_trips else "-"
+        ),
+        "requests read/pass": f"{sum(due_reads) / len(due_reads):.1f}",
+        "scan would read": f"{sum(scan_reads) / len(scan_reads):.1f}",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--ttl", type=float, default=30.0)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--spread", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--redis-url")
+    args = parser.parse_args()
+
+    if args.redis_url:
+        client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+        client.flushdb()
+    else:
+        client = CountingRedis()
+    result = run(
+        client, args.requests, args.ttl, args.interval, args.spread, args.seed
+    )
+    print(
+        f"Pending chat requests with a {args.ttl:g}s deadline, expired every "
+        f"{args.interval:g}s (all checks passed):"
+    )
+    print_table(list(result), [list(result.values())])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Cost of keeping the per-room message history: round trips and time to append a
+message, the size a room's history is bounded to, and the round trips and time for
+a reconnecting client to fetch the messages it missed.
+
+    python benchmarks/room_history.py --rooms 100 --messages 1000 --maxlen 200
+"""
+import argparse
+import os
+import time
+
+from common import CountingRedis, print_table
+
+from message_history import RoomHistory
+
+
+def envelope(username):
+    # sizes of the fields chat_room.js sends: an RSA-2048 wrapped AES key, a GCM IV
+    # and a short message with its tag, each as a list of byte values
+    return {
+        "aes_key": list(os.urandom(256)),
+        "iv": list(os.urandom(12)),
+        "message": list(os.urandom(80)),
+        "username": username,
+        "type": "user",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=1000, help="per room")
+    parser.add_argument("--maxlen", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=50)
+    args = parser.parse_args()
+
+    redis = CountingRedis()
+    history = RoomHistory(redis, maxlen=args.maxlen, batch_size=args.batch_size)
+    message = envelope("alice")
+    ids = {}
+    start = time.perf_counter()
+    for room in range(args.rooms):
+        for _ in range(args.messages):
+            ids.setdefault(room, []).append(history.append(f"room-{room}", message))
+    elapsed = time.perf_counter() - start
+    appends = args.rooms * args.messages
+
+    lengths = [redis.xlen(history._key(f"room-{room}")) for room in range(args.rooms)]
+    stored = sum(
+        len(fields["data"])
+        for room in range(args.rooms)
+        for _, fields in redis.xrange(history._key(f"room-{room}"))
+    )
+    print(f"Appending {appends:,} messages to {args.rooms} rooms:")
+    print_table(
+        ["us/append", "round trips/append", "max entries/room", "stored KB/room"],
+        [[
+            f"{elapsed / appends * 1e6:,.1f}",
+            f"{redis.round_trips / appends:.1f}",
+            max(lengths),
+            f"{stored / args.rooms / 1024:,.1f}",
+        ]],
+    )
+
+    rows = []
+    room_ids = ids[0]
+    for missed in (1, 10, args.batch_size, args.maxlen, args.messages):
+        after_id = room_ids[-missed - 1] if missed < len(room_ids) else "0-0"
+        redis.round_trips = 0
+        fetched = 0
+        start = time.perf_counter()
+        more = True
+        while more:
+            entries, more = history.read_after("room-0", after_id)
+            if entries:
+                after_id = entries[-1][0]
+                fetched += len(entries)
+        elapsed = time.perf_counter() - start
+        rows.append([
+            missed,
+            fetched,
+            redis.round_trips,
+            f"{elapsed * 1000:,.2f}",
+        ])
+    print(f"\nResuming after missed messages (batches of {args.batch_size}):")
+    print_table(["missed", "fetched", "round trips", "ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
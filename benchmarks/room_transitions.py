@@ -0,0 +1,145 @@
+"""
+Throughput of room create/leave cycles with the legacy read-modify-write pipelines
+versus the per-partition Lua scripts. A cycle creates a room for two lobby users and
+lets both of them leave it again.
+
+fakeredis has no network latency, so besides the measured cycles/sec the table shows
+the round trips per cycle and the throughput they allow at a given Redis RTT.
+
+    python benchmarks/room_transitions.py --cycles 2000 --rtt-ms 0.5
+"""
+import argparse
+import time
+import uuid
+
+from common import CountingRedis, print_table
+
+from encoding import _from_json, _to_json
+from state_manager import RedisChatManager
+
+
+def legacy_create_chatroom(manager, user1, user2):
+    room_id = str(uuid.uuid4())
+    chatroom = {"id": room_id, "users": [user1["username"], user2["username"]]}
+    user1["in_room"] = True
+    user2["in_room"] = True
+    user_partition1 = manager._get_partition(user1["username"])
+    user_partition2 = manager._get_partition(user2["username"])
+    room_partition = manager._get_partition(room_id)
+    pipeline = manager.redis.pipeline()
+    pipeline.hset(
+        f"chatrooms{{room_partition_{room_partition}}}", room_id, _to_json(chatroom)
+    )
+    pipeline.srem(
+        f"users_in_lobby{{lobby_partition_{user_partition1}}}", user1["username"]
+    )
+    pipeline.srem(
+        f"users_in_lobby{{lobby_partition_{user_partition2}}}", user2["username"]
+    )
+    pipeline.hset(
+        f"connected_users{{users_partition_{user_partition1}}}",
+        user1["username"],
+        _to_json(user1)
+    )
+    pipeline.hset(
+        f"connected_users{{users_partition_{user_partition2}}}",
+        user2["username"],
+        _to_json(user2)
+    )
+    pipeline.execute()
+    manager.roster.apply(
+        [("remove", user1["username"]), ("remove", user2["username"])]
+    )
+    return chatroom
+
+
+def legacy_leave_chatroom(manager, username, room_id):
+    user_partition = manager._get_partition(username)
+    room_partition = manager._get_partition(room_id)
+    user = _from_json(manager.redis.hget(
+        f"connected_users{{users_partition_{user_partition}}}", username
+    ))
+    chatroom = _from_json(manager.redis.hget(
+        f"chatrooms{{room_partition_{room_partition}}}", room_id
+    ))
+    user["in_room"] = False
+    pipeline = manager.redis.pipeline()
+    pipeline.sadd(f"users_in_lobby{{lobby_partition_{user_partition}}}", username)
+    pipeline.hset(
+        f"connected_users{{users_partition_{user_partition}}}",
+        username,
+        _to_json(user)
+    )
+    chatroom["users"].remove(username)
+    if not chatroom["users"]:
+        pipeline.hdel(f"chatrooms{{room_partition_{room_partition}}}", room_id)
+    else:
+        pipeline.hset(
+            f"chatrooms{{room_partition_{room_partition}}}",
+            room_id,
+            _to_json(chatroom)
+        )
+    pipeline.execute()
+    manager.roster.add(username)
+
+
+def legacy_setup(manager, username):
+    partition = manager._get_partition(username)
+    manager.redis.hset(
+        f"connected_users{{users_partition_{partition}}}",
+        username,
+        _to_json({"username": username, "in_room": False})
+    )
+    manager.redis.sadd(f"users_in_lobby{{lobby_partition_{partition}}}", username)
+
+
+def run(num_cycles, legacy):
+    redis = CountingRedis()
+    manager = RedisChatManager(client=redis)
+    manager.scripts.load()
+    usernames = [f"user-{i}" for i in range(num_cycles * 2)]
+    for username in usernames:
+        if legacy:
+            legacy_setup(manager, username)
+        else:
+            manager.add_user(username)
+
+    redis.round_trips = 0
+    start = time.perf_counter()
+    for i in range(num_cycles):
+        user1 = {"username": usernames[2 * i], "in_room": False}
+        user2 = {"username": usernames[2 * i + 1], "in_room": False}
+        if legacy:
+            chatroom = legacy_create_chatroom(manager, user1, user2)
+            for username in chatroom["users"]:
+                legacy_leave_chatroom(manager, username, chatroom["id"])
+        else:
+            chatroom = manager.create_chatroom(user1, user2)
+            for username in chatroom["users"]:
+                manager.leave_chatroom(username, chatroom["id"])
+    elapsed = time.perf_counter() - start
+    return num_cycles / elapsed, redis.round_trips / num_cycles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cycles", type=int, default=2000)
+    parser.add_argument("--rtt-ms", type=float, default=0.5)
+    args = parser.parse_args()
+
+    rows = []
+    for name, legacy in [("pipelines", True), ("lua scripts", False)]:
+        cycles_per_sec, round_trips = run(args.cycles, legacy)
+        at_rtt = 1000 / (1000 / cycles_per_sec + round_trips * args.rtt_ms)
+        rows.append([
+            name, f"{cycles_per_sec:,.0f}", f"{round_trips:.1f}", f"{at_rtt:,.0f}"
+        ])
+    print(f"Room create/leave cycles ({args.cycles} cycles, one greenlet):")
+    print_table(
+        ["path", "cycles/sec", "round trips/cycle", f"cycles/sec @ {args.rtt_ms}ms"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
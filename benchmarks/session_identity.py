@@ -0,0 +1,90 @@
+"""
+Per-event cost of resolving who sent a Socket.IO event: re-validating the identity
+fields of the payload against Redis, as the handlers used to, versus reading the
+connect-time session. fakeredis is used with an optional artificial round-trip time.
+
+    python benchmarks/session_identity.py --events 5000 --rtt-ms 0.5
+"""
+import argparse
+import time
+
+from common import CountingRedis, print_table
+
+from authz_cache import RoomAuthorizationCache
+from sessions import SessionRegistry
+from state_manager import RedisChatManager
+
+
+class LatencyRedis(CountingRedis):
+    rtt = 0.0
+
+    def execute_command(self, *args, **options):
+        if self.rtt:
+            time.sleep(self.rtt)
+        return super().execute_command(*args, **options)
+
+
+def payload_identity(manager, event, data):
+    if event == "chat_request":
+        return manager.get_user(data["from_user"]) is not None
+    return manager.user_authorized_in_room(data["username"], data["room_id"])
+
+
+def session_identity(sessions, room_authz, sid, event):
+    session = sessions.get(sid)
+    if event == "chat_request":
+        return session.in_lobby
+    return room_authz.is_authorized(sid, session.username, session.room_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--rtt-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    redis = LatencyRedis()
+    manager = RedisChatManager(client=redis)
+    manager.scripts.load()
+    manager.add_user("alice")
+    manager.add_user("bob")
+    room_id = manager.create_chatroom({"username": "alice"}, {"username": "bob"})["id"]
+
+    sessions = SessionRegistry()
+    room_authz = RoomAuthorizationCache(manager)
+    session = sessions.open("sid-alice", "alice")
+    session.in_lobby = True
+    session.room_id = room_id
+    room_authz.grant("sid-alice", "alice", room_id)
+    redis.rtt = args.rtt_ms / 1000
+
+    payloads = {
+        "send_message": {"username": "alice", "room_id": room_id},
+        "chat_request": {"from_user": "alice", "to_user": "bob"},
+    }
+    rows = []
+    for event, data in payloads.items():
+        paths = {
+            "payload": lambda: payload_identity(manager, event, data),
+            "session": lambda: session_identity(
+                sessions, room_authz, "sid-alice", event
+            ),
+        }
+        for path, resolve in paths.items():
+            redis.round_trips = 0
+            start = time.perf_counter()
+            for _ in range(args.events):
+                assert resolve()
+            elapsed = time.perf_counter() - start
+            rows.append([
+                event,
+                path,
+                f"{elapsed / args.events * 1e6:,.1f}",
+                f"{redis.round_trips / args.events:.1f}",
+            ])
+    print(f"Identity resolution per event (Redis RTT {args.rtt_ms}ms):")
+    print_table(["event", "identity", "us/event", "round trips/event"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+CPU cost of the partitioner and codec choices of the user state, per call of the
+hot state manager methods and per partitioner/codec operation on its own. Also
+checks that a manager running the compact codec reads and consumes records written
+by one running the JSON codec, as during a rolling codec migration.
+
+The per-call numbers include the cost of fakeredis, which is the same for every
+configuration, so the differences between the rows are what the client saves.
+
+    python benchmarks/state_codec.py --calls 5000
+"""
+import argparse
+import time
+
+from common import CountingRedis, print_table
+
+import encoding
+from state_manager import RedisChatManager
+
+CONFIGURATIONS = [("md5", "json"), ("crc32", "compact"), ("crc16", "compact")]
+
+
+def per_call_us(fn, args_list):
+    start = time.process_time()
+    for args in args_list:
+        fn(*args)
+    return (time.process_time() - start) / len(args_list) * 1e6
+
+
+def bench_manager(partitioner, codec, num_calls):
+    manager = RedisChatManager(
+        client=CountingRedis(), partitioner=partitioner, codec=codec
+    )
+    manager.scripts.load()
+    usernames = [f"user-{i}" for i in range(num_calls * 2)]
+    for username in usernames:
+        manager.add_user(username)
+
+    get_user = per_call_us(manager.get_user, [(u,) for u in usernames[:num_calls]])
+    rooms = []
+
+    def create_chatroom(user1, user2):
+        rooms.append(manager.create_chatroom(user1, user2))
+
+    create = per_call_us(
+        create_chatroom,
+        [
+            ({"username": usernames[2 * i]}, {"username": usernames[2 * i + 1]})
+            for i in range(num_calls)
+        ],
+    )
+    leave = per_call_us(
+        manager.leave_chatroom,
+        [(username, room["id"]) for room in rooms for username in room["users"]],
+    )
+    return get_user, create, leave
+
+
+def bench_operations(partitioner_name, codec_name, num_calls):
+    partitioner = encoding.get_partitioner(partitioner_name, 100)
+    codec = encoding.get_codec(codec_name)
+    usernames = [f"user-{i}" for i in range(num_calls)]
+    user = {"username": "user-0", "in_room": True}
+    room = {"id": "2f1c8d0e-5a4b-4c1e-9f0a-7d2b3c4e5f60", "users": ["alice", "bob"]}
+    stored_user = codec.encode_user(user)
+    stored_room = codec.encode_room(room)
+    return [
+        per_call_us(partitioner, [(u,) for u in usernames]),
+        per_call_us(codec.encode_user, [(user,)] * num_calls),
+        per_call_us(codec.decode_user, [("user-0", stored_user)] * num_calls),
+        per_call_us(codec.encode_room, [(room,)] * num_calls),
+        per_call_us(codec.decode_room, [(room["id"], stored_room)] * num_calls),
+        len(stored_user),
+        len(stored_room),
+    ]
+
+
+def check_dual_read():
+    redis = CountingRedis()
+    old = RedisChatManager(client=redis, codec="json")
+    new = RedisChatManager(client=redis, codec="compact")
+    old.scripts.load()
+    old.add_user("alice")
+    old.add_user("bob")
+    old.add_pending_request("alice", "bob")
+    assert new.get_user("alice") == {"username": "alice", "in_room": False}
+    assert new.get_pending_request("alice")["to_username"] == "bob"
+    chatroom = new.accept_chat_request("alice", "bob")
+    assert chatroom and old.get_chatroom(chatroom["id"], "bob") == chatroom
+    assert old.get_user("alice")["in_room"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=5000)
+    args = parser.parse_args()
+
+    check_dual_read()
+    print("JSON records are readable and consumable by the compact codec\n")
+
+    rows = []
+    for partitioner, codec in CONFIGURATIONS:
+        timings = bench_manager(partitioner, codec, args.calls)
+        rows.append([f"{partitioner} + {codec}", *(f"{t:.1f}" for t in timings)])
+    print(f"CPU us per call with fakeredis ({args.calls} calls):")
+    print_table(
+        ["configuration", "get_user", "create_chatroom", "leave_chatroom"], rows
+    )
+
+    rows = []
+    for partitioner, codec in CONFIGURATIONS:
+        *timings, user_bytes, room_bytes = bench_operations(
+            partitioner, codec, args.calls * 10
+        )
+        rows.append([
+            f"{partitioner} + {codec}",
+            *(f"{t:.2f}" for t in timings),
+            user_bytes,
+            room_bytes,
+        ])
+    print("\nCPU us per operation and stored record size:")
+    print_table(
+        [
+            "configuration",
+            "partition",
+            "enc user",
+            "dec user",
+            "enc room",
+            "dec room",
+            "user bytes",
+            "room bytes",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
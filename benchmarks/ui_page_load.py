@@ -0,0 +1,179 @@
+"""
+Latency of chat room page loads in the UI service under concurrent users, with a
+new connection to the backend per request (as before backend_client), with the
+pooled keep-alive BackendClient, and with the pooled client and its cache of granted
+room pages.
+
+The UI app runs in-process under the Flask test client, one thread per user, and
+the backend is a stub HTTP server that answers after an artificial delay and counts
+the requests and connections it receives.
+
+    python benchmarks/ui_page_load.py --users 20 --loads 50 --backend-ms 2
+"""
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from common import print_table
+
+UI_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "app", "ui")
+sys.path.insert(0, os.path.abspath(UI_DIR))
+
+from backend_client import BackendClient
+
+
+class StubBackend(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # as gunicorn, headers and body go out at once
+    delay = 0.0
+    requests = 0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            StubBackend.connections += 1
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            StubBackend.requests += 1
+        time.sleep(self.delay)
+        if self.path == "/api/validate":
+            body = {"results": [
+                check["check"] == "room_access" for check in payload["checks"]
+            ]}
+        elif self.path == "/api/verify_room_access":
+            body = {"authorized": True}
+        else:
+            body = {"available": True}
+        encoded = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PerRequestBackend:
+    """
+    The UI's calls to the backend before the pooled client: a new connection per
+    call, no timeouts and no caching.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def check_room_page(self, username, room_id):
+        response = requests.post(
+            f"{self.base_url}/api/verify_room_access",
+            json={"room_id": room_id, "username": username},
+        )
+        return True, response.json().get("authorized")
+
+
+def load_ui_app(backend_url):
+    os.environ.update({
+        "BACKEND_URL": backend_url,
+        "FLASK_ENV": "production",
+        "FLASK_DEBUG": "false",
+        "FLASK_SECRET_KEY": "benchmark",
+    })
+    spec = importlib.util.spec_from_file_location(
+        "ui_app", os.path.join(UI_DIR, "app.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["ui_app"] = module  # Flask finds the templates through it
+    spec.loader.exec_module(module)
+    module.logger.disabled = True
+    return module
+
+
+def user_session(ui, index, loads):
+    client = ui.app.test_client()
+    with client.session_transaction() as session:
+        session["username"] = f"user-{index}"
+    latencies = []
+    for _ in range(loads):
+        start = time.perf_counter()
+        response = client.get(f"/chat_room?room_id=room-{index // 2}")
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.status_code
+    return latencies
+
+
+def run(ui, backend, users, loads):
+    ui.backend = backend
+    StubBackend.requests = 0
+    StubBackend.connections = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        results = executor.map(
+            lambda index: user_session(ui, index, loads), range(users)
+        )
+        latencies = sorted(latency for result in results for latency in result)
+    elapsed = time.perf_counter() - start
+    return [
+        f"{statistics.median(latencies) * 1000:.2f}",
+        f"{latencies[int(len(latencies) * 0.99)] * 1000:.2f}",
+        f"{len(latencies) / elapsed:,.0f}",
+        StubBackend.requests,
+        StubBackend.connections,
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--loads", type=int, default=50)
+    parser.add_argument("--backend-ms", type=float, default=2.0)
+    args = parser.parse_args()
+
+    StubBackend.delay = args.backend_ms / 1000
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBackend)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    backend_url = f"http://127.0.0.1:{server.server_port}"
+    ui = load_ui_app(backend_url)
+
+    clients = {
+        "per-request": PerRequestBackend(backend_url),
+        "pooled": BackendClient(backend_url, pool_size=args.users, room_access_ttl=0),
+        "pooled+cache": BackendClient(backend_url, pool_size=args.users),
+    }
+    rows = [
+        [name, *run(ui, backend, args.users, args.loads)]
+        for name, backend in clients.items()
+    ]
+    server.shutdown()
+    print(
+        f"{args.users} users loading the chat room page {args.loads} times each "
+        f"(backend answers in {args.backend_ms:g}ms):"
+    )
+    print_table(
+        [
+            "backend calls",
+            "p50 ms",
+            "p99 ms",
+            "pages/s",
+            "backend requests",
+            "backend connections",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
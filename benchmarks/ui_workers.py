@@ -0,0 +1,144 @@
+"""
+Throughput of the UI service under gunicorn with sync and with gevent workers, when
+its page loads wait on a slow backend.
+
+Each worker class gets its own gunicorn with the same number of workers, as in the
+UI's Docker image, in front of a stub backend that answers after --backend-ms.
+Concurrent clients (``pip install aiohttp``) then submit the username form, which
+costs one backend call per page load.
+
+    python benchmarks/ui_workers.py --workers 4 --concurrency 200 --backend-ms 50
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import subprocess
+import time
+import uuid
+from http.server import ThreadingHTTPServer
+
+import aiohttp
+from common import print_table
+from load_test import _free_port, _wait_for_port
+from ui_page_load import UI_DIR, StubBackend
+
+
+def serve_backend(port, delay):
+    StubBackend.delay = delay
+    ThreadingHTTPServer.request_queue_size = 1024
+    ThreadingHTTPServer(("127.0.0.1", port), StubBackend).serve_forever()
+
+
+def start_ui(worker_class, workers, backend_url, pool_size):
+    port = _free_port()
+    env = {
+        **os.environ,
+        "FLASK_ENV": "production",
+        "FLASK_DEBUG": "false",
+        "FLASK_SECRET_KEY": uuid.uuid4().hex,
+        "BACKEND_URL": backend_url,
+        "BACKEND_POOL_SIZE": str(pool_size),
+        "CONTAINER_PORT": str(port),
+    }
+    process = subprocess.Popen(
+        [
+            "gunicorn",
+            "-w", str(workers),
+            "-k", worker_class,
+            "--worker-connections", "1000",
+            "-b", f"127.0.0.1:{port}",
+            "app:app",
+        ],
+        cwd=UI_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    _wait_for_port(port)
+    return process, f"http://127.0.0.1:{port}"
+
+
+async def load(url, requests, concurrency, timeout):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def client(session):
+        nonlocal errors
+        for i in remaining:
+            start = time.perf_counter()
+            try:
+                async with session.post(
+                    f"{url}/check_username",
+                    data={"username": f"user-{i}"},
+                    allow_redirects=False,
+                ) as response:
+                    await response.read()
+                    if response.status != 302:
+                        raise RuntimeError(f"Unexpected status {response.status}")
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                errors += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=client_timeout, cookie_jar=aiohttp.DummyCookieJar()
+    ) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return sorted(latencies), errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--backend-ms", type=float, default=50.0)
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    # the backend runs in its own process, so that it does not compete with the
+    # clients for the GIL
+    backend_port = _free_port()
+    backend = multiprocessing.Process(
+        target=serve_backend, args=(backend_port, args.backend_ms / 1000), daemon=True
+    )
+    backend.start()
+    _wait_for_port(backend_port)
+    backend_url = f"http://127.0.0.1:{backend_port}"
+
+    rows = []
+    for worker_class in ("sync", "gevent"):
+        process, url = start_ui(
+            worker_class, args.workers, backend_url, args.concurrency
+        )
+        try:
+            latencies, errors, elapsed = asyncio.run(
+                load(url, args.requests, args.concurrency, args.timeout)
+            )
+        finally:
+            process.terminate()
+            process.wait()
+        rows.append([
+            worker_class,
+            f"{len(latencies) / elapsed:,.0f}",
+            f"{statistics.median(latencies) * 1000:,.0f}" if latencies else "-",
+            f"{latencies[int(len(latencies) * 0.99)] * 1000:,.0f}"
+            if latencies else "-",
+            errors,
+        ])
+    backend.terminate()
+    print(
+        f"{args.requests} page loads from {args.concurrency} concurrent clients, "
+        f"{args.workers} workers, backend answers in {args.backend_ms:g}ms:"
+    )
+    print_table(["worker class", "pages/s", "p50 ms", "p99 ms", "errors"], rows)
+
+
+if __name__ == "__main__":
+    main()
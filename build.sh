@@ -346,10 +346,25 @@ install_app() {
         --set "backendMinReplicas=$BACKEND_MIN_REPLICAS" \
         --set "backendMaxReplicas=$BACKEND_MAX_REPLICAS" \
         --set "backendTargetCpuUtilization=$BACKEND_TARGET_CPU_UTILIZATION_PCT" \
+        --set "backendTargetSocketsPerPod=$BACKEND_TARGET_SOCKETS_PER_POD" \
         --set "backendMemoryRequest=$BACKEND_MEMORY_REQUEST" \
         --set "backendMemoryLimit=$BACKEND_MEMORY_LIMIT" \
         --set "backendCpuRequest=$BACKEND_CPU_REQUEST" \
         --set "backendCpuLimit=$BACKEND_CPU_LIMIT" \
+        --set "backendWorkers=$BACKEND_WORKERS" \
+        --set "backendLobbyProtocol=$BACKEND_LOBBY_PROTOCOL" \
+        --set "backendLobbyBroadcastWindowMs=$BACKEND_LOBBY_BROADCAST_WINDOW_MS" \
+        --set "backendMessageRouting=$BACKEND_MESSAGE_ROUTING" \
+        --set "backendMessageRelay=$BACKEND_MESSAGE_RELAY" \
+        --set "backendMessageEncryption=$BACKEND_MESSAGE_ENCRYPTION" \
+        --set "backendMessageSerializer=$BACKEND_MESSAGE_SERIALIZER" \
+        --set "backendStatePartitioner=$BACKEND_STATE_PARTITIONER" \
+        --set "backendStateCodec=$BACKEND_STATE_CODEC" \
+        --set "backendMigrateLegacyState=$BACKEND_MIGRATE_LEGACY_STATE" \
+        --set "backendLogFormat=$BACKEND_LOG_FORMAT" \
+        --set "backendLogLevels=${BACKEND_LOG_LEVELS//,/\\,}" \
+        --set "backendLogSampling=${BACKEND_LOG_SAMPLING//,/\\,}" \
+        --set "backendDrainSpreadSeconds=$BACKEND_DRAIN_SPREAD_SECONDS" \
         --set "uiServicePort=$UI_MODULE_PORT" \
         --set "uiMinReplicas=$UI_MIN_REPLICAS" \
         --set "uiMaxReplicas=$UI_MAX_REPLICAS" \
@@ -358,6 +373,10 @@ install_app() {
         --set "uiMemoryLimit=$UI_MEMORY_LIMIT" \
         --set "uiCpuRequest=$UI_CPU_REQUEST" \
         --set "uiCpuLimit=$UI_CPU_LIMIT" \
+        --set "uiWorkerClass=$UI_WORKER_CLASS" \
+        --set "uiWorkers=$UI_WORKERS" \
+        --set "uiWorkerConnections=$UI_WORKER_CONNECTIONS" \
+        --set "uiBackendPoolSize=$UI_BACKEND_POOL_SIZE" \
         --set "numRedisReplicasTotal=$NUM_REDIS_REPLICAS_TOTAL" \
         --set "redisPort=$REDIS_PORT" \
         --set "redisPassword=$REDIS_PASSWORD" \
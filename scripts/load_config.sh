@@ -21,11 +21,26 @@ EKS_MAX_NODES=$(yq ".eks.max_nodes" config.yaml)
 BACKEND_MIN_REPLICAS=$(yq ".backend_module.min_replicas" config.yaml)
 BACKEND_MAX_REPLICAS=$(yq ".backend_module.max_replicas" config.yaml)
 BACKEND_TARGET_CPU_UTILIZATION_PCT=$(yq ".backend_module.target_cpu_utilization_pct" config.yaml)
+BACKEND_TARGET_SOCKETS_PER_POD=$(yq ".backend_module.target_sockets_per_pod" config.yaml)
 BACKEND_MEMORY_REQUEST=$(yq ".backend_module.memory_request" config.yaml)
 BACKEND_MEMORY_LIMIT=$(yq ".backend_module.memory_limit" config.yaml)
 BACKEND_CPU_REQUEST=$(yq ".backend_module.cpu_request" config.yaml)
 BACKEND_CPU_LIMIT=$(yq ".backend_module.cpu_limit" config.yaml)
 BACKEND_MODULE_PORT=$(yq ".backend_module.module_port" config.yaml)
+BACKEND_WORKERS=$(yq ".backend_module.workers" config.yaml)
+BACKEND_LOBBY_PROTOCOL=$(yq ".backend_module.lobby_protocol" config.yaml)
+BACKEND_LOBBY_BROADCAST_WINDOW_MS=$(yq ".backend_module.lobby_broadcast_window_ms" config.yaml)
+BACKEND_MESSAGE_ROUTING=$(yq ".backend_module.message_routing" config.yaml)
+BACKEND_MESSAGE_RELAY=$(yq ".backend_module.message_relay" config.yaml)
+BACKEND_MESSAGE_ENCRYPTION=$(yq ".backend_module.message_encryption" config.yaml)
+BACKEND_MESSAGE_SERIALIZER=$(yq ".backend_module.message_serializer" config.yaml)
+BACKEND_STATE_PARTITIONER=$(yq ".backend_module.state_partitioner" config.yaml)
+BACKEND_STATE_CODEC=$(yq ".backend_module.state_codec" config.yaml)
+BACKEND_MIGRATE_LEGACY_STATE=$(yq ".backend_module.migrate_legacy_state" config.yaml)
+BACKEND_LOG_FORMAT=$(yq ".backend_module.log_format" config.yaml)
+BACKEND_LOG_LEVELS=$(yq ".backend_module.log_levels" config.yaml)
+BACKEND_LOG_SAMPLING=$(yq ".backend_module.log_sampling" config.yaml)
+BACKEND_DRAIN_SPREAD_SECONDS=$(yq ".backend_module.drain_spread_seconds" config.yaml)
 
 # load UI module settings
 UI_MIN_REPLICAS=$(yq ".ui_module.min_replicas" config.yaml)
@@ -36,6 +51,10 @@ UI_MEMORY_LIMIT=$(yq ".ui_module.memory_limit" config.yaml)
 UI_CPU_REQUEST=$(yq ".ui_module.cpu_request" config.yaml)
 UI_CPU_LIMIT=$(yq ".ui_module.cpu_limit" config.yaml)
 UI_MODULE_PORT=$(yq ".ui_module.module_port" config.yaml)
+UI_WORKER_CLASS=$(yq ".ui_module.worker_class" config.yaml)
+UI_WORKERS=$(yq ".ui_module.workers" config.yaml)
+UI_WORKER_CONNECTIONS=$(yq ".ui_module.worker_connections" config.yaml)
+UI_BACKEND_POOL_SIZE=$(yq ".ui_module.backend_pool_size" config.yaml)
 
 # load Redis settings
 REDIS_VERSION=$(yq ".redis.version" config.yaml)
@@ -26,11 +26,26 @@ check_configuration_variables() {
         "BACKEND_MIN_REPLICAS"
         "BACKEND_MAX_REPLICAS"
         "BACKEND_TARGET_CPU_UTILIZATION_PCT"
+        "BACKEND_TARGET_SOCKETS_PER_POD"
         "BACKEND_MEMORY_REQUEST"
         "BACKEND_MEMORY_LIMIT"
         "BACKEND_CPU_REQUEST"
         "BACKEND_CPU_LIMIT"
         "BACKEND_MODULE_PORT"
+        "BACKEND_WORKERS"
+        "BACKEND_LOBBY_PROTOCOL"
+        "BACKEND_LOBBY_BROADCAST_WINDOW_MS"
+        "BACKEND_MESSAGE_ROUTING"
+        "BACKEND_MESSAGE_RELAY"
+        "BACKEND_MESSAGE_ENCRYPTION"
+        "BACKEND_MESSAGE_SERIALIZER"
+        "BACKEND_STATE_PARTITIONER"
+        "BACKEND_STATE_CODEC"
+        "BACKEND_MIGRATE_LEGACY_STATE"
+        "BACKEND_LOG_FORMAT"
+        "BACKEND_LOG_LEVELS"
+        "BACKEND_LOG_SAMPLING"
+        "BACKEND_DRAIN_SPREAD_SECONDS"
         "UI_MIN_REPLICAS"
         "UI_MAX_REPLICAS"
         "UI_TARGET_CPU_UTILIZATION_PCT"
@@ -39,6 +54,10 @@ check_configuration_variables() {
         "UI_CPU_REQUEST"
         "UI_CPU_LIMIT"
         "UI_MODULE_PORT"
+        "UI_WORKER_CLASS"
+        "UI_WORKERS"
+        "UI_WORKER_CONNECTIONS"
+        "UI_BACKEND_POOL_SIZE"
         "REDIS_VERSION"
         "NUM_REDIS_MASTER_REPLICAS"
         "NUM_REDIS_SLAVES_PER_MASTER"
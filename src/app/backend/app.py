@@ -4,25 +4,123 @@ from gevent import monkey
 # https://flask-socketio.readthedocs.io/en/latest/deployment.html#using-multiple-workers
 monkey.patch_all()
 
+import functools
 import logging
 import os
-import sys
 
-from flask import jsonify, request
+from flask import Response, jsonify, request
 from flask_socketio import emit, join_room, leave_room
 
 import initialization
+from encoding import valid_username
+from envelopes import validate_envelope
+from lobby_broadcaster import FULL_LOBBY_ROOM, PAGED_LOBBY_ROOM
+from logs import logged
+from metrics import EventMetrics
+from redis_client import RedisPoolMetrics
+from sessions import SessionRegistry
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s][%(name)s][%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+log_handler, log_filter = initialization.init_logging()
 logger = logging.getLogger(__name__)
 
 app = initialization.init_app()
 socketio = initialization.init_socket(app)
-manager = initialization.init_chat_manager()
+redis_metrics = RedisPoolMetrics()
+manager = initialization.init_chat_manager(socketio.server.manager, redis_metrics)
+room_authz = initialization.init_room_authz_cache(manager, socketio.server.manager)
+room_history = initialization.init_room_history(manager)
+sessions = SessionRegistry()
+event_metrics = EventMetrics()
+rate_limiter = initialization.init_rate_limiter(manager)
+backpressure = initialization.init_backpressure(socketio)
+lobby_broadcaster = initialization.init_lobby_broadcaster(socketio, manager)
+# _user_removed is defined with the handlers below
+presence = initialization.init_presence(
+    socketio, manager, sessions, lambda *args: _user_removed(*args)
+)
+request_expiry = initialization.init_request_expiry(socketio, manager)
+roster_reconciler = initialization.init_roster_reconciler(socketio, manager)
+drain = initialization.init_drain(socketio, sessions, lobby_broadcaster, presence)
+metrics_registry = initialization.init_metrics_registry(
+    event_metrics,
+    sessions,
+    redis_metrics,
+    socketio.server.manager,
+    rate_limiter,
+    backpressure,
+    lobby_broadcaster,
+    presence,
+    request_expiry,
+    log_handler,
+    log_filter,
+    drain,
+    room_authz,
+    roster_reconciler,
+)
+pod_metrics = initialization.init_worker_metrics(socketio, metrics_registry)
+
+# "delta" pushes user_joined/user_left events with a roster sequence number and lets
+# clients fetch the lobby again when they detect a gap, "full" broadcasts the whole
+# user list on every lobby change
+LOBBY_PROTOCOL = os.environ.get("LOBBY_PROTOCOL", "delta")
+DISCONNECT_GRACE_SECONDS = float(os.environ.get("DISCONNECT_GRACE_SECONDS", 10))
+# "stream" also appends every chat message to the room's history in Redis, from which
+# clients fetch the messages they missed while reconnecting, "direct" only relays them
+MESSAGE_RELAY = os.environ.get("MESSAGE_RELAY", "direct")
+# "rsa" has clients wrap a new AES key for every message, "session" has them agree on
+# a room key with ECDH and rotate it every MESSAGE_REKEY_INTERVAL messages
+MESSAGE_ENCRYPTION = os.environ.get("MESSAGE_ENCRYPTION", "rsa")
+MESSAGE_REKEY_INTERVAL = int(os.environ.get("MESSAGE_REKEY_INTERVAL", 100))
+# most users a client can fetch in one page of the lobby
+LOBBY_PAGE_MAX = int(os.environ.get("LOBBY_PAGE_MAX", 100))
+
+
+def _emit_user_list_snapshot():
+    version, users = manager.roster.snapshot()
+    emit("user_list_snapshot", {"seq": version, "users": users})
+
+
+def _lobby_page_query(data):
+    """
+    Parse the prefix, cursor, offset and limit of a lobby page query, raising
+    ValueError if they are not valid.
+    """
+    prefix = data.get("prefix") or ""
+    after = data.get("after")
+    if not isinstance(prefix, str) or not (after is None or isinstance(after, str)):
+        raise ValueError("prefix and after must be strings")
+    offset = int(data.get("offset") or 0)
+    limit = int(data.get("limit") or LOBBY_PAGE_MAX)
+    if offset < 0 or limit < 1:
+        raise ValueError("offset must not be negative and limit must be positive")
+    return prefix, after, offset, min(limit, LOBBY_PAGE_MAX)
+
+
+def _on(event):
+    """
+    Register a Socket.IO event handler whose calls are rate limited, counted, timed
+    and logged under the event.
+    """
+    def decorator(handler):
+        handler = logged(logger, log_filter, event, _rate_limited(event, handler))
+        return socketio.on(event)(event_metrics.timed(event, handler))
+    return decorator
+
+
+def _rate_limited(event, handler):
+    if not rate_limiter.limits_event(event):
+        return handler
+
+    @functools.wraps(handler)
+    def wrapper(*args):
+        session = sessions.get(request.sid)
+        username = session.username if session else None
+        if not rate_limiter.allow(request.sid, username, event):
+            logger.warning("Rate limited '%s' from socket '%s'", event, request.sid)
+            emit("rate_limited", {"event": event})
+            return
+        return handler(*args)
+    return wrapper
 
 
 @app.route("/api/")
@@ -34,12 +132,14 @@ def index():
 def check_username():
     data = request.get_json()
     username = data.get("username")
-    logger.info(f"Checking availability for username: {username}")
+    logger.info("Checking availability for username: %s", username)
+    if not valid_username(username):
+        return jsonify({"error": "Invalid username"}), 400
     user = manager.get_user(username)
     if user:
-        logger.info(f"Username '{username}' is already taken")
+        logger.info("Username '%s' is already taken", username)
         return jsonify({"available": False}), 200
-    logger.info(f"Username '{username}' is available")
+    logger.info("Username '%s' is available", username)
     return jsonify({"available": True}), 200
 
 @app.route("/api/verify_room_access", methods=["POST"])
@@ -47,51 +147,189 @@ def verify_room_access():
     data = request.get_json()
     room_id = data.get("room_id")
     username = data.get("username")
-    logger.info(f"Verifying room access for username: {username} in room: {room_id}")
+    logger.info("Verifying room access for username: %s in room: %s", username, room_id)
     if manager.user_authorized_in_room(username, room_id):
-        logger.info(f"Access granted for user '{username}' to room '{room_id}'")
+        logger.info("Access granted for user '%s' to room '%s'", username, room_id)
         return jsonify({"authorized": True}), 200
     else:
-        logger.warning(f"Access denied for user '{username}' to room '{room_id}'")
+        logger.warning("Access denied for user '%s' to room '%s'", username, room_id)
         return jsonify({"authorized": False}), 200    
 
-@socketio.on("join_lobby")
-def handle_join_lobby(data):
-    username = data.get("username")
-    if not username:
-        logger.warning("Attempt to join lobby without a username")
-        return False  # reject the connection
+@app.route("/api/validate", methods=["POST"])
+def validate():
+    """
+    Run several of the checks above in one call, for pages that need more than one.
+    """
+    data = request.get_json(silent=True) or {}
+    checks = data.get("checks") if isinstance(data, dict) else None
+    if not isinstance(checks, list) or not all(isinstance(c, dict) for c in checks):
+        return jsonify({"error": "Expected a JSON object with a list of checks"}), 400
+    results = []
+    for check in checks:
+        name = check.get("check")
+        username = check.get("username")
+        if not valid_username(username):
+            return jsonify({"error": "Invalid username"}), 400
+        if name == "username_available":
+            results.append(manager.get_user(username) is None)
+        elif name == "room_access":
+            room_id = check.get("room_id")
+            results.append(manager.user_authorized_in_room(username, room_id))
+        else:
+            logger.warning("Unknown validation check '%s'", name)
+            return jsonify({"error": f"Unknown check '{name}'"}), 400
+    return jsonify({"results": results}), 200
+
+@app.route("/api/lobby/users")
+def lobby_users():
+    try:
+        query = _lobby_page_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(manager.page_users_in_lobby(*query)), 200
+
+@app.route("/api/lobby/count")
+def lobby_count():
+    version, total = manager.count_users_in_lobby(request.args.get("prefix", ""))
+    return jsonify({"seq": version, "total": total}), 200
+
+@app.route("/api/redis_pool_stats")
+def redis_pool_stats():
+    return jsonify(redis_metrics.stats()), 200
+
+@app.route("/api/metrics")
+def metrics():
+    return Response(pod_metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@_on("connect")
+def handle_connect(auth=None):
+    if drain.draining:
+        # the client tries again and reaches another pod
+        return False
+    username = request.args.get("username")
+    if not valid_username(username):
+        logger.warning("Rejected connection with username %r", username)
+        return False
+    sessions.open(request.sid, username)
+    manager.add_socket(username)
+    logger.info("User '%s' connected", username)
+
+@_on("disconnect")
+def handle_disconnect():
+    room_authz.forget(request.sid)
+    rate_limiter.forget(request.sid)
+    session = sessions.close(request.sid)
+    if not session:
+        return
+    logger.info("User '%s' disconnected", session.username)
+    if manager.remove_socket(session.username) == 0:
+        # moving between the lobby and a chat room page reconnects the user, so only
+        # release them if they have not come back within the grace period
+        socketio.start_background_task(
+            _release_user_after_grace, session.username, session.room_id
+        )
+
+def _release_user_after_grace(username, room_id):
+    socketio.sleep(DISCONNECT_GRACE_SECONDS)
+    if manager.count_sockets(username) or not manager.get_user(username):
+        return
+    logger.info("User '%s' did not reconnect", username)
+    _remove_user(username, room_id)
+
+def _remove_user(username, room_id=None):
+    logger.info("User '%s' is leaving the server", username)
+    manager.remove_user(username)
+    _user_removed(username, room_id)
+
+def _user_removed(username, room_id=None):
+    room_authz.invalidate(username)
+    if room_id:
+        socketio.emit(
+            "receive_message",
+            {"message": "has left the chat", "username": username, "type": "system"},
+            room=room_id
+        )
+
+def _with_session(handler):
+    """
+    Pass the session of the socket that emitted the event to the handler.
+    """
+    @functools.wraps(handler)
+    def wrapper(*args):
+        session = sessions.get(request.sid)
+        if session is None:
+            logger.warning("Ignoring event from unknown socket '%s'", request.sid)
+            return
+        return handler(session, *args)
+    return wrapper
+
+@_on("join_lobby")
+@_with_session
+def handle_join_lobby(session, data=None):
+    username = session.username
     user = manager.get_user(username)
     if not user:
-        logger.info(f"Adding new user '{username}' to the server")
+        logger.info("Adding new user '%s' to the server", username)
         manager.add_user(username)
     join_room(username)
-    logger.info(f"User '{username}' joined the lobby")
-    emit("update_user_list", manager.list_users_in_lobby(), broadcast=True)
+    session.in_lobby = True
+    logger.info("User '%s' joined the lobby", username)
+    if isinstance(data, dict) and data.get("paged"):
+        # the client fetches the part of the lobby it shows with fetch_lobby_page
+        join_room(PAGED_LOBBY_ROOM)
+        return
+    join_room(FULL_LOBBY_ROOM)
+    if LOBBY_PROTOCOL == "delta":
+        _emit_user_list_snapshot()
+    else:
+        emit("update_user_list", manager.list_users_in_lobby())
 
-@socketio.on("chat_request")
-def handle_chat_request(data):
-    from_username = data.get("from_user")
-    to_username = data.get("to_user")
+@_on("sync_user_list")
+@_with_session
+def handle_sync_user_list(session):
+    # sockets that keep the whole lobby ask for it again when they notice a gap in
+    # the deltas, e.g. after being skipped as slow consumers
+    logger.info("User '%s' requested a lobby snapshot", session.username)
+    _emit_user_list_snapshot()
 
-    logger.info(f"User '{from_username}' requested chat with '{to_username}'")
+@_on("fetch_lobby_page")
+@_with_session
+def handle_fetch_lobby_page(session, data=None):
+    try:
+        if not isinstance(data, (dict, type(None))):
+            raise ValueError("query must be an object")
+        query = _lobby_page_query(data or {})
+    except (TypeError, ValueError) as e:
+        logger.warning("Rejected lobby page query by '%s': %s", session.username, e)
+        emit("error", {"message": "Invalid lobby page query"})
+        return
+    page = manager.page_users_in_lobby(*query)
+    emit("lobby_page", {**page, "prefix": query[0]})
 
-    from_user = manager.get_user(from_username)
-    to_user = manager.get_user(to_username)
+@_on("chat_request")
+@_with_session
+def handle_chat_request(session, data):
+    from_username = session.username
+    to_username = data.get("to_user")
+
+    logger.info("User '%s' requested chat with '%s'", from_username, to_username)
 
-    if not from_user:
-        logger.error(f"Could not find from_user '{from_username}'")
+    if not session.in_lobby:
+        logger.error("User '%s' requested a chat outside the lobby", from_username)
         return
 
+    to_user = manager.get_user(to_username)
     if not to_user:
-        logger.error(f"Could not find to_user '{to_username}'")
+        logger.error("Could not find to_user '%s'", to_username)
         return
 
     # prevent multiple pending requests from the same user
     if manager.get_pending_request(from_username):
         logger.warning(
-            f"User '{from_username}' attempted to request '{to_username}' to chat "
-            "while having a pending chat request"
+            "User '%s' attempted to request '%s' to chat while having a pending chat "
+            "request",
+            from_username,
+            to_username,
         )
         emit(
             "chat_response",
@@ -101,167 +339,221 @@ def handle_chat_request(data):
         return
 
     if not to_user["in_room"]:
-        logger.info(f"User '{to_username}' is not in a room, pending request added")
+        logger.info("User '%s' is not in a room, pending request added", to_username)
         manager.add_pending_request(from_username, to_username)
         emit("chat_request", {"from_user": from_username}, room=to_username)
     else:
-        logger.info(f"User '{to_username}' is already in a room, request denied")
+        logger.info("User '%s' is already in a room, request denied", to_username)
         emit(
             "chat_response",
             {"accepted": False, "message": "User not available"},
             room=from_username
         )
 
-@socketio.on("chat_response")
-def handle_chat_response(data):
-    from_username = data.get("to_user")
+@_on("chat_response")
+@_with_session
+def handle_chat_response(session, data):
+    from_username = session.username
     to_username = data.get("from_user")  # the user who sent the request
     accepted = data.get("accepted")
 
-    if not from_username or not to_username:
+    if not to_username:
         logger.error("Missing username in chat response")
         return
 
     logger.info(
-        f"Chat response from '{from_username}' to '{to_username}': "
-        f"{'accepted' if accepted else 'declined'}"
+        "Chat response from '%s' to '%s': %s",
+        from_username,
+        to_username,
+        "accepted" if accepted else "declined",
     )
 
-    from_user = manager.get_user(from_username)
-    to_user = manager.get_user(to_username)
-
-    if to_user and from_user:
+    if accepted:
+        chatroom = manager.accept_chat_request(to_username, from_username)
+        if chatroom:
+            logger.info(
+                "Chatroom '%s' created between '%s' and '%s'",
+                chatroom["id"],
+                from_username,
+                to_username,
+            )
+            emit(
+                "chat_response",
+                {
+                    "accepted": True,
+                    "room_id": chatroom["id"],
+                    "other_user": from_username
+                },
+                room=to_username
+            )
+            emit(
+                "chat_response",
+                {
+                    "accepted": True,
+                    "room_id": chatroom["id"],
+                    "other_user": to_username
+                },
+                room=from_username
+            )
+            return
+        # the request may have been consumed, so release the requester as well
+        emit(
+            "chat_response",
+            {"accepted": False, "message": "User not available"},
+            room=to_username
+        )
+    else:
         pending_request = manager.get_pending_request(to_username)
         if pending_request and pending_request["to_username"] == from_username:
-            manager.remove_pending_request(to_username)
-            if accepted:
-                chatroom = manager.create_chatroom(to_user, from_user)
-                logger.info(
-                    f"Chatroom '{chatroom['id']}' created between '{from_username}' "
-                    f"and '{to_username}'"
-                )
-                emit(
-                    "chat_response",
-                    {
-                        "accepted": True,
-                        "room_id": chatroom["id"],
-                        "other_user": from_username
-                    },
-                    room=to_username
-                )
-                emit(
-                    "chat_response",
-                    {
-                        "accepted": True,
-                        "room_id": chatroom["id"],
-                        "other_user": to_username
-                    },
-                    room=from_username
-                )
-            else:
-                logger.info(
-                    f"Chat request from '{to_username}' was declined by "
-                    f"'{from_username}'"
-                )
-                emit(
-                    "chat_response",
-                    {"accepted": False, "message": "Chat request declined"},
-                    room=to_username
-                )
-        else:
-            logger.error(f"No pending chat request found for '{from_username}'")
+            manager.remove_pending_request(to_username, from_username)
+            logger.info(
+                "Chat request from '%s' was declined by '%s'",
+                to_username,
+                from_username,
+            )
             emit(
                 "chat_response",
-                {"accepted": False, "message": "No pending chat request found"},
-                room=from_username
+                {"accepted": False, "message": "Chat request declined"},
+                room=to_username
             )
+            return
 
-@socketio.on("join_room")
-def handle_join_room(data):
-    username = data.get("username")
+    logger.error("No pending chat request found for '%s'", from_username)
+    emit(
+        "chat_response",
+        {"accepted": False, "message": "No pending chat request found"},
+        room=from_username
+    )
+
+def _emit_to_room(event, data, room_id):
+    """
+    Emit to the other sockets in a chat room. When all of the room's members are in it
+    on this pod and no other pod has sockets in it, the message is delivered in-process
+    without a round trip through the message queue.
+    """
+    local_only = (
+        sessions.all_members_local(room_id)
+        and not socketio.server.manager.has_remote_members(room_id)
+    )
+    emit(event, data, room=room_id, include_self=False, ignore_queue=local_only)
+
+@_on("join_room")
+@_with_session
+def handle_join_room(session, data):
+    username = session.username
     room_id = data.get("room_id")
-    logger.info(f"User '{username}' attempting to join room '{room_id}'")
-    if manager.user_authorized_in_room(username, room_id):
-        logger.info(f"User '{username}' successfully joined room '{room_id}'")
+    logger.info("User '%s' attempting to join room '%s'", username, room_id)
+    # the user's copy of the room only exists while they are in it
+    chatroom = manager.get_chatroom(room_id, username) if room_id else None
+    if chatroom:
+        logger.info("User '%s' successfully joined room '%s'", username, room_id)
         join_room(room_id)
-        emit("join_room_success", {"message": "Joined room successfully"})
-        emit("update_user_list", manager.list_users_in_lobby(), broadcast=True)
+        sessions.enter_room(session, room_id, chatroom["users"])
+        room_authz.grant(request.sid, username, room_id)
+        emit(
+            "join_room_success",
+            {
+                "message": "Joined room successfully",
+                "history": MESSAGE_RELAY == "stream",
+                "encryption": MESSAGE_ENCRYPTION,
+                "rekey_interval": MESSAGE_REKEY_INTERVAL,
+            },
+        )
     else:
         logger.warning(
-            f"Unauthorized attempt by user '{username}' to join room '{room_id}'"
+            "Unauthorized attempt by user '%s' to join room '%s'", username, room_id
         )
         emit("join_room_failure", {"message": "Unauthorized access"})
 
-@socketio.on("leave_room")
-def handle_leave_room(data):
-    username = data.get("username")
-    room_id = data.get("room_id")
-    if manager.user_authorized_in_room(username, room_id):
-        logger.info(f"User '{username}' left room '{room_id}'")
-        emit(
+@_on("leave_room")
+@_with_session
+def handle_leave_room(session, data=None):
+    username = session.username
+    room_id = session.room_id
+    if room_id and manager.leave_chatroom(username, room_id):
+        logger.info("User '%s' left room '%s'", username, room_id)
+        room_authz.invalidate(username, room_id)
+        _emit_to_room(
             "receive_message",
             {"message": "has left the chat", "username": username, "type": "system"},
-            room=room_id,
-            include_self=False
+            room_id,
         )
         leave_room(room_id)
-        manager.leave_chatroom(username, room_id)
-        emit("update_user_list", manager.list_users_in_lobby(), broadcast=True)
+        sessions.leave_room(session)
+        if MESSAGE_RELAY == "stream":
+            # the room is over for both users once either of them leaves it
+            room_history.delete(room_id)
 
-@socketio.on("send_message")
-def handle_send_message(data):
-    room_id = data.get("room_id")
-    aes_key = data.get("aes_key")
-    iv = data.get("iv")
-    message = data.get("message")
-    username = data.get("username")
-    if manager.user_authorized_in_room(username, room_id):
-        logger.info(f"User '{username}' sent a message to room '{room_id}'")
-        emit(
-            "receive_message",
-            {
-                "aes_key": aes_key,
-                "iv": iv,
-                "message": message,
-                "username": username,
-                "type": "user",
-            },
-            room=room_id,
-            include_self=False
-        )
+@_on("send_message")
+@_with_session
+def handle_send_message(session, data):
+    username = session.username
+    room_id = session.room_id
+    if room_id and room_authz.is_authorized(request.sid, username, room_id):
+        try:
+            envelope = validate_envelope(data, MESSAGE_ENCRYPTION)
+        except ValueError as e:
+            logger.warning("Rejected message by '%s': %s", username, e)
+            emit("error", {"message": "Invalid message"})
+            return
+        logger.info("User '%s' sent a message to room '%s'", username, room_id)
+        message = {**envelope, "username": username, "type": "user"}
+        if MESSAGE_RELAY == "stream":
+            message["id"] = room_history.append(room_id, message)
+        _emit_to_room("receive_message", message, room_id)
     else:
         logger.warning(
-            f"Unauthorized message send attempt by '{username}' to room '{room_id}'"
+            "Unauthorized message send attempt by '%s' to room '%s'", username, room_id
         )
         emit("error", {"message": "Unauthorized"})
 
-@socketio.on("share_public_key")
-def handle_share_public_key(data):
-    room_id = data.get("room_id")
+@_on("fetch_history")
+@_with_session
+def handle_fetch_history(session, data):
+    username = session.username
+    room_id = session.room_id
+    if MESSAGE_RELAY != "stream":
+        emit("error", {"message": "Message history is not enabled"})
+        return
+    if not room_id or not room_authz.is_authorized(request.sid, username, room_id):
+        logger.warning(
+            "Unauthorized history fetch attempt by '%s' to room '%s'", username, room_id
+        )
+        emit("error", {"message": "Unauthorized"})
+        return
+    try:
+        entries, more = room_history.read_after(room_id, data.get("after_id"))
+    except ValueError as e:
+        logger.warning("Rejected history fetch by '%s': %s", username, e)
+        emit("error", {"message": "Invalid message ID"})
+        return
+    messages = [{**message, "id": entry_id} for entry_id, message in entries]
+    emit("message_history", {"messages": messages, "more": more})
+
+@_on("share_public_key")
+@_with_session
+def handle_share_public_key(session, data):
+    room_id = session.room_id
     public_key = data.get("public_key")
-    username = data.get("username")
+    username = session.username
     if not room_id:
-        logger.error("Could not share public key due to missing room id")
+        logger.error("Could not share public key due to not being in a room")
         return
     if not public_key:
         logger.error("Could not share public key due to missing key")
         return
-    logger.info(f"Sharing public key of user '{username}' in room '{room_id}'")
-    emit(
+    logger.info("Sharing public key of user '%s' in room '%s'", username, room_id)
+    _emit_to_room(
         "receive_public_key",
         {"public_key": public_key, "username": username},
-        room=room_id,
-        include_self=False,
+        room_id,
     )
 
-@socketio.on("leave_server")
-def handle_leave_server(data):
-    username = data.get("username")
-    user = manager.get_user(username)
-    if user:
-        logger.info(f"User '{username}' is leaving the server")
-        manager.remove_user(username)
-        emit("update_user_list", manager.list_users_in_lobby(), broadcast=True)
+@_on("leave_server")
+@_with_session
+def handle_leave_server(session, data=None):
+    if manager.get_user(session.username):
+        _remove_user(session.username)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,110 @@
+import logging
+import time
+from collections import OrderedDict
+
+from metrics import LATENCY_BUCKETS, Histogram
+
+logger = logging.getLogger(__name__)
+
+# a hit is a dict lookup and a miss a Redis round trip, so the buckets start well
+# below the ones of the Redis latencies
+LOOKUP_BUCKETS = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025) + (
+    LATENCY_BUCKETS
+)
+
+
+class RoomAuthorizationCache:
+    """
+    Per-pod cache of the room memberships of the sockets connected to this pod, so
+    that relaying a chat message does not need to ask Redis whether the sender is
+    allowed in the room.
+
+    Entries are added when a socket successfully joins a room, and dropped when the
+    user leaves the room or is removed, on whichever pod that happens. Entries also
+    expire after a TTL and the least recently used ones are evicted beyond
+    'max_entries', after which the membership is checked from Redis again.
+    """
+
+    def __init__(self, manager, max_entries=10000, ttl=300):
+        self.manager = manager
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # sid -> (username, room_id, expires_at)
+        self._sids_by_user = {}
+        self._publish = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.hit_latency = Histogram(LOOKUP_BUCKETS)
+        self.miss_latency = Histogram(LOOKUP_BUCKETS)
+
+    def bind(self, client_manager):
+        """
+        Exchange invalidations with the other pods through the client manager.
+        """
+        client_manager.on_internal("authz_invalidate", self._invalidate)
+        self._publish = lambda data: client_manager.publish_internal(
+            "authz_invalidate", data
+        )
+
+    def grant(self, sid, username, room_id):
+        self.forget(sid)
+        self._entries[sid] = (username, room_id, time.monotonic() + self.ttl)
+        self._sids_by_user.setdefault(username, set()).add(sid)
+        while len(self._entries) > self.max_entries:
+            self.forget(next(iter(self._entries)))
+
+    def forget(self, sid):
+        entry = self._entries.pop(sid, None)
+        if entry:
+            sids = self._sids_by_user[entry[0]]
+            sids.discard(sid)
+            if not sids:
+                del self._sids_by_user[entry[0]]
+
+    def is_authorized(self, sid, username, room_id):
+        start = time.perf_counter()
+        entry = self._entries.get(sid)
+        if (
+            entry
+            and entry[0] == username
+            and entry[1] == room_id
+            and entry[2] > time.monotonic()
+        ):
+            self._entries.move_to_end(sid)
+            self.hits += 1
+            self.hit_latency.observe(time.perf_counter() - start)
+            return True
+
+        authorized = self.manager.user_authorized_in_room(username, room_id)
+        if authorized:
+            self.grant(sid, username, room_id)
+        else:
+            self.forget(sid)
+        self.misses += 1
+        self.miss_latency.observe(time.perf_counter() - start)
+        return authorized
+
+    def invalidate(self, username, room_id=None):
+        """
+        Drop the cached memberships of the user, in the given room only or in any
+        room, on this pod and on the others.
+        """
+        data = {"username": username, "room_id": room_id}
+        self._invalidate(data)
+        if self._publish:
+            self._publish(data)
+
+    def _invalidate(self, data):
+        stale = [
+            sid
+            for sid in self._sids_by_user.get(data["username"], ())
+            if data["room_id"] in (None, self._entries[sid][1])
+        ]
+        for sid in stale:
+            self.forget(sid)
+        self.invalidations += len(stale)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,75 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# lobby updates that a client can do without, as it asks for a snapshot of the lobby
+# when it notices missed deltas, and each full user list supersedes the previous one
+COALESCED_EVENTS = frozenset(
+    ["user_joined", "user_left", "user_list_deltas", "update_user_list"]
+)
+
+
+class Backpressure:
+    """
+    Watches the outbound queues of the sockets on this pod, which grow when a client
+    reads slower than the pod sends to it.
+
+    Every 'interval' seconds the queues are checked. Sockets with at least
+    'coalesce_queue_size' packets queued stop receiving lobby updates until they have
+    caught up. They then notice the gap in the deltas and ask for the lobby again,
+    or simply take the next full user list.
+    Sockets with at least 'max_queue_size' packets queued are disconnected.
+    """
+
+    def __init__(
+        self, server, coalesce_queue_size=100, max_queue_size=1000, interval=1.0
+    ):
+        self.server = server
+        self.coalesce_queue_size = coalesce_queue_size
+        self.max_queue_size = max_queue_size
+        self.interval = interval
+        self.backlogged = frozenset()
+        self.coalesced = 0
+        self.dropped = 0
+
+    def start(self):
+        self.server.start_background_task(self._run)
+
+    def skip_sids(self, event):
+        """
+        Sockets that an emit of the event should skip.
+        """
+        if event not in COALESCED_EVENTS or not self.backlogged:
+            return ()
+        self.coalesced += len(self.backlogged)
+        return self.backlogged
+
+    def _run(self):
+        while True:
+            self.server.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Failed to check the outbound queues")
+
+    def check(self):
+        backlogged = set()
+        for sid, eio_sid in self.server.manager.get_participants("/", None):
+            socket = self.server.eio.sockets.get(eio_sid)
+            if socket is None:
+                continue
+            queued = socket.queue.qsize()
+            if queued >= self.max_queue_size:
+                logger.warning("Dropping slow socket '%s' with %s queued", sid, queued)
+                self._drop(socket)
+                self.dropped += 1
+            elif queued >= self.coalesce_queue_size:
+                backlogged.add(sid)
+        self.backlogged = frozenset(backlogged)
+
+    def _drop(self, socket):
+        # discard the backlog first, as closing waits for the queue to be sent
+        while not socket.queue.empty():
+            socket.queue.get_nowait()
+            socket.queue.task_done()
+        socket.close(wait=False, abort=True)
@@ -0,0 +1,91 @@
+import atexit
+import logging
+import os
+import random
+import signal
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Drain:
+    """
+    Moves the sockets of a pod that is shutting down to the other pods a few at a
+    time, so that they do not all reconnect and rejoin the lobby at once.
+
+    On SIGTERM gunicorn stops accepting connections, and this pod rejects any that
+    still reach it. Every connected socket is sent a server_draining event with a
+    reconnect delay picked at random from the next 'spread' seconds, at the end of
+    which the client disconnects and connects to another pod. The records of the
+    users stay in Redis meanwhile, so they come back to the lobby or the room they
+    were in. The worker exits once the sockets are gone, or at gunicorn's graceful
+    timeout, when clients that do not know the event reconnect. On exit it
+    broadcasts the lobby changes it has not broadcast yet and marks the users still
+    connected to it as seen.
+    """
+
+    def __init__(self, server, sessions, lobby_broadcaster, presence, spread=20.0):
+        self.server = server
+        self.sessions = sessions
+        self.lobby_broadcaster = lobby_broadcaster
+        self.presence = presence
+        self.spread = spread
+        self.draining = False
+        self.notified = 0
+        self._previous_handler = None
+
+    def start(self):
+        self._previous_handler = signal.signal(signal.SIGTERM, self._on_sigterm)
+
+    def _on_sigterm(self, signum, frame):
+        if self.draining:
+            return
+        self.server.start_background_task(self.drain)
+        if callable(self._previous_handler):
+            # gunicorn's handler stops the worker from accepting connections, and the
+            # worker exits once the open ones have closed
+            self._previous_handler(signum, frame)
+        else:
+            self.server.start_background_task(self._exit_when_drained)
+
+    def drain(self):
+        self.draining = True
+        atexit.register(self.flush)
+        notified = self.notify()
+        logger.info("Draining %s sockets over %s seconds", notified, self.spread)
+
+    def _exit_when_drained(self):
+        deadline = time.time() + self.spread + 5
+        while len(self.sessions) and time.time() < deadline:
+            self.server.sleep(0.5)
+        self.flush()
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    def notify(self):
+        """
+        Tell every socket on this pod when to reconnect, and return how many there
+        were.
+        """
+        notified = 0
+        for session in self.sessions:
+            self.server.emit(
+                "server_draining",
+                {"reconnect_delay_ms": int(random.uniform(0, self.spread) * 1000)},
+                room=session.sid,
+                ignore_queue=True,
+            )
+            notified += 1
+            if notified % 100 == 0:
+                # let the sockets write what has been queued for them
+                self.server.sleep(0)
+        self.notified += notified
+        return notified
+
+    def flush(self):
+        try:
+            self.lobby_broadcaster.flush()
+            self.presence.heartbeat()
+        except Exception:
+            logger.exception("Failed to flush the state of the drained pod")
+        logger.info("Drained, %s sockets left", len(self.sessions))
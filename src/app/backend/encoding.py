@@ -0,0 +1,215 @@
+import hashlib
+import json
+import pickle
+import re
+import zlib
+from binascii import crc_hqx
+
+# Compact records start with a byte that never starts a JSON document, so records
+# written in either format can be told apart and read during a migration
+_COMPACT_PREFIX = "\x01"
+_FIELD_SEPARATOR = "\x1f"
+# usernames may not contain control characters, which include the separator
+_CONTROL_CHARACTERS = re.compile("[\x00-\x1f\x7f-\x9f]")
+
+# Pickles start with the PROTO opcode, so compact emits are marked by another byte
+_COMPACT_EMIT_PREFIX = b"\x01"
+_EMIT_FIELDS = (
+    "method", "event", "data", "namespace", "room", "skip_sid", "callback", "host_id"
+)
+_EMIT_KEYS = frozenset(_EMIT_FIELDS)
+
+
+# ==================== Partitioners ====================
+
+class Md5Partitioner:
+    """
+    The original partitioner and the default one, since changing the partitioner
+    moves every key.
+    """
+
+    def __init__(self, num_partitions):
+        self.num_partitions = num_partitions
+
+    def __call__(self, key):
+        return int(hashlib.md5(key.encode()).hexdigest(), 16) % self.num_partitions
+
+
+class Crc32Partitioner:
+    def __init__(self, num_partitions):
+        self.num_partitions = num_partitions
+
+    def __call__(self, key):
+        return zlib.crc32(key.encode()) % self.num_partitions
+
+
+class Crc16Partitioner:
+    """
+    The CRC16 that Redis Cluster uses for slot mapping, so that with 16384 partitions
+    a partition corresponds to the slot the key would hash to on its own.
+    """
+
+    def __init__(self, num_partitions):
+        self.num_partitions = num_partitions
+
+    def __call__(self, key):
+        return crc_hqx(key.encode(), 0) % self.num_partitions
+
+
+PARTITIONERS = {
+    "md5": Md5Partitioner,
+    "crc32": Crc32Partitioner,
+    "crc16": Crc16Partitioner,
+}
+
+
+def get_partitioner(name, num_partitions):
+    try:
+        return PARTITIONERS[name](num_partitions)
+    except KeyError:
+        raise ValueError(f"Unknown partitioner '{name}'")
+
+
+# ==================== Codecs ====================
+
+class JsonCodec:
+    """
+    Encodes records as the JSON documents the backend has always stored.
+
+    Every record is stored in a hash field named after the user or room it belongs
+    to, and the decoders are given that name so that compact records need not repeat
+    it. Both codecs decode either format, so records written by pods running the
+    other codec stay readable.
+    """
+
+    def encode_user(self, user):
+        return _to_json(user)
+
+    def encode_room(self, room):
+        return _to_json(room)
+
+    def encode_request(self, request):
+        return _to_json(request)
+
+    def decode_user(self, username, data):
+        if data.startswith(_COMPACT_PREFIX):
+            return {"username": username, "in_room": data[1:] == "1"}
+        return _from_json(data)
+
+    def decode_room(self, room_id, data):
+        if data.startswith(_COMPACT_PREFIX):
+            return {"id": room_id, "users": data[1:].split(_FIELD_SEPARATOR)}
+        return _from_json(data)
+
+    def decode_request(self, from_username, data):
+        if data.startswith(_COMPACT_PREFIX):
+            return {"from_username": from_username, "to_username": data[1:]}
+        return _from_json(data)
+
+
+class CompactCodec(JsonCodec):
+    """
+    Stores only what the hash field name does not already tell: the in-room flag of a
+    user, the members of a room and the recipient of a request.
+    """
+
+    def encode_user(self, user):
+        return _COMPACT_PREFIX + ("1" if user["in_room"] else "0")
+
+    def encode_room(self, room):
+        return _COMPACT_PREFIX + _FIELD_SEPARATOR.join(room["users"])
+
+    def encode_request(self, request):
+        return _COMPACT_PREFIX + request["to_username"]
+
+
+CODECS = {
+    "json": JsonCodec,
+    "compact": CompactCodec,
+}
+_ALL_CODECS = [codec() for codec in CODECS.values()]
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown codec '{name}'")
+
+
+def request_encodings(request):
+    """
+    All encodings a pending request may have been stored with, used to match a
+    stored request regardless of which codec wrote it.
+    """
+    return [codec.encode_request(request) for codec in _ALL_CODECS]
+
+
+def valid_username(username):
+    """
+    Whether the username can be stored: a non-empty string without control
+    characters, so that the members of a compact room record can be told apart.
+    """
+    return (
+        isinstance(username, str)
+        and bool(username)
+        and not _CONTROL_CHARACTERS.search(username)
+    )
+
+
+def _to_json(data):
+    try:
+        return json.dumps(data)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Failed to serialize data: {repr(e)}")
+
+
+def _from_json(data):
+    try:
+        return json.loads(data)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Failed to deserialize data: {repr(e)}")
+
+
+# ==================== Message serializers ====================
+
+class PickleSerializer:
+    """
+    Serializes the messages exchanged between pods as the stock KombuManager does.
+    Both serializers load either format, so pods on different serializers still
+    understand each other.
+    """
+
+    def dumps(self, message):
+        return pickle.dumps(message)
+
+    def loads(self, payload):
+        if payload.startswith(_COMPACT_EMIT_PREFIX):
+            return dict(zip(_EMIT_FIELDS, pickle.loads(payload[1:])))
+        return pickle.loads(payload)
+
+
+class CompactSerializer(PickleSerializer):
+    """
+    Sends emits, most of the traffic between pods, as a tuple of their values, which
+    leaves out the field names that every pickled emit repeats.
+    """
+
+    def dumps(self, message):
+        if message.keys() == _EMIT_KEYS and message["method"] == "emit":
+            values = tuple(message[field] for field in _EMIT_FIELDS)
+            return _COMPACT_EMIT_PREFIX + pickle.dumps(values)
+        return pickle.dumps(message)
+
+
+SERIALIZERS = {
+    "pickle": PickleSerializer,
+    "compact": CompactSerializer,
+}
+
+
+def get_serializer(name):
+    try:
+        return SERIALIZERS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown serializer '{name}'")
@@ -0,0 +1,48 @@
+# Fields of the encrypted messages clients send, per encryption scheme. "rsa" wraps a
+# fresh AES key for every message with the recipient's RSA key, "session" encrypts
+# with a per-room key agreed once with ECDH and rotated every few messages, so the
+# message only names the key epoch instead of carrying a wrapped key.
+ENVELOPE_FIELDS = {
+    "rsa": ("aes_key", "iv", "message"),
+    "session": ("epoch", "iv", "message"),
+}
+
+_AES_GCM_IV_BYTES = 12
+_RSA_WRAPPED_KEY_BYTES = (256, 384, 512)
+
+
+def validate_envelope(data, scheme, max_message_bytes=65536):
+    """
+    Return the envelope fields of a send_message payload, or raise ValueError if the
+    payload does not match the scheme. The contents stay encrypted, so only their
+    shape can be checked.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Message payload is not an object")
+    if scheme == "session":
+        epoch = data.get("epoch")
+        if not isinstance(epoch, int) or isinstance(epoch, bool) or epoch < 0:
+            raise ValueError("Invalid key epoch")
+    else:
+        _check_bytes(data.get("aes_key"), "aes_key", _RSA_WRAPPED_KEY_BYTES)
+    _check_bytes(data.get("iv"), "iv", (_AES_GCM_IV_BYTES,))
+    message = data.get("message")
+    _check_bytes(message, "message")
+    if len(message) > max_message_bytes:
+        raise ValueError(f"Message exceeds {max_message_bytes} bytes")
+    return {field: data[field] for field in ENVELOPE_FIELDS[scheme]}
+
+
+def _check_bytes(value, field, lengths=None):
+    # binary fields arrive as Socket.IO binary attachments, or as lists of byte
+    # values from clients that send JSON only
+    if not isinstance(value, (bytes, list)) or not value:
+        raise ValueError(f"Missing or invalid '{field}'")
+    if isinstance(value, list):
+        try:
+            # every item must be a byte value, so that the length counts bytes
+            bytes(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid byte values in '{field}'")
+    if lengths and len(value) not in lengths:
+        raise ValueError(f"Invalid length of '{field}'")
@@ -1,12 +1,61 @@
+import logging
 import os
+import sys
 
 from flask import Flask
 from flask_socketio import SocketIO
-from socketio import KombuManager
 
+import encoding
+import redis_client
 import state_manager
+from authz_cache import RoomAuthorizationCache
+from backpressure import Backpressure
+from drain import Drain
+from legacy_state import migrate_legacy_state
+from lobby_broadcaster import LobbyBroadcaster
+from logs import (TEXT_FORMAT, BackgroundHandler, EventFilter, JsonFormatter,
+                  parse_event_settings, parse_level)
+from message_history import RoomHistory
+from metrics import MetricsRegistry, WorkerMetrics
+from presence import Presence
+from pubsub import ChatKombuManager, RoutedKombuManager
+from rate_limit import (RedisTokenBucketLimiter, TokenBucketLimiter,
+                        parse_limits)
+from request_expiry import RequestExpiry
+from roster import RosterReconciler
 from state_manager import RedisChatManager
 
+# the hot events log only a sample of their INFO records, warnings and errors are
+# always logged
+DEFAULT_LOG_SAMPLING = (
+    "send_message=0.01,share_public_key=0.1,fetch_history=0.1,fetch_lobby_page=0.1"
+)
+
+
+def init_logging():
+    levels = parse_event_settings(os.environ.get("LOG_LEVELS", ""), parse_level)
+    sampling = parse_event_settings(
+        os.environ.get("LOG_SAMPLING", DEFAULT_LOG_SAMPLING), float
+    )
+    log_filter = EventFilter(levels, sampling)
+    # "background" writes the records from a thread of its own, "stream" writes them
+    # in the greenlet that logs them
+    if os.environ.get("LOG_HANDLER", "background") == "background":
+        handler = BackgroundHandler(
+            sys.stdout, max_queued=int(os.environ.get("LOG_MAX_QUEUED", 10000))
+        )
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+    if os.environ.get("LOG_FORMAT", "json") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    handler.addFilter(log_filter)
+    logging.basicConfig(
+        level=min([log_filter.default_level, *levels.values()]), handlers=[handler]
+    )
+    return handler, log_filter
+
 
 def init_app():
     app = Flask(__name__)
@@ -22,38 +71,78 @@ def _get_rabbit_queue_uri(username, password, host, port, vhost="/"):
 
 
 def _get_client_manager(rabbit_queue_uri):
-    exchange_options = {
-        "type": "fanout",
-        "durable": False
-    }
-    client_manager = KombuManager(
+    serializer = encoding.get_serializer(
+        os.environ.get("MESSAGE_SERIALIZER", "pickle")
+    )
+    # "routed" only delivers messages to the pods with sockets in the target room,
+    # "fanout" delivers every message to every pod; the two use different exchanges,
+    # see "Upgrading" in the README
+    if os.environ.get("MESSAGE_ROUTING", "fanout") == "fanout":
+        return ChatKombuManager(
+            url=rabbit_queue_uri,
+            channel="chatapp-fanout-exchange",
+            exchange_options={"type": "fanout", "durable": False},
+            serializer=serializer,
+        )
+    return RoutedKombuManager(
         url=rabbit_queue_uri,
-        channel="chatapp-fanout-exchange",
-        exchange_options=exchange_options,
+        channel="chatapp-routed-exchange",
+        exchange_options={"type": "direct", "durable": False},
+        serializer=serializer,
     )
-    return client_manager
 
 
-def init_socket(app):
-    alb_dns = os.environ["ALB_DNS"]
-    rabbit_queue_uri = _get_rabbit_queue_uri(
+def _get_message_queue_uri():
+    # a local stack (e.g. the load tests) may point Kombu to another broker, such as
+    # redis://localhost:6379/1, instead of RabbitMQ
+    if os.environ.get("MESSAGE_QUEUE_URL"):
+        return os.environ["MESSAGE_QUEUE_URL"]
+    return _get_rabbit_queue_uri(
         username=os.environ["RABBIT_USERNAME"],
         password=os.environ["RABBIT_PASSWORD"],
         host=os.environ["RABBIT_HOST"],
         port=os.environ["RABBIT_PORT"]
     )
-    client_manager = _get_client_manager(rabbit_queue_uri)
+
+
+def init_socket(app):
+    alb_dns = os.environ["ALB_DNS"]
+    client_manager = _get_client_manager(_get_message_queue_uri())
     socketio = SocketIO(
         app,
         client_manager=client_manager,
         cors_allowed_origins=[f"https://{alb_dns}"],
-        logger=True,
-        engineio_logger=True
+        # clients only use websockets, which keeps each socket on the gunicorn worker
+        # that accepted it; long-polling would need sticky routing between workers
+        transports=["websocket"],
+        # both log every packet at INFO, which is only worth it when debugging
+        logger=os.environ.get("SOCKETIO_LOGGING", "false") == "true",
+        engineio_logger=os.environ.get("SOCKETIO_LOGGING", "false") == "true",
     )
     return socketio
 
 
-def init_chat_manager():
+def _get_redis_client_settings():
+    return redis_client.RedisClientSettings(
+        max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 50)),
+        pool_timeout=float(os.environ.get("REDIS_POOL_TIMEOUT_SECONDS", 5)),
+        socket_timeout=float(os.environ.get("REDIS_SOCKET_TIMEOUT_SECONDS", 5)),
+        socket_connect_timeout=float(
+            os.environ.get("REDIS_CONNECT_TIMEOUT_SECONDS", 2)
+        ),
+        retries=int(os.environ.get("REDIS_RETRIES", 3)),
+        backoff_base=float(os.environ.get("REDIS_BACKOFF_BASE_SECONDS", 0.01)),
+        backoff_cap=float(os.environ.get("REDIS_BACKOFF_CAP_SECONDS", 0.5)),
+    )
+
+
+def _get_redis_client(redis_metrics):
+    settings = _get_redis_client_settings()
+    # a single local redis-server instead of the cluster, for local stacks
+    if os.environ.get("REDIS_URL"):
+        return redis_client.create_standalone_client(
+            os.environ["REDIS_URL"], settings=settings, metrics=redis_metrics
+        )
     startup_nodes = state_manager.get_startup_nodes(
         num_replicas=int(os.environ["NUM_REDIS_REPLICAS_TOTAL"]),
         pod_name_prefix=os.environ["REDIS_POD_NAME_PREFIX"],
@@ -61,8 +150,322 @@ def init_chat_manager():
         namespace=os.environ["REDIS_NAMESPACE"],
         port=os.environ["REDIS_PORT"]
     )
+    return redis_client.create_cluster_client(
+        startup_nodes,
+        password=os.environ["REDIS_PASSWORD"],
+        settings=settings,
+        metrics=redis_metrics,
+    )
+
+
+def init_chat_manager(client_manager, redis_metrics):
+    client = _get_redis_client(redis_metrics)
     manager = RedisChatManager(
-        startup_nodes=startup_nodes,
-        password=os.environ["REDIS_PASSWORD"]
+        client=client,
+        partitioner=os.environ.get("STATE_PARTITIONER", "md5"),
+        codec=os.environ.get("STATE_CODEC", "compact"),
+        request_ttl=float(os.environ.get("PENDING_REQUEST_TTL_SECONDS", 30)),
     )
+    manager.scripts.load()
+    manager.roster.bind(client_manager)
+    # moves the state written by the original backend before this pod serves anyone,
+    # see "Upgrading" in the README
+    if os.environ.get("MIGRATE_LEGACY_STATE", "false") == "true":
+        migrate_legacy_state(manager)
     return manager
+
+
+def init_room_authz_cache(manager, client_manager):
+    cache = RoomAuthorizationCache(
+        manager,
+        max_entries=int(os.environ.get("AUTHZ_CACHE_MAX_ENTRIES", 10000)),
+        ttl=float(os.environ.get("AUTHZ_CACHE_TTL_SECONDS", 300))
+    )
+    cache.bind(client_manager)
+    return cache
+
+
+def init_room_history(manager):
+    return RoomHistory(
+        manager.redis,
+        maxlen=int(os.environ.get("MESSAGE_HISTORY_MAXLEN", 200)),
+        ttl=int(os.environ.get("MESSAGE_HISTORY_TTL_SECONDS", 3600)),
+        batch_size=int(os.environ.get("MESSAGE_HISTORY_BATCH_SIZE", 50)),
+    )
+
+
+DEFAULT_RATE_LIMITS = (
+    "send_message=10/30,share_public_key=2/10,fetch_history=5/20,"
+    "chat_request=1/5,chat_response=2/10,join_lobby=0.5/5,sync_user_list=0.5/5,"
+    "fetch_lobby_page=5/20,"
+    "join_room=0.5/5,leave_room=0.5/5"
+)
+
+
+def init_lobby_broadcaster(socketio, manager):
+    window_ms = float(os.environ.get("LOBBY_BROADCAST_WINDOW_MS", 100))
+    broadcaster = LobbyBroadcaster(
+        socketio.server,
+        manager.roster,
+        manager.redis,
+        protocol=os.environ.get("LOBBY_PROTOCOL", "delta"),
+        window=window_ms / 1000,
+    )
+    manager.roster.add_listener(broadcaster.notify)
+    # broadcasts are built from the roster history, which only starts once the
+    # snapshot has been loaded
+    manager.roster.load_snapshot()
+    return broadcaster
+
+
+def init_rate_limiter(manager):
+    limits = parse_limits(os.environ.get("RATE_LIMITS", DEFAULT_RATE_LIMITS))
+    # "local" limits every socket on its own pod, "redis" every user across all pods
+    if os.environ.get("RATE_LIMIT_STORE", "local") == "redis":
+        return RedisTokenBucketLimiter(manager.redis, limits)
+    return TokenBucketLimiter(limits)
+
+
+def init_backpressure(socketio):
+    backpressure = Backpressure(
+        socketio.server,
+        coalesce_queue_size=int(os.environ.get("SLOW_CONSUMER_COALESCE_QUEUE", 100)),
+        max_queue_size=int(os.environ.get("SLOW_CONSUMER_MAX_QUEUE", 1000)),
+    )
+    socketio.server.manager.backpressure = backpressure
+    backpressure.start()
+    return backpressure
+
+
+def init_presence(socketio, manager, sessions, on_reaped):
+    presence = Presence(
+        socketio.server,
+        manager,
+        sessions,
+        ttl=float(os.environ.get("PRESENCE_TTL_SECONDS", 60)),
+        heartbeat_interval=float(os.environ.get("PRESENCE_HEARTBEAT_SECONDS", 10)),
+        reap_interval=float(os.environ.get("PRESENCE_REAP_INTERVAL_SECONDS", 10)),
+        batch_size=int(os.environ.get("PRESENCE_REAP_BATCH_SIZE", 500)),
+        on_reaped=on_reaped,
+    )
+    presence.start()
+    return presence
+
+
+def init_roster_reconciler(socketio, manager):
+    reconciler = RosterReconciler(
+        socketio.server,
+        manager.roster,
+        interval=float(os.environ.get("LOBBY_ROSTER_RECONCILE_SECONDS", 60)),
+    )
+    reconciler.start()
+    return reconciler
+
+
+def init_request_expiry(socketio, manager):
+    expiry = RequestExpiry(
+        socketio.server,
+        manager,
+        interval=float(os.environ.get("REQUEST_EXPIRY_INTERVAL_SECONDS", 1)),
+        batch_size=int(os.environ.get("REQUEST_EXPIRY_BATCH_SIZE", 500)),
+    )
+    expiry.start()
+    return expiry
+
+
+def init_drain(socketio, sessions, lobby_broadcaster, presence):
+    drain = Drain(
+        socketio.server,
+        sessions,
+        lobby_broadcaster,
+        presence,
+        # the sockets must be gone before gunicorn's graceful timeout, which the chart
+        # sets to the spread plus 10 seconds, 30 by default
+        spread=float(os.environ.get("DRAIN_SPREAD_SECONDS", 20)),
+    )
+    drain.start()
+    return drain
+
+
+def init_metrics_registry(
+    event_metrics,
+    sessions,
+    redis_metrics,
+    client_manager,
+    rate_limiter,
+    backpressure,
+    lobby_broadcaster,
+    presence,
+    request_expiry,
+    log_handler,
+    log_filter,
+    drain,
+    room_authz,
+    roster_reconciler,
+):
+    registry = MetricsRegistry()
+    registry.counter(
+        "chat_socketio_events_total",
+        "Socket.IO events handled by this pod.",
+        lambda: [({"event": e}, n) for e, n in event_metrics.calls.items()],
+    )
+    registry.counter(
+        "chat_socketio_event_errors_total",
+        "Socket.IO event handlers that raised an exception.",
+        lambda: [({"event": e}, n) for e, n in event_metrics.errors.items()],
+    )
+    registry.histogram(
+        "chat_socketio_event_duration_seconds",
+        "Time spent in the Socket.IO event handlers.",
+        lambda: [({"event": e}, h) for e, h in event_metrics.latency.items()],
+    )
+    registry.gauge(
+        "chat_connected_sockets",
+        "Sockets connected to this pod.",
+        lambda: [({}, len(sessions))],
+    )
+    registry.gauge(
+        "chat_active_rooms",
+        "Chat rooms with at least one socket on this pod.",
+        lambda: [({}, sessions.count_rooms())],
+    )
+    registry.counter(
+        "chat_redis_commands_total",
+        "Commands and pipelines sent to Redis nodes.",
+        lambda: [({}, redis_metrics.command_latency.count)],
+    )
+    registry.histogram(
+        "chat_redis_command_duration_seconds",
+        "Time a Redis connection stays checked out for a command or pipeline.",
+        lambda: [({}, redis_metrics.command_latency)],
+    )
+    registry.histogram(
+        "chat_redis_pool_wait_seconds",
+        "Time to obtain a connection from the Redis pools.",
+        lambda: [({}, redis_metrics.pool_wait)],
+    )
+    registry.gauge(
+        "chat_redis_connections_in_use",
+        "Redis connections currently checked out.",
+        lambda: [({}, redis_metrics.in_use)],
+    )
+    registry.counter(
+        "chat_redis_pool_timeouts_total",
+        "Commands that found no free Redis connection in time.",
+        lambda: [({}, redis_metrics.pool_timeouts)],
+    )
+    registry.counter(
+        "chat_room_authz_lookups_total",
+        "Room authorization checks, answered by this pod's cache or by Redis.",
+        lambda: [
+            ({"result": "hit"}, room_authz.hits),
+            ({"result": "miss"}, room_authz.misses),
+        ],
+    )
+    registry.histogram(
+        "chat_room_authz_lookup_duration_seconds",
+        "Time to check a room authorization, from this pod's cache or from Redis.",
+        lambda: [
+            ({"result": "hit"}, room_authz.hit_latency),
+            ({"result": "miss"}, room_authz.miss_latency),
+        ],
+    )
+    registry.counter(
+        "chat_room_authz_invalidations_total",
+        "Cached room authorizations dropped because the user left or was removed.",
+        lambda: [({}, room_authz.invalidations)],
+    )
+    registry.gauge(
+        "chat_room_authz_entries",
+        "Room authorizations cached by this pod.",
+        lambda: [({}, len(room_authz))],
+    )
+    registry.histogram(
+        "chat_kombu_publish_duration_seconds",
+        "Time to publish a message to the message queue.",
+        lambda: [({}, client_manager.publish_latency)],
+    )
+    registry.counter(
+        "chat_local_emits_total",
+        "Emits delivered in-process without going through the message queue.",
+        lambda: [({}, client_manager.local_emits)],
+    )
+    registry.counter(
+        "chat_rate_limited_events_total",
+        "Socket.IO events rejected by the rate limits.",
+        lambda: [({"event": e}, n) for e, n in rate_limiter.limited.items()],
+    )
+    registry.gauge(
+        "chat_slow_consumers",
+        "Sockets whose outbound queue is too long to receive lobby updates.",
+        lambda: [({}, len(backpressure.backlogged))],
+    )
+    registry.counter(
+        "chat_slow_consumer_coalesced_total",
+        "Lobby updates not sent to slow sockets, which resync once caught up.",
+        lambda: [({}, backpressure.coalesced)],
+    )
+    registry.counter(
+        "chat_slow_consumer_dropped_total",
+        "Sockets disconnected for letting their outbound queue grow too long.",
+        lambda: [({}, backpressure.dropped)],
+    )
+    registry.counter(
+        "chat_lobby_broadcasts_total",
+        "Lobby updates broadcast by this pod.",
+        lambda: [({}, lobby_broadcaster.broadcasts)],
+    )
+    registry.counter(
+        "chat_lobby_broadcasts_skipped_total",
+        "Lobby updates of this pod already broadcast by another pod.",
+        lambda: [({}, lobby_broadcaster.skipped)],
+    )
+    registry.counter(
+        "chat_presence_reaped_total",
+        "Users not seen for the presence TTL and their records reaped by this pod.",
+        lambda: [({"kind": k}, n) for k, n in presence.reaped.items()],
+    )
+    registry.counter(
+        "chat_pending_requests_expired_total",
+        "Chat requests expired by this pod for not being answered in time.",
+        lambda: [({}, request_expiry.expired)],
+    )
+    registry.counter(
+        "chat_log_records_sampled_out_total",
+        "Log records of hot events left out by the log sampling.",
+        lambda: [({"event": e}, n) for e, n in log_filter.sampled_out.items()],
+    )
+    registry.counter(
+        "chat_log_records_dropped_total",
+        "Log records dropped because too many were waiting to be written.",
+        lambda: [({}, getattr(log_handler, "dropped", 0))],
+    )
+    registry.gauge(
+        "chat_draining",
+        "Whether this pod is shutting down and moving its sockets to other pods.",
+        lambda: [({}, int(drain.draining))],
+    )
+    registry.counter(
+        "chat_drained_sockets_total",
+        "Sockets told to reconnect to another pod as this pod shuts down.",
+        lambda: [({}, drain.notified)],
+    )
+    registry.counter(
+        "chat_lobby_roster_repairs_total",
+        "Lobby roster entries repaired by this pod to match the lobby partitions.",
+        lambda: [({"op": o}, n) for o, n in roster_reconciler.repaired.items()],
+    )
+    return registry
+
+
+def init_worker_metrics(socketio, registry):
+    # with several gunicorn workers, a scrape reaches only one of them
+    if int(os.environ.get("WORKERS", 1)) <= 1:
+        return registry
+    worker_metrics = WorkerMetrics(
+        registry,
+        os.environ.get("WORKER_METRICS_DIR", "/tmp/chat_worker_metrics"),
+        interval=float(os.environ.get("WORKER_METRICS_INTERVAL", 5.0)),
+    )
+    worker_metrics.start(socketio.server)
+    return worker_metrics
@@ -0,0 +1,106 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK_KEY = "legacy_state_migration"
+
+
+def _legacy_keys(partition):
+    """
+    Keys of a partition of the original layout, in which every kind of record had a
+    hash tag of its own and the chatrooms were partitioned by room id.
+    """
+    return (
+        f"connected_users{{users_partition_{partition}}}",
+        f"users_in_lobby{{lobby_partition_{partition}}}",
+        f"chatrooms{{room_partition_{partition}}}",
+        f"pending_requests{{requests_partition_{partition}}}",
+    )
+
+
+def migrate_legacy_state(manager, now=None, lock_timeout=300):
+    """
+    Move the users, lobby, chatrooms and pending requests written by the original
+    backend to the partitions of the current layout, and delete them from the old
+    keys. The migrated users are marked as seen now and their requests get a new
+    deadline. Returns the number of users moved.
+
+    The backend pods hold a lock while they migrate, so they can all run this on
+    startup: the first one moves the state and the others find nothing left. Pods of
+    the original backend must be gone by then, as their later writes are not moved.
+    """
+    now = time.time() if now is None else now
+    with manager.redis.lock(
+        MIGRATION_LOCK_KEY, timeout=lock_timeout, blocking_timeout=lock_timeout
+    ):
+        users, lobby, chatrooms, requests = {}, set(), {}, {}
+        pipeline = manager.redis.pipeline()
+        for partition in range(manager.num_partitions):
+            keys = _legacy_keys(partition)
+            pipeline.hgetall(keys[0])
+            pipeline.smembers(keys[1])
+            pipeline.hgetall(keys[2])
+            pipeline.hgetall(keys[3])
+        results = pipeline.execute()
+        for i in range(0, len(results), 4):
+            users.update(results[i])
+            lobby.update(results[i + 1])
+            chatrooms.update(results[i + 2])
+            requests.update(results[i + 3])
+        if not (users or lobby or chatrooms or requests):
+            return 0
+        in_lobby = _move(manager, users, lobby, chatrooms, requests, now)
+
+        pipeline = manager.redis.pipeline()
+        for partition in range(manager.num_partitions):
+            # the keys are in different slots, so they are deleted one by one
+            for key in _legacy_keys(partition):
+                pipeline.delete(key)
+        pipeline.execute()
+    manager.roster.apply([("add", username) for username in in_lobby])
+    logger.info("Moved %s users from the original state layout", len(users))
+    return len(users)
+
+
+def _move(manager, users, lobby, chatrooms, requests, now):
+    """
+    Write the records of the original layout to the current one and return the users
+    who are in the lobby.
+    """
+    codec = manager.codec
+    in_room = set()
+    in_lobby = []
+    pipeline = manager.redis.pipeline()
+    for username, user_data in users.items():
+        user = codec.decode_user(username, user_data)
+        keys = manager._partition_keys(username)
+        pipeline.hset(keys.users, username, codec.encode_user(user))
+        pipeline.zadd(keys.presence, {username: now})
+        if user["in_room"]:
+            in_room.add(username)
+        elif username in lobby:
+            pipeline.sadd(keys.lobby, username)
+            in_lobby.append(username)
+    for room_id, room_data in chatrooms.items():
+        chatroom = codec.decode_room(room_id, room_data)
+        room_data = codec.encode_room(chatroom)
+        # every member keeps a copy of the room in their own partition now; the
+        # original backend left the rooms of removed users behind, which are dropped
+        for username in in_room.intersection(chatroom["users"]):
+            keys = manager._partition_keys(username)
+            pipeline.hset(keys.user_rooms, username, room_id)
+            pipeline.hset(keys.chatrooms, room_id, room_data)
+    for from_username, request_data in requests.items():
+        request = codec.decode_request(from_username, request_data)
+        keys = manager._partition_keys(from_username)
+        pipeline.hset(keys.requests, from_username, codec.encode_request(request))
+        pipeline.zadd(
+            keys.request_deadlines, {from_username: now + manager.request_ttl}
+        )
+        pipeline.sadd(
+            manager._partition_keys(request["to_username"]).incoming_requests,
+            from_username,
+        )
+    pipeline.execute()
+    return in_lobby
@@ -0,0 +1,145 @@
+import logging
+import time
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_VERSION_KEY = "lobby_broadcast_version{lobby_roster}"
+# rooms of the lobby sockets that keep the whole lobby, and of the paged ones that only
+# keep the users in view; every user has a room named after them, and the control
+# character keeps these names from being taken as usernames
+FULL_LOBBY_ROOM = "\x00lobby:full"
+PAGED_LOBBY_ROOM = "\x00lobby:paged"
+
+# Claims the roster changes up to version ARGV[1] for broadcasting. Returns the
+# version up to which the lobby had already been broadcast, or ARGV[2] if that is not
+# known yet, or -1 if it already includes ARGV[1] and there is nothing left to do.
+_CLAIM_SCRIPT = """
+local broadcast = tonumber(redis.call("GET", KEYS[1]) or ARGV[2])
+if broadcast >= tonumber(ARGV[1]) then
+    return -1
+end
+redis.call("SET", KEYS[1], ARGV[1])
+return broadcast
+"""
+
+
+class LobbyBroadcaster:
+    """
+    Broadcasts the changes to the lobby roster to every lobby socket, coalesced into
+    one update per 'window' seconds.
+
+    The first change after a broadcast schedules the next one at the end of the
+    current window. Windows are aligned to the wall clock, so the pods broadcast at
+    the same moments, and a compare-and-set on the roster version in Redis lets only
+    the first of them send the changes of the window. The others find their changes
+    already included and skip their broadcast.
+
+    In "delta" mode a broadcast is a single user_list_deltas event with the deltas
+    since the previous broadcast, or a user_list_snapshot if they are no longer in the
+    roster history; in "full" mode it is the whole user list. With a window of 0
+    every change is broadcast on its own as it happens. The whole lobby only goes to
+    the sockets in FULL_LOBBY_ROOM, and the ones in PAGED_LOBBY_ROOM get a
+    lobby_resync with the roster version instead, after which they fetch the users
+    in view again.
+    """
+
+    def __init__(self, server, roster, redis, protocol="delta", window=0.1):
+        self.server = server
+        self.roster = roster
+        self.protocol = protocol
+        self.window = window
+        self.broadcasts = 0
+        self.skipped = 0
+        self._since = None  # the version before the first unsent change of this pod
+        self._target = 0  # the latest roster version changed by this pod
+        self._broadcast_version = 0
+        self._scheduled = False
+        self._claim_script = redis.register_script(_CLAIM_SCRIPT)
+
+    def notify(self, deltas):
+        """
+        Roster listener for the (version, op, username) deltas made by this pod.
+        """
+        if not self.window:
+            self._broadcast_now(deltas)
+            return
+        if self._since is None:
+            self._since = deltas[0][0] - 1
+        self._target = max(self._target, deltas[-1][0])
+        self._schedule()
+
+    def _broadcast_now(self, deltas):
+        if self.protocol == "full":
+            self._broadcast_lobby("update_user_list", self.roster.list_users())
+        else:
+            for version, op, username in deltas:
+                event = "user_joined" if op == "add" else "user_left"
+                self.server.emit(event, {"username": username, "seq": version})
+        self.broadcasts += 1
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._scheduled = True
+            self.server.start_background_task(self._run)
+
+    def _run(self):
+        self.server.sleep(self.window - time.time() % self.window)
+        self._scheduled = False
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to broadcast lobby changes")
+
+    def flush(self):
+        """
+        Broadcast the changes of this pod, unless another pod already has.
+        """
+        if self._since is None:
+            return
+        if self.roster.version < self._target:
+            # deltas of other pods are still missing, a snapshot is loaded if they
+            # do not arrive in time
+            self.roster.snapshot()
+            if self.roster.version < self._target:
+                self._schedule()
+                return
+        version = self.roster.version
+        since, self._since = self._since, None
+        previous = self._claim(version, since)
+        if previous < 0:
+            self._broadcast_version = max(self._broadcast_version, version)
+            self.skipped += 1
+            return
+        if self.protocol == "full":
+            self._broadcast_lobby("update_user_list", self.roster.list_users())
+        else:
+            deltas = self.roster.deltas_since(previous)
+            if deltas is None:
+                version, users = self.roster.snapshot()
+                self._broadcast_lobby(
+                    "user_list_snapshot", {"seq": version, "users": users}
+                )
+            else:
+                self.server.emit("user_list_deltas", {"deltas": deltas})
+        self._broadcast_version = version
+        self.broadcasts += 1
+
+    def _broadcast_lobby(self, event, data):
+        self.server.emit(event, data, room=FULL_LOBBY_ROOM)
+        self.server.emit(
+            "lobby_resync", {"seq": self.roster.version}, room=PAGED_LOBBY_ROOM
+        )
+
+    def _claim(self, version, since):
+        try:
+            return int(self._claim_script(
+                keys=[BROADCAST_VERSION_KEY], args=[version, since]
+            ))
+        except RedisError as e:
+            # broadcasting twice is harmless, clients skip deltas they already have
+            logger.warning("Could not claim the lobby broadcast: %s", e)
+            if version <= self._broadcast_version:
+                return -1
+            return max(self._broadcast_version, since)
@@ -0,0 +1,173 @@
+import contextvars
+import datetime
+import functools
+import json
+import logging
+import random
+import time
+
+from gevent import monkey
+
+# (event, sampled) of the Socket.IO event handler that is running, each greenlet has
+# its own
+current_event = contextvars.ContextVar("current_event", default=None)
+
+TEXT_FORMAT = "[%(asctime)s][%(name)s][%(levelname)s] %(message)s"
+
+
+def parse_event_settings(spec, parse):
+    """
+    Parse settings given as "event=value,...", e.g. "send_message=0.01", with 'parse'
+    converting each value.
+    """
+    settings = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            event, value = item.split("=")
+            settings[event.strip()] = parse(value.strip())
+        except ValueError:
+            raise ValueError(f"Invalid log setting '{item}'")
+    return settings
+
+
+def parse_level(name):
+    level = logging.getLevelName(name.upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level '{name}'")
+    return level
+
+
+class EventFilter(logging.Filter):
+    """
+    Tags records with the Socket.IO event being handled and drops the ones that are
+    below the level of that event. For events with a sampling rate, only that share
+    of the handler calls is sampled, and the records below WARNING of the other calls
+    are dropped, so that the records of a call are kept or dropped together. Records
+    logged outside of an event handler go under "default".
+    """
+
+    def __init__(self, levels=None, sampling=None, default_level=logging.INFO):
+        super().__init__()
+        self.levels = levels or {}
+        self.sampling = sampling or {}
+        self.default_level = self.levels.get("default", default_level)
+        self.sampled_out = {}  # event -> records dropped by sampling
+
+    def sample(self, event):
+        """
+        Whether to keep the records of a call of the handler of 'event'.
+        """
+        rate = self.sampling.get(event)
+        return rate is None or random.random() < rate
+
+    def filter(self, record):
+        event, sampled = current_event.get() or ("default", True)
+        record.event = event
+        if record.levelno < self.levels.get(event, self.default_level):
+            return False
+        if not sampled and record.levelno < logging.WARNING:
+            self.sampled_out[event] = self.sampled_out.get(event, 0) + 1
+            return False
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON with its time, level, logger, event,
+    message, and the latency of the handler and the exception when there are some.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", None),
+            "message": record.getMessage(),
+        }
+        latency_ms = getattr(record, "latency_ms", None)
+        if latency_ms is not None:
+            entry["latency_ms"] = round(latency_ms, 3)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(logging.Handler):
+    """
+    Hands records to a native thread that formats and writes them, so that a slow
+    stdout does not block the event loop. The messages are formatted by the thread as
+    well, so logged arguments must not be changed after the call. Records are dropped
+    when 'max_queued' of them are waiting, and the rest are written on close.
+    """
+
+    def __init__(self, stream, max_queued=10000):
+        super().__init__()
+        self.stream = stream
+        self.max_queued = max_queued
+        self.dropped = 0
+        # the event loop must never wait on the thread, so the queue and the thread
+        # are the ones gevent has not patched
+        self._queue = monkey.get_original("queue", "SimpleQueue")()
+        self._stopped = monkey.get_original("_thread", "allocate_lock")()
+        self._stopped.acquire()
+        monkey.get_original("_thread", "start_new_thread")(self._write, ())
+
+    def emit(self, record):
+        if self._queue.qsize() >= self.max_queued:
+            self.dropped += 1
+            return
+        self._queue.put(record)
+
+    def _write(self):
+        try:
+            while True:
+                record = self._queue.get()
+                if record is None:
+                    break
+                try:
+                    self.stream.write(self.format(record) + "\n")
+                    if self._queue.empty():
+                        self.stream.flush()
+                except Exception:
+                    self.handleError(record)
+        finally:
+            self.stream.flush()
+            self._stopped.release()
+
+    def close(self):
+        if self._stopped.locked():
+            self._queue.put(None)
+            if self._stopped.acquire(timeout=5):
+                self._stopped.release()
+        super().close()
+
+
+def logged(logger, log_filter, event, handler):
+    """
+    Wrap a Socket.IO event handler so that the records logged while it runs are
+    tagged with 'event' and sampled together, and its latency is logged once it
+    returns.
+    """
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        sampled = log_filter.sample(event)
+        token = current_event.set((event, sampled))
+        start = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            # the record would be dropped anyway, so it is not even created
+            if sampled and logger.isEnabledFor(logging.INFO):
+                latency_ms = (time.perf_counter() - start) * 1000
+                logger.info(
+                    "Handled '%s' in %.3f ms",
+                    event,
+                    latency_ms,
+                    extra={"latency_ms": latency_ms},
+                )
+            current_event.reset(token)
+    return wrapper
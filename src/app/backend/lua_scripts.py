@@ -0,0 +1,211 @@
+import hashlib
+import logging
+
+from redis.exceptions import NoScriptError
+
+logger = logging.getLogger(__name__)
+
+# All scripts operate on the keys of a single user partition, which share the
+# {partition_N} hash tag and therefore live in the same cluster slot:
+#   KEYS[1] connected_users, KEYS[2] users_in_lobby, KEYS[3] user_rooms,
+#   KEYS[4] chatrooms, KEYS[5] pending_requests, KEYS[6] incoming_requests:<user>,
+#   KEYS[7] user_sockets, KEYS[8] presence, KEYS[9] request_deadlines
+# Records are encoded by the caller, so the scripts never decode them.
+
+# Move a user from the lobby into a room. A user is in the lobby exactly when they
+# are not in a room, so the SREM doubles as the "not in a room yet" check.
+#   ARGV: username, encoded user, room_id, encoded room, sender whose request to this
+#   user is consumed (or ""), followed by the encodings the request this user must
+#   still have pending may be stored with (none if no request is consumed)
+ENTER_ROOM = """
+local username = ARGV[1]
+local consumes_request = #ARGV > 5
+if redis.call("HEXISTS", KEYS[1], username) == 0 then
+    return "no_user"
+end
+if consumes_request then
+    local pending = redis.call("HGET", KEYS[5], username)
+    local found = false
+    for i = 6, #ARGV do
+        if pending == ARGV[i] then
+            found = true
+            break
+        end
+    end
+    if not found then
+        return "no_request"
+    end
+end
+if redis.call("SREM", KEYS[2], username) == 0 then
+    return "in_room"
+end
+if consumes_request then
+    redis.call("HDEL", KEYS[5], username)
+    redis.call("ZREM", KEYS[9], username)
+end
+if ARGV[5] ~= "" then
+    redis.call("SREM", KEYS[6], ARGV[5])
+end
+redis.call("HSET", KEYS[1], username, ARGV[2])
+redis.call("HSET", KEYS[3], username, ARGV[3])
+redis.call("HSET", KEYS[4], ARGV[3], ARGV[4])
+return "ok"
+"""
+
+# Move a user from a room back to the lobby, dropping their copy of the room. Users
+# removed meanwhile only leave the room, and "no_user" tells them apart.
+#   ARGV: username, encoded user, room_id
+LEAVE_ROOM = """
+local username = ARGV[1]
+if redis.call("HGET", KEYS[3], username) ~= ARGV[3] then
+    return "not_in_room"
+end
+redis.call("HDEL", KEYS[3], username)
+redis.call("HDEL", KEYS[4], ARGV[3])
+if redis.call("HEXISTS", KEYS[1], username) == 1 then
+    redis.call("HSET", KEYS[1], username, ARGV[2])
+    redis.call("SADD", KEYS[2], username)
+    return "ok"
+end
+return "no_user"
+"""
+
+# Remove a user and their copy of the room they are in, if any. Returns 1 if the
+# user was in the lobby.
+#   ARGV: username
+REMOVE_USER = """
+local username = ARGV[1]
+local room_id = redis.call("HGET", KEYS[3], username)
+if room_id then
+    redis.call("HDEL", KEYS[3], username)
+    redis.call("HDEL", KEYS[4], room_id)
+end
+redis.call("ZREM", KEYS[8], username)
+redis.call("HDEL", KEYS[1], username)
+return redis.call("SREM", KEYS[2], username)
+"""
+
+# Remove up to ARGV[2] users of the partition last seen before ARGV[1], along with
+# their copy of the room they are in and their socket counter. Claiming them from the
+# presence index here makes sure that only one pod reaps each of them.
+#   ARGV: cutoff time, limit
+# Returns the reaped users as a flat [username, room_id or "", 1 if they were in the
+# lobby else 0, ...] list.
+REAP_EXPIRED = """
+local expired = redis.call(
+    "ZRANGEBYSCORE", KEYS[8], "-inf", "(" .. ARGV[1], "LIMIT", 0, tonumber(ARGV[2])
+)
+local reaped = {}
+for _, username in ipairs(expired) do
+    redis.call("ZREM", KEYS[8], username)
+    local room_id = redis.call("HGET", KEYS[3], username)
+    if room_id then
+        redis.call("HDEL", KEYS[3], username)
+        redis.call("HDEL", KEYS[4], room_id)
+    end
+    local in_lobby = redis.call("SREM", KEYS[2], username)
+    redis.call("HDEL", KEYS[7], username)
+    if redis.call("HDEL", KEYS[1], username) == 1 then
+        table.insert(reaped, username)
+        table.insert(reaped, room_id or "")
+        table.insert(reaped, in_lobby)
+    end
+end
+return reaped
+"""
+
+# Decrement the number of sockets of a user, dropping the counter once it hits zero.
+#   ARGV: username
+REMOVE_SOCKET = """
+local remaining = redis.call("HINCRBY", KEYS[7], ARGV[1], -1)
+if remaining <= 0 then
+    redis.call("HDEL", KEYS[7], ARGV[1])
+    return 0
+end
+return remaining
+"""
+
+# Remove up to ARGV[2] pending requests of the partition whose deadline is not after
+# ARGV[1]. Claiming them from the deadline index here makes sure that only one pod
+# expires each of them.
+#   ARGV: now, limit
+# Returns the expired requests as a flat [from_username, encoded request, ...] list.
+EXPIRE_REQUESTS = """
+local due = redis.call(
+    "ZRANGEBYSCORE", KEYS[9], "-inf", ARGV[1], "LIMIT", 0, tonumber(ARGV[2])
+)
+local expired = {}
+for _, username in ipairs(due) do
+    redis.call("ZREM", KEYS[9], username)
+    local request = redis.call("HGET", KEYS[5], username)
+    if request then
+        redis.call("HDEL", KEYS[5], username)
+        table.insert(expired, username)
+        table.insert(expired, request)
+    end
+end
+return expired
+"""
+
+SCRIPTS = {
+    "enter_room": ENTER_ROOM,
+    "leave_room": LEAVE_ROOM,
+    "remove_user": REMOVE_USER,
+    "reap_expired": REAP_EXPIRED,
+    "expire_requests": EXPIRE_REQUESTS,
+    "remove_socket": REMOVE_SOCKET,
+}
+
+
+class ClusterScripts:
+    """
+    Runs registered Lua scripts with EVALSHA. A batch of script calls is sent in one
+    cluster pipeline, so calls against different slots cost a single round trip.
+
+    redis-py refuses ``evalsha`` on cluster pipelines because it cannot load missing
+    scripts there, so the commands are queued directly and only the calls that failed
+    with NOSCRIPT (e.g. after a failover) are retried once the scripts are loaded.
+    """
+
+    def __init__(self, redis, scripts=SCRIPTS):
+        self.redis = redis
+        self.scripts = scripts
+        self.shas = {
+            name: hashlib.sha1(source.encode()).hexdigest()
+            for name, source in scripts.items()
+        }
+
+    def load(self):
+        for source in self.scripts.values():
+            self.redis.script_load(source)
+
+    def run(self, calls):
+        """
+        Execute (name, keys, args) script calls and return their results in order.
+        """
+        results = self._execute(calls)
+        missing = [i for i, result in enumerate(results) if _is_noscript(result)]
+        if missing:
+            logger.warning("Lua scripts missing from Redis, loading them")
+            self.load()
+            retried = self._execute([calls[i] for i in missing])
+            for i, result in zip(missing, retried):
+                results[i] = result
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def _execute(self, calls):
+        pipeline = self.redis.pipeline()
+        for name, keys, args in calls:
+            pipeline.execute_command(
+                "EVALSHA", self.shas[name], len(keys), *keys, *args
+            )
+        return pipeline.execute(raise_on_error=False)
+
+
+def _is_noscript(result):
+    return isinstance(result, NoScriptError) or (
+        isinstance(result, Exception) and str(result).startswith("NOSCRIPT")
+    )
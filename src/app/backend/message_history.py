@@ -0,0 +1,73 @@
+import base64
+import json
+import re
+
+# stream entry IDs are "<milliseconds>-<sequence>"
+_ENTRY_ID = re.compile(r"^\d+-\d+$")
+
+
+class RoomHistory:
+    """
+    Recent messages of every chat room, kept in a Redis Stream per room so that a
+    client whose connection dropped can fetch what it missed.
+
+    Only the encrypted messages are stored, as relayed. Each stream keeps at most
+    about 'maxlen' entries, trimmed as messages are appended, and expires 'ttl'
+    seconds after its last message, so abandoned rooms do not accumulate.
+    """
+
+    def __init__(self, redis, maxlen=200, ttl=3600, batch_size=50):
+        self.redis = redis
+        self.maxlen = maxlen
+        self.ttl = ttl
+        self.batch_size = batch_size
+
+    @staticmethod
+    def _key(room_id):
+        # the room ID is the hash tag, so the stream is a single cluster key
+        return f"room_history{{{room_id}}}"
+
+    def append(self, room_id, message):
+        """
+        Append a message and return its entry ID, which orders it within the room.
+        """
+        key = self._key(room_id)
+        pipeline = self.redis.pipeline()
+        pipeline.xadd(key, _encode(message), maxlen=self.maxlen, approximate=True)
+        pipeline.expire(key, self.ttl)
+        entry_id, _ = pipeline.execute()
+        return entry_id
+
+    def read_after(self, room_id, after_id):
+        """
+        Return up to 'batch_size' messages appended after 'after_id' as (entry_id,
+        message) pairs in order, and whether more messages may follow them. Messages
+        trimmed from the stream are gone.
+        """
+        if not isinstance(after_id, str) or not _ENTRY_ID.match(after_id):
+            raise ValueError(f"Invalid message ID '{after_id}'")
+        entries = self.redis.xrange(
+            self._key(room_id), min=f"({after_id}", count=self.batch_size
+        )
+        messages = [(entry_id, _decode(fields)) for entry_id, fields in entries]
+        return messages, len(entries) == self.batch_size
+
+    def delete(self, room_id):
+        self.redis.delete(self._key(room_id))
+
+
+def _encode(message):
+    # binary envelope fields are stored base64 encoded, and listed in "binary"
+    binary = [field for field, value in message.items() if isinstance(value, bytes)]
+    data = {
+        field: base64.b64encode(value).decode() if field in binary else value
+        for field, value in message.items()
+    }
+    return {"data": json.dumps(data), "binary": ",".join(binary)}
+
+
+def _decode(fields):
+    message = json.loads(fields["data"])
+    for field in filter(None, fields.get("binary", "").split(",")):
+        message[field] = base64.b64decode(message[field])
+    return message
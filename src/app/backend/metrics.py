@@ -0,0 +1,252 @@
+import bisect
+import functools
+import glob
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, suited to Redis round trips and pool waits within a pod
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5
+)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram in the Prometheus style. Observations are only counted, so
+    recording one costs a bisect and two additions.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        """
+        Return (upper bound, observations at or below it) pairs, ending with +Inf.
+        """
+        bounds = [*self.buckets, float("inf")]
+        total = 0
+        cumulative = []
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return cumulative
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile, or None without observations.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative_counts():
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "avg_ms": self.sum / self.count * 1000 if self.count else 0.0,
+            "p50_ms": _to_ms(self.quantile(0.5)),
+            "p99_ms": _to_ms(self.quantile(0.99)),
+        }
+
+
+def _to_ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class EventMetrics:
+    """
+    Call counts, error counts and latency histograms of the Socket.IO event handlers,
+    keyed by event name.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.errors = {}
+        self.latency = {}
+
+    def timed(self, event, handler):
+        """
+        Wrap a handler so that its calls are counted and timed under 'event'.
+        """
+        self.calls[event] = 0
+        self.errors[event] = 0
+        self.latency[event] = Histogram()
+
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            except Exception:
+                self.errors[event] += 1
+                raise
+            finally:
+                self.calls[event] += 1
+                self.latency[event].observe(time.perf_counter() - start)
+        return wrapper
+
+
+class MetricsRegistry:
+    """
+    Renders metrics in the Prometheus text exposition format. Metrics are registered
+    with a function returning their current (labels, value) samples, so the values
+    are only read when the endpoint is scraped; histogram samples are Histograms.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help_text, collect):
+        self._metrics.append((name, "counter", help_text, collect))
+
+    def gauge(self, name, help_text, collect):
+        self._metrics.append((name, "gauge", help_text, collect))
+
+    def histogram(self, name, help_text, collect):
+        self._metrics.append((name, "histogram", help_text, collect))
+
+    def collect(self):
+        """
+        Return the current samples as (name, type, help text, samples) families.
+        """
+        return [
+            (name, metric_type, help_text, list(collect()))
+            for name, metric_type, help_text, collect in self._metrics
+        ]
+
+    def render(self, families=None):
+        lines = []
+        for name, metric_type, help_text, samples in families or self.collect():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                if metric_type != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                for bound, count in value.cumulative_counts():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = _format_labels({**labels, "le": le})
+                    lines.append(f"{name}_bucket{bucket_labels} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+class WorkerMetrics:
+    """
+    Metrics of all the gunicorn workers of a pod. Every worker writes its samples to
+    a file in 'directory' every 'interval' seconds, and a scrape, which reaches one
+    of the workers, adds the samples of the others to its own, so that the pod is
+    reported as a whole. Files not updated for three intervals belong to workers that
+    have exited and are ignored.
+    """
+
+    def __init__(self, registry, directory, interval=5.0):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._path = os.path.join(directory, f"{os.getpid()}.json")
+
+    def start(self, server):
+        os.makedirs(self.directory, exist_ok=True)
+        server.start_background_task(self._run, server)
+
+    def _run(self, server):
+        while True:
+            try:
+                self.export()
+            except Exception:
+                logger.exception("Failed to export the metrics of this worker")
+            server.sleep(self.interval)
+
+    def export(self):
+        families = [
+            (name, metric_type, help_text, [
+                (labels, _dump_value(value)) for labels, value in samples
+            ])
+            for name, metric_type, help_text, samples in self.registry.collect()
+        ]
+        temporary = f"{self._path}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(families, f)
+        os.replace(temporary, self._path)
+
+    def render(self):
+        families = self.registry.collect()
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            if path == self._path:
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > 3 * self.interval:
+                    continue
+                with open(path) as f:
+                    families = _merge_families(families, json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning("Could not read worker metrics '%s': %s", path, e)
+        return self.registry.render(families)
+
+
+def _dump_value(value):
+    if isinstance(value, Histogram):
+        return {"buckets": value.buckets, "counts": value.counts, "sum": value.sum}
+    return value
+
+
+def _add_values(value, other):
+    if not isinstance(value, Histogram):
+        return value + other
+    total = Histogram(value.buckets)
+    total.counts = [a + b for a, b in zip(value.counts, other["counts"])]
+    total.count = sum(total.counts)
+    total.sum = value.sum + other["sum"]
+    return total
+
+
+def _merge_families(families, others):
+    others = {
+        name: {tuple(sorted(labels.items())): value for labels, value in samples}
+        for name, _, _, samples in others
+    }
+    merged = []
+    for name, metric_type, help_text, samples in families:
+        other_samples = dict(others.get(name, {}))
+        summed = []
+        for labels, value in samples:
+            other = other_samples.pop(tuple(sorted(labels.items())), None)
+            if other is not None:
+                value = _add_values(value, other)
+            summed.append((labels, value))
+        for key, value in other_samples.items():
+            if metric_type == "histogram":
+                value = _add_values(Histogram(value["buckets"]), value)
+            summed.append((dict(key), value))
+        merged.append((name, metric_type, help_text, summed))
+    return merged
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(
+        f'{key}="{_escape_label(value)}"' for key, value in labels.items()
+    )
+    return f"{{{pairs}}}"
+
+
+def _escape_label(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
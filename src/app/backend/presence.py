@@ -0,0 +1,107 @@
+import logging
+import math
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Presence:
+    """
+    Tracks when each user was last seen, so that the records of users whose browser
+    crashed or lost its network, or whose pod died before it could release them, do
+    not stay in Redis forever.
+
+    Every 'heartbeat_interval' seconds the pod marks the users with a socket connected
+    to it as seen. Engine.IO pings disconnect sockets whose client stops answering, so
+    a connected socket is a live user. Every 'reap_interval' seconds the pod reaps the
+    users not seen for 'ttl' seconds, at most 'batch_size' of them per pass, and goes
+    through about 'batch_size' more users, one partition after another, to start
+    tracking any that are not tracked yet. All the pods reap, and each expired user is
+    claimed by one of them. 'on_reaped' is called with the username and room ID of
+    every user reaped by this pod.
+    """
+
+    def __init__(
+        self,
+        server,
+        manager,
+        sessions,
+        ttl=60.0,
+        heartbeat_interval=10.0,
+        reap_interval=10.0,
+        batch_size=500,
+        on_reaped=None,
+    ):
+        self.server = server
+        self.manager = manager
+        self.sessions = sessions
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.reap_interval = reap_interval
+        self.batch_size = batch_size
+        self.on_reaped = on_reaped
+        self.reaped = {"users": 0, "pending_requests": 0, "chatrooms": 0}
+        self._partition = random.randrange(manager.num_partitions)
+        self._cursor = 0
+
+    def start(self):
+        self.server.start_background_task(self._run_heartbeat)
+        self.server.start_background_task(self._run_reaper)
+
+    def _run_heartbeat(self):
+        while True:
+            try:
+                self.heartbeat()
+            except Exception:
+                logger.exception("Failed to mark the connected users as seen")
+            self.server.sleep(self.heartbeat_interval)
+
+    def _run_reaper(self):
+        # spread the passes of the pods over the interval
+        self.server.sleep(random.uniform(0, self.reap_interval))
+        while True:
+            try:
+                self.reap()
+            except Exception:
+                logger.exception("Failed to reap expired users")
+            self.server.sleep(self.reap_interval)
+
+    def heartbeat(self):
+        self.manager.touch_users({session.username for session in self.sessions})
+
+    def reap(self):
+        limit = max(1, math.ceil(self.batch_size / self.manager.num_partitions))
+        cutoff = time.time() - self.ttl
+        reaped, requests = self.manager.reap_expired_users(cutoff, limit)
+        rooms = sum(1 for _, room_id in reaped if room_id)
+        self.reaped["users"] += len(reaped)
+        self.reaped["pending_requests"] += requests
+        self.reaped["chatrooms"] += rooms
+        if reaped:
+            logger.info(
+                "Reaped %s expired users, %s of their pending requests and %s of their "
+                "chatrooms",
+                len(reaped),
+                requests,
+                rooms,
+            )
+        for username, room_id in reaped:
+            if self.on_reaped:
+                self.on_reaped(username, room_id)
+
+        self._track_untracked()
+        return reaped
+
+    def _track_untracked(self):
+        # goes on from where the previous pass stopped
+        seen = 0
+        for _ in range(self.manager.num_partitions):
+            self._cursor, count = self.manager.track_untracked_users(
+                self._partition, self._cursor, self.batch_size - seen
+            )
+            if self._cursor == 0:
+                self._partition = (self._partition + 1) % self.manager.num_partitions
+            seen += count
+            if seen >= self.batch_size:
+                return
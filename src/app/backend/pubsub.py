@@ -0,0 +1,279 @@
+import functools
+import logging
+import threading
+import time
+
+import kombu
+from kombu.common import maybe_declare
+from socketio import KombuManager
+
+from encoding import PickleSerializer
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# routing keys of the routed exchange
+BROADCAST_KEY = "all"
+ROOM_KEY_PREFIX = "room:"
+HOST_KEY_PREFIX = "host:"
+
+PRESENCE_METHOD = "room_presence"
+
+
+class ChatKombuManager(KombuManager):
+    """
+    KombuManager that also carries backend-internal messages (e.g. lobby roster
+    deltas) over the same exchange as the Socket.IO emits, so that pods can keep
+    local state in sync without a separate broker connection.
+
+    Internal messages use their own 'method' names, which the base listener thread
+    ignores, so they are intercepted here before reaching it.
+
+    Messages are serialized with 'serializer' (see encoding.SERIALIZERS) instead of
+    always being pickled.
+    """
+
+    def __init__(self, *args, serializer=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.serializer = serializer or PickleSerializer()
+        self.backpressure = None
+        self._internal_handlers = {}
+        self.publish_latency = Histogram()
+        # the publisher connection is shared by all handlers, and Kombu channels
+        # must not be opened concurrently on one connection
+        self._publish_lock = threading.Lock()
+        self._routing_key = ""
+        self.local_emits = 0
+
+    def on_internal(self, method, handler):
+        self._internal_handlers[method] = handler
+
+    def has_remote_members(self, room):
+        """
+        Whether sockets on other pods may be in the room. Without knowledge of the
+        other pods' rooms, they always may be.
+        """
+        return True
+
+    def emit(self, *args, **kwargs):
+        if kwargs.get("ignore_queue"):
+            self.local_emits += 1
+        return super().emit(*args, **kwargs)
+
+    def _handle_emit(self, message):
+        # both local emits and those from other pods are delivered through here
+        if self.backpressure is not None:
+            skip = self.backpressure.skip_sids(message["event"])
+            if skip:
+                skip_sid = message.get("skip_sid")
+                if not isinstance(skip_sid, list):
+                    skip_sid = [skip_sid]
+                message = {**message, "skip_sid": [*skip_sid, *skip]}
+        super()._handle_emit(message)
+
+    def publish_internal(self, method, data):
+        """
+        Publish an internal message to the other pods. The sending pod is expected to
+        have already applied the change locally, so it does not handle its own message.
+        """
+        self._publish({"method": method, "data": data, "host_id": self.host_id})
+
+    def _publish(self, data):
+        start = time.perf_counter()
+        try:
+            with self._publish_lock:
+                self._routing_key = self._route(data)
+                self._publish_payload(self.serializer.dumps(data))
+        finally:
+            self.publish_latency.observe(time.perf_counter() - start)
+
+    def _publish_payload(self, payload):
+        # KombuManager._publish, which always pickles the message
+        for retry in (True, False):
+            try:
+                producer_publish = self._producer_publish(self.publisher_connection)
+                producer_publish(payload)
+                return
+            except (OSError, kombu.exceptions.KombuError):
+                if retry:
+                    logger.error("Cannot publish to the message queue, retrying")
+                else:
+                    logger.error("Cannot publish to the message queue, giving up")
+
+    def _route(self, data):
+        """
+        Routing key of a message. A fanout exchange ignores it.
+        """
+        return ""
+
+    def _producer_publish(self, connection):
+        publish = super()._producer_publish(connection)
+        return functools.partial(publish, routing_key=self._routing_key)
+
+    def _listen(self):
+        for message in super()._listen():
+            data = self._decode_message(message)
+            if data is None:
+                yield message
+                continue
+            handler = self._internal_handlers.get(data.get("method"))
+            if handler is None:
+                yield data
+                continue
+            if data.get("host_id") == self.host_id:
+                continue
+            try:
+                handler(data["data"])
+            except Exception:
+                logger.exception(
+                    "Failed to handle internal message '%s'", data["method"]
+                )
+
+    def _decode_message(self, message):
+        if isinstance(message, dict):
+            return message
+        if isinstance(message, bytes):
+            try:
+                data = self.serializer.loads(message)
+            except Exception:
+                return None
+            return data if isinstance(data, dict) else None
+        return None
+
+
+class RoutedKombuManager(ChatKombuManager):
+    """
+    ChatKombuManager that publishes to a direct exchange, on which each pod's queue is
+    only bound to the rooms that have sockets on the pod. Every socket is in a room
+    named after its sid and the handlers put users in rooms named after them, so a
+    message to a socket, a user or a chat room only reaches the pods with recipients.
+    Broadcasts and internal messages are still delivered to every pod.
+
+    Bindings are added when the first local socket enters a room and removed when the
+    last one leaves it. The listener declares the queue with all current bindings
+    whenever it (re)connects, so a failed bind is repaired on the next reconnect.
+
+    A pod also announces its presence in every room but a sid room to the pods
+    already bound to it, which answer with their own presence, so each pod knows
+    which rooms are only present locally. Presence that is lost, e.g. when a pod
+    crashes, only makes the other pods publish messages they could keep local.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._bindings = {
+            key: self._binding(key)
+            for key in (BROADCAST_KEY, HOST_KEY_PREFIX + self.host_id)
+        }
+        self._reader_queue = None
+        self._announced_rooms = set()
+        self._remote_hosts = {}  # room -> hosts of the other pods present in it
+        self.binds = 0
+        self.unbinds = 0
+        self.on_internal(PRESENCE_METHOD, self._on_presence)
+
+    def has_remote_members(self, room):
+        return room not in self._announced_rooms or bool(self._remote_hosts.get(room))
+
+    def basic_enter_room(self, sid, namespace, room, eio_sid=None):
+        new_room = room is not None and not self._has_local_room(room)
+        super().basic_enter_room(sid, namespace, room, eio_sid=eio_sid)
+        if not new_room:
+            return
+        self._update_binding(ROOM_KEY_PREFIX + room, bind=True)
+        if room != sid:
+            self._announced_rooms.add(room)
+            self._announce(room, present=True)
+
+    def basic_leave_room(self, sid, namespace, room):
+        super().basic_leave_room(sid, namespace, room)
+        if room is None or self._has_local_room(room):
+            return
+        self._update_binding(ROOM_KEY_PREFIX + room, bind=False)
+        if room in self._announced_rooms:
+            self._announced_rooms.discard(room)
+            self._remote_hosts.pop(room, None)
+            self._announce(room, present=False)
+
+    def _has_local_room(self, room):
+        return any(room in rooms for rooms in self.rooms.values())
+
+    def _announce(self, room, present, reply_to=None):
+        self.publish_internal(
+            PRESENCE_METHOD,
+            {
+                "room": room,
+                "host_id": self.host_id,
+                "present": present,
+                "reply_to": reply_to,
+            },
+        )
+
+    def _on_presence(self, presence):
+        room, host_id = presence["room"], presence["host_id"]
+        if room not in self._announced_rooms:
+            return
+        if not presence["present"]:
+            self._remote_hosts.get(room, set()).discard(host_id)
+            return
+        self._remote_hosts.setdefault(room, set()).add(host_id)
+        if presence["reply_to"] is None:
+            self._announce(room, present=True, reply_to=host_id)
+
+    def _queue(self):
+        if self._reader_queue is None:
+            options = {"durable": False, "queue_arguments": {"x-expires": 300000}}
+            options.update(self.queue_options)
+            self._reader_queue = kombu.Queue(
+                f"flask-socketio.{self.host_id}",
+                bindings=list(self._bindings.values()),
+                **options,
+            )
+        return self._reader_queue
+
+    def _binding(self, routing_key):
+        return kombu.binding(self._exchange(), routing_key=routing_key)
+
+    def _update_binding(self, routing_key, bind):
+        # the listener declares a copy of this queue on every (re)connect, so keeping
+        # its bindings current restores them after a reconnect
+        queue = self._queue()
+        if bind:
+            self._bindings[routing_key] = self._binding(routing_key)
+            queue.bindings.add(self._bindings[routing_key])
+            self.binds += 1
+        else:
+            queue.bindings.discard(self._bindings.pop(routing_key, None))
+            self.unbinds += 1
+        try:
+            with self._publish_lock:
+                channel = self.publisher_connection.default_channel
+                maybe_declare(self._exchange(), channel)
+                bound_queue = queue(channel)
+                if bind:
+                    bound_queue.bind_to(self._exchange(), routing_key=routing_key)
+                else:
+                    bound_queue.unbind_from(self._exchange(), routing_key=routing_key)
+        except Exception:
+            logger.exception("Failed to update the binding of '%s'", routing_key)
+
+    def _route(self, data):
+        method = data.get("method")
+        if method == "callback":
+            return HOST_KEY_PREFIX + data["host_id"]
+        if method == PRESENCE_METHOD:
+            presence = data["data"]
+            if presence["reply_to"]:
+                return HOST_KEY_PREFIX + presence["reply_to"]
+            return ROOM_KEY_PREFIX + presence["room"]
+        if method in ("emit", "close_room"):
+            room = data.get("room")
+        elif method in ("disconnect", "enter_room", "leave_room"):
+            room = data.get("sid")
+        else:
+            room = None
+        # emits to several rooms at once are broadcast rather than published once
+        # per room, which could deliver them twice to sockets in more than one room
+        if isinstance(room, str):
+            return ROOM_KEY_PREFIX + room
+        return BROADCAST_KEY
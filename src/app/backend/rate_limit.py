@@ -0,0 +1,105 @@
+import logging
+import math
+import time
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# Takes a token from the bucket in KEYS[1] if there is one, after refilling it at
+# ARGV[1] tokens per second up to ARGV[2] tokens since it was last updated. The caller
+# passes the time in ARGV[3], so that the script stays deterministic.
+_TAKE_SCRIPT = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated_at")
+local tokens = tonumber(bucket[1]) or burst
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated_at) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated_at", tostring(now))
+redis.call("EXPIRE", KEYS[1], tonumber(ARGV[4]))
+return allowed
+"""
+
+
+def parse_limits(spec):
+    """
+    Parse limits given as "event=rate/burst,...", e.g. "send_message=5/20" to allow
+    bursts of 20 messages and 5 messages per second after that.
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        try:
+            event, limit = item.split("=")
+            rate, burst = limit.split("/")
+            limits[event.strip()] = (float(rate), float(burst))
+        except ValueError:
+            raise ValueError(f"Invalid rate limit '{item}'")
+    return limits
+
+
+class TokenBucketLimiter:
+    """
+    Per-pod token buckets of every socket and event type. A bucket holds up to
+    'burst' tokens and refills at 'rate' tokens per second, and every event takes a
+    token or is rejected. Events without a configured limit are never limited.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}  # (sid, event) -> (tokens, updated_at)
+        self.limited = {}  # event -> rejected events
+
+    def limits_event(self, event):
+        return event in self.limits
+
+    def allow(self, sid, username, event):
+        limit = self.limits.get(event)
+        if limit is None:
+            return True
+        allowed = self._take(sid, username, event, *limit)
+        if not allowed:
+            self.limited[event] = self.limited.get(event, 0) + 1
+        return allowed
+
+    def forget(self, sid):
+        for event in self.limits:
+            self._buckets.pop((sid, event), None)
+
+    def _take(self, sid, username, event, rate, burst):
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get((sid, event), (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        self._buckets[(sid, event)] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+
+class RedisTokenBucketLimiter(TokenBucketLimiter):
+    """
+    Token buckets kept in Redis per user instead of per socket, so that the limits
+    hold across all the sockets a user has on any pod. Costs a round trip per limited
+    event, and lets events through if Redis cannot be reached.
+    """
+
+    def __init__(self, redis, limits):
+        super().__init__(limits)
+        self._take_script = redis.register_script(_TAKE_SCRIPT)
+
+    def forget(self, sid):
+        # the buckets are shared by the user's sockets and expire once full again
+        pass
+
+    def _take(self, sid, username, event, rate, burst):
+        try:
+            return bool(self._take_script(
+                keys=[f"rate_limit:{event}:{username}"],
+                args=[rate, burst, time.time(), math.ceil(burst / rate) + 1],
+            ))
+        except RedisError as e:
+            logger.warning("Could not check the rate limit of '%s': %s", username, e)
+            return True
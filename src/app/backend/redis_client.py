@@ -0,0 +1,152 @@
+import functools
+import time
+
+from redis import Redis
+from redis.backoff import EqualJitterBackoff
+from redis.cluster import RedisCluster
+from redis.connection import BlockingConnectionPool
+from redis.exceptions import ConnectionError, TimeoutError
+from redis.retry import Retry
+
+from metrics import Histogram
+
+
+class RedisClientSettings:
+    """
+    Connection settings shared by every node pool of a cluster client.
+
+    'max_connections' applies per cluster node. A command that finds the node's pool
+    exhausted waits up to 'pool_timeout' seconds for a connection to be released.
+    Commands failing with a connection error or a timeout are retried 'retries' times
+    with jittered exponential backoff between 'backoff_base' and 'backoff_cap'.
+    """
+
+    def __init__(
+        self,
+        max_connections=50,
+        pool_timeout=5.0,
+        socket_timeout=5.0,
+        socket_connect_timeout=2.0,
+        retries=3,
+        backoff_base=0.01,
+        backoff_cap=0.5,
+    ):
+        self.max_connections = max_connections
+        self.pool_timeout = pool_timeout
+        self.socket_timeout = socket_timeout
+        self.socket_connect_timeout = socket_connect_timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+    def retry(self):
+        return Retry(
+            EqualJitterBackoff(cap=self.backoff_cap, base=self.backoff_base),
+            self.retries,
+            supported_errors=(ConnectionError, TimeoutError),
+        )
+
+
+class RedisPoolMetrics:
+    """
+    Pool saturation and latency of a cluster client, summed over its node pools.
+
+    'pool_wait' is the time to obtain a connection, including connecting a new one,
+    and 'command_latency' the time a connection stays checked out, which for the
+    cluster client is one command or one pipeline sent to a node.
+    """
+
+    def __init__(self):
+        self.pool_wait = Histogram()
+        self.command_latency = Histogram()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.pool_timeouts = 0
+
+    def checked_out(self, wait=None):
+        if wait is not None:
+            self.pool_wait.observe(wait)
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def released(self, latency):
+        self.command_latency.observe(latency)
+        self.in_use -= 1
+
+    def stats(self):
+        return {
+            "in_use": self.in_use,
+            "max_in_use": self.max_in_use,
+            "pool_timeouts": self.pool_timeouts,
+            "pool_wait": self.pool_wait.stats(),
+            "command_latency": self.command_latency.stats(),
+        }
+
+
+class MeteredConnectionPool(BlockingConnectionPool):
+    """
+    Blocking pool that reports to RedisPoolMetrics. Unlike the default pool, which
+    fails immediately once 'max_connections' is reached, it queues the caller.
+    """
+
+    def __init__(self, metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+        self._checked_out = {}
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except ConnectionError as e:
+            if str(e) == "No connection available.":
+                self.metrics.pool_timeouts += 1
+            raise
+        now = time.perf_counter()
+        self._checked_out[connection] = now
+        self.metrics.checked_out(now - start)
+        return connection
+
+    def release(self, connection):
+        # connections released by a failed get_connection were never handed out
+        start = self._checked_out.pop(connection, None)
+        if start is not None:
+            self.metrics.released(time.perf_counter() - start)
+        super().release(connection)
+
+
+def create_cluster_client(startup_nodes, password, settings, metrics):
+    # redis-py only creates the node pools with 'connection_pool_class' for clients
+    # created from a URL, and gives the others its default pool, so the first node
+    # is passed as one
+    first, *others = startup_nodes
+    return RedisCluster(
+        url=f"redis://{first.host}:{first.port}",
+        startup_nodes=others,
+        password=password,
+        decode_responses=True,
+        socket_timeout=settings.socket_timeout,
+        socket_connect_timeout=settings.socket_connect_timeout,
+        retry=settings.retry(),
+        max_connections=settings.max_connections,
+        connection_pool_class=functools.partial(
+            MeteredConnectionPool, metrics, timeout=settings.pool_timeout
+        ),
+    )
+
+
+def create_standalone_client(url, settings, metrics):
+    """
+    Client of a single Redis server, e.g. a local redis-server in development.
+    """
+    pool = MeteredConnectionPool.from_url(
+        url,
+        metrics=metrics,
+        timeout=settings.pool_timeout,
+        max_connections=settings.max_connections,
+        socket_timeout=settings.socket_timeout,
+        socket_connect_timeout=settings.socket_connect_timeout,
+        retry=settings.retry(),
+        decode_responses=True,
+    )
+    return Redis(connection_pool=pool)
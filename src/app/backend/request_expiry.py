@@ -0,0 +1,58 @@
+import logging
+import math
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RequestExpiry:
+    """
+    Expires the pending chat requests that have not been answered by their deadline,
+    so that the requester can send a new one.
+
+    Every 'interval' seconds the pod removes the requests that are due, at most about
+    'batch_size' of them per pass, and tells each requester that their request timed
+    out. The deadlines are kept in a time-ordered index, so a pass only touches the
+    requests that are due, and no timer is kept per request. All the pods expire
+    requests, and each request is claimed by one of them.
+    """
+
+    def __init__(self, server, manager, interval=1.0, batch_size=500):
+        self.server = server
+        self.manager = manager
+        self.interval = interval
+        self.batch_size = batch_size
+        self.expired = 0
+
+    def start(self):
+        self.server.start_background_task(self._run)
+
+    def _run(self):
+        # spread the passes of the pods over the interval
+        self.server.sleep(random.uniform(0, self.interval))
+        while True:
+            try:
+                self.expire()
+            except Exception:
+                logger.exception("Failed to expire pending chat requests")
+            self.server.sleep(self.interval)
+
+    def expire(self):
+        limit = max(1, math.ceil(self.batch_size / self.manager.num_partitions))
+        expired = self.manager.expire_pending_requests(time.time(), limit)
+        for from_username, to_username in expired:
+            logger.info(
+                "Chat request from '%s' to '%s' timed out", from_username, to_username
+            )
+            self.server.emit(
+                "chat_response",
+                {
+                    "accepted": False,
+                    "timed_out": True,
+                    "message": "Chat request timed out",
+                },
+                room=from_username,
+            )
+        self.expired += len(expired)
+        return expired
@@ -0,0 +1,289 @@
+import bisect
+import collections
+import itertools
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+ROSTER_KEY = "lobby_roster{lobby_roster}"
+ROSTER_VERSION_KEY = "lobby_roster_version{lobby_roster}"
+
+# Applies a batch of (op, username) changes to the roster set. The version is bumped
+# once per change that actually modified the set, and the effective changes are
+# returned as a flat [version, op, username, ...] list.
+_APPLY_SCRIPT = """
+local applied = {}
+for i = 1, #ARGV, 2 do
+    local op, username = ARGV[i], ARGV[i + 1]
+    local changed
+    if op == "add" then
+        changed = redis.call("SADD", KEYS[1], username)
+    else
+        changed = redis.call("SREM", KEYS[1], username)
+    end
+    if changed == 1 then
+        table.insert(applied, redis.call("INCR", KEYS[2]))
+        table.insert(applied, op)
+        table.insert(applied, username)
+    end
+end
+return applied
+"""
+
+_SNAPSHOT_SCRIPT = """
+return {redis.call("GET", KEYS[2]) or false, redis.call("SMEMBERS", KEYS[1])}
+"""
+
+
+class LobbyRoster:
+    """
+    Per-pod materialized view of the users in the lobby.
+
+    The authoritative roster is a single Redis set with a version counter, both
+    updated atomically by a Lua script. Every effective change bumps the version and
+    is published to the other pods as a delta, so each pod keeps its in-memory copy
+    current without reading Redis. A pod only fetches the snapshot on cold start, or
+    when it detects a gap in the delta sequence that does not close in time.
+
+    The last 'history_size' applied deltas are kept, so that the changes since a
+    recent version can be handed out without a snapshot. The users are also kept in
+    sorted order, so that pages of the lobby and users with a given prefix are found
+    by bisection instead of by going through the whole lobby.
+    """
+
+    def __init__(
+        self, redis, seed=None, max_pending=64, gap_timeout=2.0, history_size=1024
+    ):
+        self.redis = redis
+        self.seed = seed
+        self.max_pending = max_pending
+        self.gap_timeout = gap_timeout
+        self.version = 0
+        self._users = set()
+        self._sorted = []
+        self._pending = {}
+        self._history = collections.deque(maxlen=history_size)
+        self._gap_since = None
+        self._loaded = False
+        self._publish = None
+        self._listeners = []
+        self._apply_script = redis.register_script(_APPLY_SCRIPT)
+        self._snapshot_script = redis.register_script(_SNAPSHOT_SCRIPT)
+
+    def bind(self, client_manager):
+        """
+        Exchange roster deltas with the other pods through the client manager.
+        """
+        client_manager.on_internal("roster_delta", self._apply_deltas)
+        self._publish = lambda deltas: client_manager.publish_internal(
+            "roster_delta", deltas
+        )
+
+    def add_listener(self, listener):
+        """
+        Register a callback that receives the (version, op, username) deltas of the
+        changes made by this pod.
+        """
+        self._listeners.append(listener)
+
+    def list_users(self):
+        return self.snapshot()[1]
+
+    def snapshot(self):
+        if not self._loaded or self._gap_expired():
+            self.load_snapshot()
+        return self.version, list(self._users)
+
+    def page(self, prefix="", after=None, offset=0, limit=50):
+        """
+        Return a page of at most 'limit' users with the prefix in sorted order, either
+        those after the username 'after' (the cursor of the previous page) or those
+        from the 'offset'th user with the prefix on. The page tells the roster version
+        it was taken at, the offset of its first user, the total number of users with
+        the prefix, and the cursor of the next page, or None if it was the last one.
+        """
+        if not self._loaded or self._gap_expired():
+            self.load_snapshot()
+        low, high = self._prefix_range(prefix)
+        if after is not None:
+            start = bisect.bisect_right(self._sorted, after, low, high)
+        else:
+            start = min(low + max(offset, 0), high)
+        end = min(start + limit, high)
+        users = self._sorted[start:end]
+        return {
+            "seq": self.version,
+            "users": users,
+            "offset": start - low,
+            "total": high - low,
+            "next": users[-1] if users and end < high else None,
+        }
+
+    def count(self, prefix=""):
+        if not self._loaded or self._gap_expired():
+            self.load_snapshot()
+        low, high = self._prefix_range(prefix)
+        return self.version, high - low
+
+    def _prefix_range(self, prefix):
+        if not prefix:
+            return 0, len(self._sorted)
+        low = bisect.bisect_left(self._sorted, prefix)
+        # every string with the prefix sorts before the prefix followed by the
+        # highest code point
+        high = bisect.bisect_left(self._sorted, prefix + chr(0x10FFFF), low)
+        return low, high
+
+    def deltas_since(self, version):
+        """
+        Return the (version, op, username) deltas applied after the version, or None
+        if they are no longer all in the history.
+        """
+        missing = self.version - version
+        if missing <= 0:
+            return []
+        if missing > len(self._history):
+            return None
+        return list(
+            itertools.islice(self._history, len(self._history) - missing, None)
+        )
+
+    def add(self, username):
+        return self.apply([("add", username)])
+
+    def remove(self, username):
+        return self.apply([("remove", username)])
+
+    def apply(self, changes):
+        """
+        Apply (op, username) changes to the shared roster in a single round trip and
+        return the effective ones as (version, op, username) deltas.
+        """
+        if not changes:
+            return []
+        args = [item for change in changes for item in change]
+        result = self._apply_script(keys=[ROSTER_KEY, ROSTER_VERSION_KEY], args=args)
+        deltas = [
+            (int(result[i]), result[i + 1], result[i + 2])
+            for i in range(0, len(result), 3)
+        ]
+        if deltas:
+            self._apply_deltas(deltas)
+            if self._publish:
+                self._publish(deltas)
+            for listener in self._listeners:
+                listener(deltas)
+        return deltas
+
+    def differences(self):
+        """
+        Return the set of (op, username) changes that would make the shared roster
+        match the lobby partitions, which are authoritative.
+        """
+        roster = set(self.redis.smembers(ROSTER_KEY))
+        lobby = set(self.seed())
+        return {("add", username) for username in lobby - roster} | {
+            ("remove", username) for username in roster - lobby
+        }
+
+    def load_snapshot(self):
+        version, users = self._snapshot_script(keys=[ROSTER_KEY, ROSTER_VERSION_KEY])
+        if version is None and self.seed:
+            # the shared roster has never been written, build it from the lobby
+            # partitions once; SADD keeps concurrent seeding by several pods harmless
+            logger.info("Seeding lobby roster from lobby partitions")
+            self.apply([("add", username) for username in self.seed()])
+            version, users = self._snapshot_script(
+                keys=[ROSTER_KEY, ROSTER_VERSION_KEY]
+            )
+        self._users = set(users)
+        self._sorted = sorted(self._users)
+        self.version = int(version or 0)
+        # the deltas before the snapshot may have gaps, so start the history over
+        self._history.clear()
+        self._pending = {v: d for v, d in self._pending.items() if v > self.version}
+        self._gap_since = None
+        self._loaded = True
+        self._drain()
+        logger.info("Loaded lobby roster snapshot at version %s", self.version)
+
+    def _apply_deltas(self, deltas):
+        for version, op, username in deltas:
+            if version > self.version:
+                self._pending[version] = (op, username)
+        self._drain()
+        if len(self._pending) > self.max_pending:
+            logger.warning("Too many out-of-order roster deltas, reloading snapshot")
+            self.load_snapshot()
+
+    def _drain(self):
+        while self.version + 1 in self._pending:
+            op, username = self._pending.pop(self.version + 1)
+            if op == "add":
+                if username not in self._users:
+                    self._users.add(username)
+                    bisect.insort(self._sorted, username)
+            elif username in self._users:
+                self._users.discard(username)
+                del self._sorted[bisect.bisect_left(self._sorted, username)]
+            self.version += 1
+            self._history.append((self.version, op, username))
+        if not self._pending:
+            self._gap_since = None
+        elif self._gap_since is None:
+            self._gap_since = time.monotonic()
+
+    def _gap_expired(self):
+        return (
+            self._gap_since is not None
+            and time.monotonic() - self._gap_since > self.gap_timeout
+        )
+
+
+class RosterReconciler:
+    """
+    Repairs the shared roster where it disagrees with the lobby partitions. Every
+    transition writes its partition and the roster in separate round trips, so a pod
+    that dies between the two would leave them apart for good.
+
+    Every 'interval' seconds the pod compares the two and applies the differences it
+    also found on its previous pass, so that the transitions whose roster write is
+    still on its way are left alone. Each pass reads the whole lobby from Redis.
+    """
+
+    def __init__(self, server, roster, interval=60.0):
+        self.server = server
+        self.roster = roster
+        self.interval = interval
+        self.repaired = {"add": 0, "remove": 0}
+        self._suspects = set()
+
+    def start(self):
+        self.server.start_background_task(self._run)
+
+    def _run(self):
+        # spread the passes of the pods over the interval
+        self.server.sleep(random.uniform(0, self.interval))
+        while True:
+            try:
+                self.reconcile()
+            except Exception:
+                logger.exception("Failed to reconcile the lobby roster")
+            self.server.sleep(self.interval)
+
+    def reconcile(self):
+        """
+        Apply the differences found on this pass and the previous one, and return the
+        resulting (version, op, username) deltas.
+        """
+        differences = self.roster.differences()
+        confirmed = differences & self._suspects
+        self._suspects = differences - confirmed
+        deltas = self.roster.apply(sorted(confirmed))
+        for _, op, _ in deltas:
+            self.repaired[op] += 1
+        if deltas:
+            logger.warning("Repaired %s lobby roster entries", len(deltas))
+        return deltas
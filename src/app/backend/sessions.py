@@ -0,0 +1,79 @@
+class SocketSession:
+    """
+    Identity of a connected socket, established once when it connects.
+    """
+
+    __slots__ = ("sid", "username", "room_id", "in_lobby")
+
+    def __init__(self, sid, username):
+        self.sid = sid
+        self.username = username
+        self.room_id = None
+        self.in_lobby = False
+
+
+class SessionRegistry:
+    """
+    Sessions of the sockets connected to this pod. Handlers read the user and room of
+    a socket from here instead of taking them from every payload and re-validating
+    them against Redis.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._room_members = {}  # room_id -> members stored for the room in Redis
+        self._room_sessions = {}  # room_id -> local sessions in the room
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def count_rooms(self):
+        return len({session.room_id for session in self if session.room_id})
+
+    def open(self, sid, username):
+        session = SocketSession(sid, username)
+        self._sessions[sid] = session
+        return session
+
+    def get(self, sid):
+        return self._sessions.get(sid)
+
+    def close(self, sid):
+        session = self._sessions.pop(sid, None)
+        if session is not None:
+            self._unindex(session)
+        return session
+
+    def enter_room(self, session, room_id, members):
+        self._unindex(session)
+        session.room_id = room_id
+        self._room_members[room_id] = members
+        self._room_sessions.setdefault(room_id, set()).add(session)
+
+    def leave_room(self, session):
+        self._unindex(session)
+        session.room_id = None
+
+    def _unindex(self, session):
+        room_id = session.room_id
+        local = self._room_sessions.get(room_id)
+        if local is None:
+            return
+        local.discard(session)
+        if not local:
+            del self._room_sessions[room_id]
+            del self._room_members[room_id]
+
+    def all_members_local(self, room_id):
+        """
+        Whether every member of the room has a socket in it on this pod, in which case
+        a message to the room need not go through the message queue.
+        """
+        local = self._room_sessions.get(room_id)
+        if not local:
+            return False
+        usernames = {session.username for session in local}
+        return all(member in usernames for member in self._room_members[room_id])
@@ -1,225 +1,486 @@
-import hashlib
-import json
 import logging
+import time
 import uuid
+from collections import namedtuple
 
 from redis.cluster import ClusterNode, RedisCluster
 
+import encoding
+from lua_scripts import ClusterScripts
+from roster import LobbyRoster
+
 logger = logging.getLogger(__name__)
 
+PartitionKeys = namedtuple(
+    "PartitionKeys",
+    [
+        "users",
+        "lobby",
+        "user_rooms",
+        "chatrooms",
+        "requests",
+        "incoming_requests",
+        "sockets",
+        "presence",
+        "request_deadlines",
+    ]
+)
+
 
 class RedisChatManager:
-    def __init__(self, startup_nodes, password, num_partitions=100):
-        self.redis = RedisCluster(
+    def __init__(
+        self,
+        startup_nodes=None,
+        password=None,
+        num_partitions=100,
+        client=None,
+        partitioner="md5",
+        codec="compact",
+        request_ttl=30.0,
+    ):
+        self.redis = client or RedisCluster(
             startup_nodes=startup_nodes,
             password=password,
             decode_responses=True
         )
         self.num_partitions = num_partitions
+        self.partitioner = encoding.get_partitioner(partitioner, num_partitions)
+        self.codec = encoding.get_codec(codec)
+        self.request_ttl = request_ttl
+        self.roster = LobbyRoster(self.redis, seed=self._scan_lobby_partitions)
+        self.scripts = ClusterScripts(self.redis)
 
     def _get_partition(self, key):
         """
-        Convert the input key (username, room_id, etc.) to a numerical representation
-        and take a modulo of the number of partitions. This function can be reused for
-        both users and chatrooms.
+        Map the input key (username, room_id, etc.) to a partition with the configured
+        partitioner. Changing the partitioner moves every key to another partition, so
+        it can only be changed on an empty user state.
+        """
+        return self.partitioner(key)
+
+    def _partition_keys(self, username):
+        """
+        Keys of the partition that holds the user's state. They share a hash tag, so
+        they live in the same cluster slot and can be updated together by one script.
         """
-        key_hash = int(hashlib.md5(key.encode()).hexdigest(), 16)
-        return key_hash % self.num_partitions
+        return self._keys_of_partition(self._get_partition(username), username)
+
+    def _keys_of_partition(self, partition, username=""):
+        return PartitionKeys(
+            users=f"connected_users{{partition_{partition}}}",
+            lobby=f"users_in_lobby{{partition_{partition}}}",
+            user_rooms=f"user_rooms{{partition_{partition}}}",
+            chatrooms=f"chatrooms{{partition_{partition}}}",
+            requests=f"pending_requests{{partition_{partition}}}",
+            # the hash tag must come before the username, which may contain braces
+            incoming_requests=f"incoming_requests{{partition_{partition}}}:{username}",
+            sockets=f"user_sockets{{partition_{partition}}}",
+            presence=f"presence{{partition_{partition}}}",
+            request_deadlines=f"request_deadlines{{partition_{partition}}}",
+        )
 
     # ==================== Connected Users ====================
 
     def add_user(self, username):
-        partition = self._get_partition(username)
+        keys = self._partition_keys(username)
         user_data = {
             "username": username,
             "in_room": False
         }
-        self.redis.hset(
-            f"connected_users{{users_partition_{partition}}}",
-            username,
-            _to_json(user_data)
-        )
-        self.redis.sadd(f"users_in_lobby{{lobby_partition_{partition}}}", username)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(keys.users, username, self.codec.encode_user(user_data))
+        pipeline.sadd(keys.lobby, username)
+        pipeline.zadd(keys.presence, {username: time.time()})
+        pipeline.execute()
+        self.roster.add(username)
 
     def remove_user(self, username):
-        partition = self._get_partition(username)
-        self.redis.hdel(f"connected_users{{users_partition_{partition}}}", username)
-        self.redis.srem(f"users_in_lobby{{lobby_partition_{partition}}}", username)
+        keys = self._partition_keys(username)
+        [in_lobby] = self.scripts.run([("remove_user", keys, [username])])
+        if in_lobby:
+            self.roster.remove(username)
         self.remove_all_pending_requests(username)
 
     def get_user(self, username):
-        partition = self._get_partition(username)
-        user_data = self.redis.hget(
-            f"connected_users{{users_partition_{partition}}}", username
-        )
-        return _from_json(user_data) if user_data else None
+        keys = self._partition_keys(username)
+        user_data = self.redis.hget(keys.users, username)
+        return self.codec.decode_user(username, user_data) if user_data else None
 
     def list_users_in_lobby(self):
+        """
+        Served from the pod-local roster, which costs no Redis round trips unless the
+        roster needs to be (re)loaded.
+        """
+        return self.roster.list_users()
+
+    def page_users_in_lobby(self, prefix="", after=None, offset=0, limit=50):
+        """
+        A page of the lobby in username order, see LobbyRoster.page. Also served from
+        the pod-local roster.
+        """
+        return self.roster.page(prefix, after, offset, limit)
+
+    def count_users_in_lobby(self, prefix=""):
+        return self.roster.count(prefix)
+
+    def _scan_lobby_partitions(self):
         all_users = []
         for partition in range(self.num_partitions):
             users_in_partition = self.redis.smembers(
-                f"users_in_lobby{{lobby_partition_{partition}}}"
+                f"users_in_lobby{{partition_{partition}}}"
             )
             all_users.extend(users_in_partition)
         return all_users
 
-    # ==================== Chatrooms ====================
-
-    def create_chatroom(self, user1, user2):
-        room_id = str(uuid.uuid4())
-        chatroom = {
-            "id": room_id,
-            "users": [user1["username"], user2["username"]]
-        }
-        user1["in_room"] = True
-        user2["in_room"] = True
-
-        user_partition1 = self._get_partition(user1["username"])
-        user_partition2 = self._get_partition(user2["username"])
-        room_partition = self._get_partition(room_id)
+    # ==================== Presence ====================
 
+    def touch_users(self, usernames, now=None):
+        """
+        Mark the users as seen now, in a single round trip. Users that are no longer
+        tracked, e.g. because they were reaped meanwhile, are not added back.
+        """
+        now = time.time() if now is None else now
+        by_partition = {}
+        for username in usernames:
+            key = self._partition_keys(username).presence
+            by_partition.setdefault(key, {})[username] = now
+        if not by_partition:
+            return
         pipeline = self.redis.pipeline()
-        pipeline.hset(
-            f"chatrooms{{room_partition_{room_partition}}}", room_id, _to_json(chatroom)
-        )
-        pipeline.srem(
-            f"users_in_lobby{{lobby_partition_{user_partition1}}}", user1["username"]
-        )
-        pipeline.srem(
-            f"users_in_lobby{{lobby_partition_{user_partition2}}}", user2["username"]
-        )
-        pipeline.hset(
-            f"connected_users{{users_partition_{user_partition1}}}",
-            user1["username"],
-            _to_json(user1)
-        )
-        pipeline.hset(
-            f"connected_users{{users_partition_{user_partition2}}}",
-            user2["username"],
-            _to_json(user2)
-        )
+        for key, mapping in by_partition.items():
+            pipeline.zadd(key, mapping, xx=True)
         pipeline.execute()
 
-        return chatroom
-    
-    def get_chatroom(self, room_id):
-        partition = self._get_partition(room_id)
-        room_data = self.redis.hget(f"chatrooms{{room_partition_{partition}}}", room_id)
-        return _from_json(room_data) if room_data else None
-    
-    def leave_chatroom(self, username, room_id):
-        user = self.get_user(username)
-        chatroom = self.get_chatroom(room_id)
+    def reap_expired_users(self, cutoff, limit_per_partition):
+        """
+        Remove the users last seen before 'cutoff', at most 'limit_per_partition' from
+        each partition, along with their copy of the room they are in, their socket
+        counter and their pending requests. Returns the reaped users as (username,
+        room_id or None) pairs and the number of pending requests removed.
+        """
+        results = self.scripts.run([
+            ("reap_expired", self._keys_of_partition(partition), [
+                cutoff, limit_per_partition
+            ])
+            for partition in range(self.num_partitions)
+        ])
+        reaped = [
+            (result[i], result[i + 1] or None, result[i + 2])
+            for result in results
+            for i in range(0, len(result), 3)
+        ]
+        if not reaped:
+            return [], 0
+        self.roster.apply([
+            ("remove", username) for username, _, in_lobby in reaped if in_lobby
+        ])
+        usernames = [username for username, _, _ in reaped]
+        return (
+            [(username, room_id) for username, room_id, _ in reaped],
+            self.remove_all_pending_requests(*usernames),
+        )
+
+    def track_untracked_users(self, partition, cursor=0, count=100):
+        """
+        Start tracking the presence of the users in a partition who have none yet,
+        such as those added before presence was tracked, as if they were seen now.
+        Goes through about 'count' users at a time and returns the cursor of the next
+        ones, which is 0 once the whole partition has been gone through, and the number
+        of users gone through.
+        """
+        keys = self._keys_of_partition(partition)
+        cursor, users = self.redis.hscan(keys.users, cursor, count=count)
+        if users:
+            self.redis.zadd(keys.presence, dict.fromkeys(users, time.time()), nx=True)
+        return cursor, len(users)
 
-        user_partition = self._get_partition(username)
-        room_partition = self._get_partition(room_id)
+    # ==================== Sockets ====================
 
-        user["in_room"] = False
+    def add_socket(self, username):
+        """
+        Count a socket connected by the user on any pod. Returns the number of sockets
+        the user now has.
+        """
+        keys = self._partition_keys(username)
+        return self.redis.hincrby(keys.sockets, username, 1)
 
-        pipeline = self.redis.pipeline()
-        pipeline.sadd(f"users_in_lobby{{lobby_partition_{user_partition}}}", username)
-        pipeline.hset(
-            f"connected_users{{users_partition_{user_partition}}}",
-            username,
-            _to_json(user)
+    def remove_socket(self, username):
+        """
+        Returns the number of sockets the user still has connected.
+        """
+        keys = self._partition_keys(username)
+        [remaining] = self.scripts.run([("remove_socket", keys, [username])])
+        return remaining
+
+    def count_sockets(self, username):
+        keys = self._partition_keys(username)
+        return int(self.redis.hget(keys.sockets, username) or 0)
+
+    # ==================== Chatrooms ====================
+
+    def create_chatroom(self, user1, user2):
+        """
+        Move both users from the lobby into a new chatroom. Returns None if either of
+        them is no longer available, in which case neither ends up in the room.
+        """
+        return self._open_chatroom(user1["username"], user2["username"])
+
+    def accept_chat_request(self, from_username, to_username):
+        """
+        Consume the pending chat request from 'from_username' to 'to_username' and move
+        both users into a new chatroom. Returns None if the request is no longer pending
+        or either user is no longer available.
+        """
+        request_data = {
+            "from_username": from_username,
+            "to_username": to_username
+        }
+        return self._open_chatroom(
+            from_username, to_username, encoding.request_encodings(request_data)
         )
 
-        chatroom["users"].remove(username)
-        if not chatroom["users"]:
-            pipeline.hdel(f"chatrooms{{room_partition_{room_partition}}}", room_id)
-        else:
-            pipeline.hset(
-                f"chatrooms{{room_partition_{room_partition}}}",
-                room_id,
-                _to_json(chatroom)
+    def _open_chatroom(self, username1, username2, request_encodings=()):
+        """
+        Each user's part of the transition runs atomically as one script in the user's
+        own partition, and both scripts are sent in a single round trip. Every user
+        keeps a copy of the chatroom in their partition for as long as they are in it.
+
+        'request_encodings' are the encodings of the request from the first user to the
+        second that must still be pending, one per codec that may have stored it.
+        """
+        room_id = str(uuid.uuid4())
+        chatroom = {
+            "id": room_id,
+            "users": [username1, username2]
+        }
+        room_data = self.codec.encode_room(chatroom)
+
+        user_data1 = self.codec.encode_user({"username": username1, "in_room": True})
+        user_data2 = self.codec.encode_user({"username": username2, "in_room": True})
+        keys1 = self._partition_keys(username1)
+        keys2 = self._partition_keys(username2)
+        results = self.scripts.run([
+            (
+                "enter_room",
+                keys1,
+                [username1, user_data1, room_id, room_data, "", *request_encodings]
+            ),
+            (
+                "enter_room",
+                keys2,
+                [
+                    username2,
+                    user_data2,
+                    room_id,
+                    room_data,
+                    username1 if request_encodings else "",
+                ]
+            ),
+        ])
+
+        if results != ["ok", "ok"]:
+            logger.warning(
+                "Could not open chatroom between '%s' and '%s': %s",
+                username1,
+                username2,
+                results,
             )
+            # put back whoever already made it into the room; the roster still has
+            # them in the lobby, unless they were removed meanwhile
+            entered = [
+                username
+                for username, result in zip((username1, username2), results)
+                if result == "ok"
+            ]
+            if entered:
+                rollback = self.scripts.run([
+                    self._leave_room_call(username, room_id) for username in entered
+                ])
+                self.roster.apply([
+                    ("remove", username)
+                    for username, result in zip(entered, rollback)
+                    if result == "no_user"
+                ])
+            if request_encodings and results[0] == "ok":
+                # the request was consumed, but the second user's part, which drops
+                # it from their reverse index, did not run
+                self.redis.srem(keys2.incoming_requests, username1)
+            return None
+
+        self.roster.apply([("remove", username1), ("remove", username2)])
+        return chatroom
 
-        pipeline.execute()
+    def get_chatroom(self, room_id, username):
+        """
+        Return the user's copy of the chatroom, or None if they are not in it.
+        """
+        keys = self._partition_keys(username)
+        room_data = self.redis.hget(keys.chatrooms, room_id)
+        return self.codec.decode_room(room_id, room_data) if room_data else None
+
+    def leave_chatroom(self, username, room_id):
+        """
+        Move the user from the chatroom back to the lobby. Returns False if the user
+        was not in the chatroom.
+        """
+        [result] = self.scripts.run([self._leave_room_call(username, room_id)])
+        if result == "not_in_room":
+            return False
+        # users removed while they were in the room do not go back to the lobby
+        if result == "ok":
+            self.roster.add(username)
+        return True
+
+    def _leave_room_call(self, username, room_id):
+        user_data = self.codec.encode_user({"username": username, "in_room": False})
+        keys = self._partition_keys(username)
+        return ("leave_room", keys, [username, user_data, room_id])
 
     # ==================== Pending Requests ====================
 
     def add_pending_request(self, from_username, to_username):
-        partition = self._get_partition(from_username)
+        """
+        Store the request with a deadline 'request_ttl' seconds from now, after which
+        expire_pending_requests removes it unless it has been answered.
+        """
         request_data = {
             "from_username": from_username,
             "to_username": to_username
         }
-        self.redis.hset(
-            f"pending_requests{{requests_partition_{partition}}}",
-            from_username,
-            _to_json(request_data)
+        keys = self._partition_keys(from_username)
+        pipeline = self.redis.pipeline()
+        pipeline.hset(
+            keys.requests, from_username, self.codec.encode_request(request_data)
         )
+        pipeline.zadd(
+            keys.request_deadlines, {from_username: time.time() + self.request_ttl}
+        )
+        pipeline.sadd(
+            self._partition_keys(to_username).incoming_requests, from_username
+        )
+        pipeline.execute()
 
     def get_pending_request(self, from_username):
-        partition = self._get_partition(from_username)
-        request_data = self.redis.hget(
-            f"pending_requests{{requests_partition_{partition}}}", from_username
+        keys = self._partition_keys(from_username)
+        request_data = self.redis.hget(keys.requests, from_username)
+        if not request_data:
+            return None
+        return self.codec.decode_request(from_username, request_data)
+
+    def remove_pending_request(self, from_username, to_username=None):
+        if to_username is None:
+            request = self.get_pending_request(from_username)
+            if not request:
+                return
+            to_username = request["to_username"]
+        keys = self._partition_keys(from_username)
+        pipeline = self.redis.pipeline()
+        pipeline.hdel(keys.requests, from_username)
+        pipeline.zrem(keys.request_deadlines, from_username)
+        pipeline.srem(
+            self._partition_keys(to_username).incoming_requests, from_username
         )
-        return _from_json(request_data) if request_data else None
+        pipeline.execute()
 
-    def remove_pending_request(self, from_username):
-        partition = self._get_partition(from_username)
-        self.redis.hdel(
-            f"pending_requests{{requests_partition_{partition}}}", from_username
-        )
+    def remove_all_pending_requests(self, *usernames):
+        """
+        Remove all pending requests for the users, including requests made by or to
+        them. The request made by a user is found from their own partition, and the
+        requests made to them from the reverse index of senders, so the cost only
+        depends on the number of requests involving the users, and takes at most two
+        round trips however many users there are. Returns the number of requests
+        removed.
+        """
+        pipeline = self.redis.pipeline()
+        for username in usernames:
+            keys = self._partition_keys(username)
+            pipeline.hget(keys.requests, username)
+            pipeline.smembers(keys.incoming_requests)
+        results = pipeline.execute()
 
-    def remove_all_pending_requests(self, username):
+        removed = set()  # senders, who have at most one pending request each
+        pipeline = self.redis.pipeline()
+        for i, username in enumerate(usernames):
+            outgoing_request, senders = results[2 * i], results[2 * i + 1]
+            if not outgoing_request and not senders:
+                continue
+            keys = self._partition_keys(username)
+            if outgoing_request:
+                request = self.codec.decode_request(username, outgoing_request)
+                pipeline.hdel(keys.requests, username)
+                pipeline.zrem(keys.request_deadlines, username)
+                pipeline.srem(
+                    self._partition_keys(request["to_username"]).incoming_requests,
+                    username
+                )
+                removed.add(username)
+            for from_username in senders:
+                sender_keys = self._partition_keys(from_username)
+                pipeline.hdel(sender_keys.requests, from_username)
+                pipeline.zrem(sender_keys.request_deadlines, from_username)
+            pipeline.delete(keys.incoming_requests)
+            removed.update(senders)
+        if removed:
+            pipeline.execute()
+        return len(removed)
+
+    def expire_pending_requests(self, now=None, limit_per_partition=100):
         """
-        Remove all pending requests for a user, including requests made by or to them.
-        To achieve this, we need to search across all partitions and find any requests where
-        the user is either the 'from_username' or the 'to_username'.
+        Remove the pending requests whose deadline has passed, at most
+        'limit_per_partition' from each partition, and return them as (from_username,
+        to_username) pairs. The deadlines are kept in a sorted set per partition, so
+        this only touches requests that are due. Takes two round trips when requests
+        expire and one when none do.
         """
-        for partition in range(self.num_partitions):
-            key = f"pending_requests{{requests_partition_{partition}}}"
-            pending_requests = self.redis.hgetall(key)
-            for from_username, request_data in pending_requests.items():
-                request = _from_json(request_data)
-                if (
-                    request["from_username"] == username 
-                    or request["to_username"] == username
-                ):
-                    self.redis.hdel(key, from_username)
+        now = time.time() if now is None else now
+        results = self.scripts.run([
+            ("expire_requests", self._keys_of_partition(partition), [
+                now, limit_per_partition
+            ])
+            for partition in range(self.num_partitions)
+        ])
+        expired = [
+            self.codec.decode_request(result[i], result[i + 1])
+            for result in results
+            for i in range(0, len(result), 2)
+        ]
+        if not expired:
+            return []
+        pipeline = self.redis.pipeline()
+        for request in expired:
+            pipeline.srem(
+                self._partition_keys(request["to_username"]).incoming_requests,
+                request["from_username"],
+            )
+        pipeline.execute()
+        return [
+            (request["from_username"], request["to_username"]) for request in expired
+        ]
 
     # ==================== Authorization ====================
 
     def user_authorized_in_room(self, username, room_id):
-        user = self.get_user(username)
-        chatroom = self.get_chatroom(room_id)
-        if not user:
-            logger.warning(
-                f"Unauthorized access for user '{username}' to room '{room_id}' due to "
-                "user not found"
-            )
-            return False
-        if not chatroom:
+        # a user who is in no room has no room id either, which must not match
+        if not isinstance(room_id, str) or not room_id or not isinstance(username, str):
             logger.warning(
-                f"Unauthorized access for user '{username}' to room '{room_id}' due to "
-                "chatroom not found"
+                "Unauthorized access for user '%s' to room '%s' due to a missing user "
+                "or room",
+                username,
+                room_id,
             )
             return False
-        if username not in chatroom["users"]:
+        keys = self._partition_keys(username)
+        if self.redis.hget(keys.user_rooms, username) != room_id:
             logger.warning(
-                f"Unauthorized access for user '{username}' to room '{room_id}' due to "
-                "user not found in chatroom members: {chatroom['users']}"
+                "Unauthorized access for user '%s' to room '%s' due to user not being "
+                "a member of the chatroom",
+                username,
+                room_id,
             )
             return False
         return True
 
 
-def _to_json(data):
-    try:
-        return json.dumps(data)
-    except (TypeError, ValueError) as e:
-        raise ValueError(f"Failed to serialize data: {repr(e)}")
-
-
-def _from_json(data):
-    try:
-        return json.loads(data)
-    except (TypeError, ValueError) as e:
-        raise ValueError(f"Failed to deserialize data: {repr(e)}")
-
-
 def get_startup_nodes(num_replicas, pod_name_prefix, service_name, namespace, port):
     startup_nodes = []
     for i in range(num_replicas):
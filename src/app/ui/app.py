@@ -5,7 +5,15 @@ import sys
 import requests
 from flask import Flask, redirect, render_template, request, session, url_for
 
-backend_url = os.environ["BACKEND_URL"]
+from backend_client import BackendClient
+
+backend = BackendClient(
+    os.environ["BACKEND_URL"],
+    pool_size=int(os.environ.get("BACKEND_POOL_SIZE", 10)),
+    connect_timeout=float(os.environ.get("BACKEND_CONNECT_TIMEOUT", 1.0)),
+    read_timeout=float(os.environ.get("BACKEND_READ_TIMEOUT", 5.0)),
+    room_access_ttl=float(os.environ.get("ROOM_ACCESS_CACHE_SECONDS", 5.0)),
+)
 
 app = Flask(__name__)
 app.config["ENV"] = os.environ["FLASK_ENV"]
@@ -31,12 +39,20 @@ def check_username():
     username = request.form.get("username")
     logger.info(f"Checking availability for username '{username}'")
 
-    response = requests.post(
-        f"{backend_url}/api/check_username", json={"username": username}
-    )
-    data = response.json()
+    try:
+        available = backend.username_available(username)
+    except requests.RequestException as e:
+        if e.response is not None and e.response.status_code == 400:
+            logger.info(f"Username {username!r} is not valid.")
+            return render_template(
+                "home.html", error="Invalid username. Please choose another."
+            )
+        logger.error(f"Could not check username '{username}': {e}")
+        return render_template(
+            "home.html", error="Could not reach the server. Please try again."
+        ), 503
 
-    if not data["available"]:
+    if not available:
         logger.info(f"Username '{username}' is already taken.")
         return render_template(
             "home.html", error="Username is already taken. Please choose another."
@@ -70,13 +86,19 @@ def chat_room():
 
     logger.info(f"User '{username}' attempting to access room '{room_id}'")
 
-    response = requests.post(
-        f"{backend_url}/api/verify_room_access",
-        json={"room_id": room_id, "username": username}
-    )
-    data = response.json()
+    try:
+        user_exists, authorized = backend.check_room_page(username, room_id)
+    except requests.RequestException as e:
+        logger.error(f"Could not verify access of '{username}' to '{room_id}': {e}")
+        return render_template(
+            "home.html", error="Could not reach the server. Please try again."
+        ), 503
+
+    if not user_exists:
+        logger.warning(f"User '{username}' no longer exists. Redirecting to index.")
+        return redirect(url_for("index"))
 
-    if not data.get("authorized"):
+    if not authorized:
         logger.warning(
             f"Unauthorized access attempt by user '{username}' to room '{room_id}'"
         )
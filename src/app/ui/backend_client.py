@@ -0,0 +1,86 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class BackendClient:
+    """
+    Client of the backend's HTTP API over a pool of keep-alive connections, so that a
+    page load does not pay for a new TCP connection to the backend.
+
+    A chat room page that was granted, to an existing user with access to the room,
+    is remembered for 'room_access_ttl' seconds, as the page is loaded again on every
+    reconnect. Denials are never cached, because the room of a just accepted chat
+    request may only become visible moments later. The backend checks the user and
+    the room again when the socket joins the room, so a user or grant that is gone
+    within the TTL only renders a page that then cannot join.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        pool_size=10,
+        connect_timeout=1.0,
+        read_timeout=5.0,
+        room_access_ttl=5.0,
+        max_cached=10000,
+    ):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.room_access_ttl = room_access_ttl
+        self.max_cached = max_cached
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._room_access = {}  # (username, room_id) -> expires at
+        self._lock = threading.Lock()
+
+    def _post(self, path, payload):
+        response = self.session.post(
+            f"{self.base_url}{path}", json=payload, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def username_available(self, username):
+        return self._post("/api/check_username", {"username": username})["available"]
+
+    def validate(self, checks):
+        """
+        Run several checks in one call to the backend, e.g.
+        [{"check": "room_access", "username": ..., "room_id": ...}], and return their
+        results as booleans in the same order.
+        """
+        return self._post("/api/validate", {"checks": checks})["results"]
+
+    def check_room_page(self, username, room_id):
+        """
+        Return whether the user still exists and may access the room, from the cache
+        when the page was granted recently.
+        """
+        key = (username, room_id)
+        with self._lock:
+            expires_at = self._room_access.get(key)
+        if expires_at is not None and expires_at > time.monotonic():
+            return True, True
+        available, authorized = self.validate([
+            {"check": "username_available", "username": username},
+            {"check": "room_access", "username": username, "room_id": room_id},
+        ])
+        if not available and authorized and self.room_access_ttl > 0:
+            self._remember(key)
+        return not available, authorized
+
+    def _remember(self, key):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._room_access) >= self.max_cached:
+                self._room_access = {
+                    k: t for k, t in self._room_access.items() if t > now
+                }
+                if len(self._room_access) >= self.max_cached:
+                    self._room_access.clear()
+            self._room_access[key] = now + self.room_access_ttl
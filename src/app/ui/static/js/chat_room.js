@@ -20,6 +20,21 @@ document.getElementById("chat-other-user").textContent = other_user;
 let privateKey, publicKey;
 let otherUserPublicKey;
 
+// ID of the latest message received, when the server keeps a message history
+let lastMessageId = null;
+
+// Encryption scheme configured on the server: "rsa" wraps a new AES key for every
+// message, "session" derives AES keys from a secret agreed once with ECDH
+let encryption = "rsa";
+let rekeyInterval = 100;
+
+// ECDH for agreeing on the session keys
+let ecdhKeyPair;
+let sharedSecret;
+let otherUserKeyData;  // the other user's public key as last received
+let sentMessages = 0;
+const sessionKeys = new Map();  // "<sender>:<epoch>" -> AES key
+
 async function generateKeyPair() {
     console.log("[INFO] Generating RSA key pair...");
     const keyPair = await window.crypto.subtle.generateKey(
@@ -59,6 +74,59 @@ async function decryptAESKey(encryptedAESKey, privateKey) {
 }
 
 
+// ECDH key agreement for the session keys
+async function generateECDHKeyPair() {
+    console.log("[INFO] Generating ECDH key pair...");
+    return window.crypto.subtle.generateKey(
+        { name: "ECDH", namedCurve: "P-256" },
+        false, // The public key is always exportable
+        ["deriveBits"]
+    );
+}
+
+async function deriveSharedSecret(keyData) {
+    console.log("[INFO] Deriving shared secret with ECDH...");
+    const otherUserKey = await window.crypto.subtle.importKey(
+        "raw",
+        keyData,
+        { name: "ECDH", namedCurve: "P-256" },
+        false,
+        []
+    );
+    const secret = await window.crypto.subtle.deriveBits(
+        { name: "ECDH", public: otherUserKey },
+        ecdhKeyPair.privateKey,
+        256
+    );
+    return window.crypto.subtle.importKey("raw", secret, "HKDF", false, ["deriveKey"]);
+}
+
+// Each sender encrypts with a key of its own, and moves on to a new key (epoch) every
+// rekeyInterval messages. Both users derive the same keys from the shared secret.
+async function getSessionKey(sender, epoch) {
+    const keyId = `${sender}:${epoch}`;
+    if (!sessionKeys.has(keyId)) {
+        const encoder = new TextEncoder();
+        const aesKey = await window.crypto.subtle.deriveKey(
+            {
+                name: "HKDF",
+                hash: "SHA-256",
+                salt: encoder.encode(room_id),
+                info: encoder.encode(keyId),
+            },
+            sharedSecret,
+            { name: "AES-GCM", length: 256 },
+            false,
+            ["encrypt", "decrypt"]
+        );
+        sessionKeys.set(keyId, aesKey);
+        // keep the previous epoch for messages still in flight
+        sessionKeys.delete(`${sender}:${epoch - 2}`);
+    }
+    return sessionKeys.get(keyId);
+}
+
+
 // AES encryption for the actual message
 async function generateAESKey() {
     console.log("[INFO] Generating AES key...");
@@ -151,31 +219,43 @@ async function sendMessage() {
     }
 
     // Check if the recipient's public key is available
-    if (!otherUserPublicKey) {
+    if (encryption === "session" ? !sharedSecret : !otherUserPublicKey) {
         console.error("[ERROR] No public key for the recipient");
         return;
     }
 
     console.log("[INFO] Sending message...");
 
-    // Step 1: Generate a symmetric AES key for encrypting the message
-    const aesKey = await generateAESKey();
-
-    // Step 2: Encrypt the message with AES
-    const { iv, ciphertext } = await encryptWithAES(message, aesKey);
-
-    // Step 3: Encrypt the AES key with the recipient's public RSA key
-    const exportedAESKey = await exportAESKey(aesKey);
-    const encryptedAESKey = await encryptAESKey(exportedAESKey, otherUserPublicKey);
-
-    // Step 4: Send both the encrypted AES key and the encrypted message (ciphertext)
-    socket.emit("send_message", {
-        room_id: room_id,
-        aes_key: Array.from(new Uint8Array(encryptedAESKey)),
-        iv: Array.from(iv), // Send IV along with ciphertext
-        message: Array.from(new Uint8Array(ciphertext)),
-        username: username
-    });
+    if (encryption === "session") {
+        // Encrypt the message with the current session key, and name its epoch
+        const epoch = Math.floor(sentMessages / rekeyInterval);
+        sentMessages++;
+        const aesKey = await getSessionKey(username, epoch);
+        const { iv, ciphertext } = await encryptWithAES(message, aesKey);
+        // typed arrays are sent as binary attachments instead of JSON arrays
+        socket.emit("send_message", {
+            epoch: epoch,
+            iv: iv,
+            message: new Uint8Array(ciphertext),
+        });
+    } else {
+        // Step 1: Generate a symmetric AES key for encrypting the message
+        const aesKey = await generateAESKey();
+
+        // Step 2: Encrypt the message with AES
+        const { iv, ciphertext } = await encryptWithAES(message, aesKey);
+
+        // Step 3: Encrypt the AES key with the recipient's public RSA key
+        const exportedAESKey = await exportAESKey(aesKey);
+        const encryptedAESKey = await encryptAESKey(exportedAESKey, otherUserPublicKey);
+
+        // Step 4: Send both the encrypted AES key and the encrypted message
+        socket.emit("send_message", {
+            aes_key: new Uint8Array(encryptedAESKey),
+            iv: iv, // Send IV along with ciphertext
+            message: new Uint8Array(ciphertext),
+        });
+    }
 
     messageInput.value = "";  // Clear input field after sending
 
@@ -194,6 +274,54 @@ function scrollToBottom() {
     chatMessages.scrollTop = chatMessages.scrollHeight;
 }
 
+// Whether message ID "<milliseconds>-<sequence>" a comes after message ID b
+function isNewerMessageId(a, b) {
+    const [aTime, aSeq] = a.split("-").map(Number);
+    const [bTime, bSeq] = b.split("-").map(Number);
+    return aTime > bTime || (aTime === bTime && aSeq > bSeq);
+}
+
+// Decrypt and display a message from the other user
+async function handleUserMessage(data) {
+    if (data.id) {
+        // skip messages already received live before being fetched from history
+        if (lastMessageId && !isNewerMessageId(data.id, lastMessageId)) {
+            return;
+        }
+        lastMessageId = data.id;
+    }
+    // the history also holds our own messages, which are already displayed
+    if (data.username === username) {
+        return;
+    }
+
+    const iv = new Uint8Array(data.iv);
+    const encryptedMessage = new Uint8Array(data.message);
+
+    let aesKey;
+    if (data.epoch !== undefined) {
+        // Step 1: Derive the sender's session key of the message's epoch
+        aesKey = await getSessionKey(data.username, data.epoch);
+    } else {
+        // Step 1: Decrypt the AES key with your private RSA key
+        const encryptedAESKey = new Uint8Array(data.aes_key);
+        const decryptedAESKey = await decryptAESKey(encryptedAESKey, privateKey);
+
+        // Step 2: Import the decrypted AES key
+        aesKey = await importAESKey(decryptedAESKey);
+    }
+
+    // Step 3: Decrypt the message with AES
+    const decryptedMessage = await decryptWithAES(encryptedMessage, iv, aesKey);
+
+    // Step 4: Display the decrypted message
+    const messageElement = document.createElement("div");
+    messageElement.classList.add("message");
+    messageElement.innerHTML = `<strong>${data.username}:</strong> ${decryptedMessage}`;
+    chatMessages.appendChild(messageElement);
+    scrollToBottom();
+}
+
 
 // Event handlers
 
@@ -210,7 +338,7 @@ messageInput.addEventListener("keypress", (e) => {
 // Handle "Back to Lobby" button click
 leaveRoomBtn.addEventListener("click", () => {
     console.log(`[INFO] User '${username}' leaving the room`);
-    socket.emit("leave_room", { username: username, room_id: room_id });
+    socket.emit("leave_room");
     window.location.href = "/lobby";
 });
 
@@ -220,7 +348,36 @@ leaveRoomBtn.addEventListener("click", () => {
 // When connected, join the room
 socket.on("connect", () => {
     console.log("[INFO] Connected to the chat room");
-    socket.emit("join_room", { username: username, room_id: room_id });
+    socket.emit("join_room", { room_id: room_id });
+});
+
+// The server is shutting down and picked when this client moves to another one, so
+// that its clients do not all reconnect at the same moment; the room and the keys
+// stay as they are, and the missed messages are fetched once the room is rejoined
+const DRAIN_RETRY_MS = 2000;  // most to wait before retrying a refused reconnect
+let draining = false;
+
+socket.on("server_draining", (data) => {
+    console.log(`[INFO] Server shutting down, moving in ${data.reconnect_delay_ms} ms`);
+    if (draining) {
+        return;
+    }
+    draining = true;
+    setTimeout(() => {
+        socket.disconnect();
+        socket.connect();
+    }, data.reconnect_delay_ms);
+});
+
+socket.on("connect", () => {
+    draining = false;
+});
+
+// Reached the shutting down server again, try another one after a while
+socket.on("connect_error", () => {
+    if (draining) {
+        setTimeout(() => socket.connect(), Math.random() * DRAIN_RETRY_MS);
+    }
 });
 
 // Handle room join failure and redirect
@@ -230,29 +387,75 @@ socket.on("join_room_failure", () => {
 });
 
 // Generate keys and share public key upon joining the room
-socket.on("join_room_success", async () => {
+socket.on("join_room_success", async (data) => {
     console.log("[INFO] Successfully joined chat room");
+    encryption = data.encryption || "rsa";
+    rekeyInterval = data.rekey_interval || rekeyInterval;
+
+    // Generate the key pair for this user, unless this is a reconnect, in which case
+    // the other user may have encrypted missed messages with the existing key
+    if (encryption === "session") {
+        if (!ecdhKeyPair) {
+            ecdhKeyPair = await generateECDHKeyPair();
+        }
+    } else if (!privateKey) {
+        const keyPair = await generateKeyPair();
+        privateKey = keyPair.privateKey;
+        publicKey = keyPair.publicKey;
+    }
+    await sharePublicKey();
 
-    // Generate the RSA key pair for this user
-    const keyPair = await generateKeyPair();
-    privateKey = keyPair.privateKey;
-    publicKey = keyPair.publicKey;
+    // Fetch the messages sent while reconnecting
+    if (data.history && lastMessageId) {
+        console.log("[INFO] Fetching missed messages");
+        socket.emit("fetch_history", { after_id: lastMessageId });
+    }
+});
+
+// Receive a batch of missed messages, and ask for the next one if there is more
+socket.on("message_history", async (data) => {
+    console.log(`[INFO] Received ${data.messages.length} missed messages`);
+    for (const message of data.messages) {
+        await handleUserMessage(message);
+    }
+    if (data.more && lastMessageId) {
+        socket.emit("fetch_history", { after_id: lastMessageId });
+    }
+});
 
-    // Export and send the public key to the server for sharing with others
-    const exportedPublicKey = await exportPublicKey(publicKey);
+// Export and send the public key to the server for sharing with others
+async function sharePublicKey() {
+    const exportedPublicKey = encryption === "session"
+        ? await window.crypto.subtle.exportKey("raw", ecdhKeyPair.publicKey)
+        : await exportPublicKey(publicKey);
     console.log("[INFO] Sharing public key with the other participant");
     socket.emit("share_public_key", {
-        room_id: room_id,
-        public_key: Array.from(new Uint8Array(exportedPublicKey)),
-        username: username
+        public_key: new Uint8Array(exportedPublicKey),
     });
-});
+}
 
 // Receive and store public key from another user
 socket.on("receive_public_key", async (data) => {
     const publicKeyData = new Uint8Array(data.public_key);
-    otherUserPublicKey = await importPublicKey(publicKeyData.buffer);
     console.log(`[INFO] Received public key from '${data.username}'`);
+    if (encryption !== "session") {
+        otherUserPublicKey = await importPublicKey(publicKeyData.buffer);
+        return;
+    }
+    // our key pair is still being generated, and once shared the other user will
+    // answer with their key again
+    if (!ecdhKeyPair) {
+        return;
+    }
+    // a new key means that the other user (re)joined, possibly after we shared ours,
+    // so share it again for them to derive the same secret
+    const keyData = publicKeyData.join(",");
+    if (keyData !== otherUserKeyData) {
+        otherUserKeyData = keyData;
+        sharedSecret = await deriveSharedSecret(publicKeyData.buffer);
+        sessionKeys.clear();
+        await sharePublicKey();
+    }
 });
 
 // Receive an encrypted message or system message
@@ -266,29 +469,16 @@ socket.on("receive_message", async (data) => {
         chatMessages.appendChild(messageElement);
         scrollToBottom();
     } else {
-        const encryptedAESKey = new Uint8Array(data.aes_key);
-        const iv = new Uint8Array(data.iv);
-        const encryptedMessage = new Uint8Array(data.message);
-
-        // Step 1: Decrypt the AES key with your private RSA key
-        const decryptedAESKey = await decryptAESKey(encryptedAESKey, privateKey);
-
-        // Step 2: Import the decrypted AES key
-        const aesKey = await importAESKey(decryptedAESKey);
-
-        // Step 3: Decrypt the message with AES
-        const decryptedMessage = await decryptWithAES(encryptedMessage, iv, aesKey);
-
-        // Step 4: Display the decrypted message
-        const messageElement = document.createElement("div");
-        messageElement.classList.add("message");
-        messageElement.innerHTML = `<strong>${data.username}:</strong> ${decryptedMessage}`;
-        chatMessages.appendChild(messageElement);
-        scrollToBottom();
+        await handleUserMessage(data);
     }
 });
 
 
+// The server dropped an event sent too fast
+socket.on("rate_limited", (data) => {
+    console.warn(`[WARNING] Sending '${data.event}' too fast, it was not delivered`);
+});
+
 // Handle errors from the server
 socket.on("error", (data) => {
     console.error("[ERROR] Server error:", data.message || "An error occurred.");
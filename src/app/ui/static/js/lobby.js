@@ -15,7 +15,8 @@ let requestPending = false;
 // Handle connection to the lobby
 socket.on("connect", () => {
     console.log(`[INFO] User '${username}' connected to the lobby`);
-    socket.emit("join_lobby", { username: username });
+    socket.emit("join_lobby", { paged: true });
+    queueLobbyUpdate(fetchWindow);
 });
 
 // Handle disconnection from the server
@@ -23,42 +24,257 @@ socket.on("disconnect", () => {
     console.log("[INFO] Disconnected from the server");
 });
 
-// Update the user list when a new list of users is received
-socket.on("update_user_list", (users) => {
-    console.log("[INFO] Received updated user list from the server");
-    userList.innerHTML = "";
-
-    // Add the current user to the top of the list
-    const currentUserLi = document.createElement("li");
-    currentUserLi.classList.add("user-item");
-    currentUserLi.innerText = `${username} (You)`;
-    currentUserLi.style.fontWeight = "bold";
-    userList.appendChild(currentUserLi);
-
-    // Add other users to the list
-    const otherUsers = users.filter((user) => user !== username);
-    otherUsers.forEach((user) => {
-        const li = document.createElement("li");
-        li.classList.add("user-item");
-        li.innerText = user;
-        li.style.cursor = "pointer";
-
-        // Handle click event on a user in the list
-        li.addEventListener("click", () => {
-            if (!requestPending) {
-                console.log(`[INFO] Sending chat request to '${user}'`);
-                requestPending = true;
-                socket.emit("chat_request", {
-                    to_user: user,
-                    from_user: username,
-                });
-            } else {
-                console.log("[WARNING] User already has a pending chat request");
-                alert("You already have a pending chat request.");
-            }
+// The server is shutting down and picked when this client moves to another one, so
+// that its clients do not all reconnect and rejoin the lobby at the same moment
+const DRAIN_RETRY_MS = 2000;  // most to wait before retrying a refused reconnect
+let draining = false;
+
+socket.on("server_draining", (data) => {
+    console.log(`[INFO] Server shutting down, moving in ${data.reconnect_delay_ms} ms`);
+    if (draining) {
+        return;
+    }
+    draining = true;
+    setTimeout(() => {
+        socket.disconnect();
+        socket.connect();
+    }, data.reconnect_delay_ms);
+});
+
+socket.on("connect", () => {
+    draining = false;
+});
+
+// Lobby user list, virtualized: only the rows in view are in the DOM, and only the
+// users around them are fetched from the server, a page at a time in username order
+const ROW_HEIGHT = 48;  // height of a .user-item including its margin, in pixels
+const OVERSCAN = 10;  // rows rendered beyond the visible ones in each direction
+const PAGE_SIZE = 60;  // users fetched around the visible rows, at most LOBBY_PAGE_MAX
+const PAGE_TIMEOUT_MS = 5000;
+const FETCH_DELAY_MS = 100;  // fetches wait for scrolling and typing to settle
+
+const viewport = document.getElementById("user-list-viewport");
+const spacer = document.getElementById("user-list-spacer");
+const searchInput = document.getElementById("user-search");
+
+// The fetched users of the lobby, the users with 'prefix' from the 'offset'th on, of
+// 'total' users with the prefix; kept current with the lobby deltas
+let lobbyWindow = { prefix: "", offset: 0, users: [], total: 0 };
+let lastSeq = null;  // sequence number of the last applied lobby delta
+let pendingPage = null;  // resolves the fetch waiting for its lobby_page
+let fetchScheduled = false;
+let renderedItems = new Map();
+
+function userItem(user) {
+    const li = document.createElement("li");
+    li.classList.add("user-item");
+    if (user === username) {
+        li.innerText = `${username} (You)`;
+        li.style.fontWeight = "bold";
+        return li;
+    }
+    li.innerText = user;
+    li.style.cursor = "pointer";
+
+    // Handle click event on a user in the list
+    li.addEventListener("click", () => {
+        if (!requestPending) {
+            console.log(`[INFO] Sending chat request to '${user}'`);
+            requestPending = true;
+            socket.emit("chat_request", { to_user: user });
+        } else {
+            console.log("[WARNING] User already has a pending chat request");
+            alert("You already have a pending chat request.");
+        }
+    });
+    return li;
+}
+
+// Rows of the list in view, as [first, end) indexes of the users with the prefix
+function visibleRange() {
+    const top = Math.max(0, viewport.scrollTop - spacer.offsetTop);
+    const first = Math.floor(top / ROW_HEIGHT);
+    const rows = Math.ceil(viewport.clientHeight / ROW_HEIGHT) + 1;
+    return [first, Math.min(first + rows, lobbyWindow.total)];
+}
+
+function render() {
+    const { offset, users, total } = lobbyWindow;
+    spacer.style.height = `${total * ROW_HEIGHT}px`;
+    const [first, end] = visibleRange();
+    const start = Math.max(offset, first - OVERSCAN);
+    const stop = Math.min(offset + users.length, end + OVERSCAN);
+    const items = new Map();
+    for (let i = start; i < stop; i++) {
+        const user = users[i - offset];
+        items.set(user, renderedItems.get(user) || userItem(user));
+    }
+    renderedItems = items;
+    userList.style.transform = `translateY(${Math.max(start, 0) * ROW_HEIGHT}px)`;
+    userList.replaceChildren(...items.values());
+
+    const covered = first >= offset && end <= offset + users.length;
+    if (!covered || searchInput.value.trim() !== lobbyWindow.prefix) {
+        scheduleFetch();
+    }
+}
+
+function scheduleFetch() {
+    if (fetchScheduled) {
+        return;
+    }
+    fetchScheduled = true;
+    setTimeout(() => {
+        queueLobbyUpdate(() => {
+            fetchScheduled = false;
+            return fetchWindow();
+        });
+    }, FETCH_DELAY_MS);
+}
+
+// Fetch the users around the rows in view, or the first ones of a new search
+async function fetchWindow() {
+    const prefix = searchInput.value.trim();
+    if (prefix !== lobbyWindow.prefix) {
+        viewport.scrollTop = 0;
+    }
+    const [first] = visibleRange();
+    const page = await new Promise((resolve) => {
+        pendingPage = resolve;
+        socket.emit("fetch_lobby_page", {
+            prefix: prefix,
+            offset: Math.max(0, first - OVERSCAN),
+            limit: PAGE_SIZE,
         });
+        setTimeout(() => resolve(null), PAGE_TIMEOUT_MS);
+    });
+    pendingPage = null;
+    if (!page) {
+        console.log("[WARNING] No lobby page received, retrying");
+        scheduleFetch();
+        return;
+    }
+    lobbyWindow = {
+        prefix: page.prefix,
+        offset: page.offset,
+        users: page.users,
+        total: page.total,
+    };
+    lastSeq = page.seq;
+    render();
+}
+
+socket.on("lobby_page", (page) => {
+    if (pendingPage) {
+        pendingPage(page);
+    }
+});
+
+// Index of the first user in the sorted users that does not sort before the user
+function sortedIndex(users, user) {
+    let low = 0;
+    let high = users.length;
+    while (low < high) {
+        const middle = (low + high) >> 1;
+        if (users[middle] < user) {
+            low = middle + 1;
+        } else {
+            high = middle;
+        }
+    }
+    return low;
+}
+
+function addUser(user) {
+    const { offset, users, total } = lobbyWindow;
+    const index = sortedIndex(users, user);
+    if (users[index] === user) {
+        return;
+    }
+    lobbyWindow.total += 1;
+    if (index === 0 && offset > 0) {
+        lobbyWindow.offset += 1;  // sorts before the fetched users
+    } else if (index < users.length || offset + users.length === total) {
+        users.splice(index, 0, user);
+    }
+}
 
-        userList.appendChild(li);
+function removeUser(user) {
+    const { offset, users } = lobbyWindow;
+    const index = sortedIndex(users, user);
+    lobbyWindow.total = Math.max(0, lobbyWindow.total - 1);
+    if (users[index] === user) {
+        users.splice(index, 1);
+    } else if (index === 0 && offset > 0) {
+        lobbyWindow.offset -= 1;
+    }
+}
+
+// Apply a lobby delta to the fetched users, or fetch them again if one was missed
+function applyDelta(data, apply) {
+    if (lastSeq === null || data.seq <= lastSeq) {
+        return;  // no page yet, or already included in the page
+    }
+    if (data.seq !== lastSeq + 1) {
+        console.log(`[WARNING] Missed lobby updates (${lastSeq} -> ${data.seq}), resyncing`);
+        lastSeq = null;
+        scheduleFetch();
+        return;
+    }
+    if (data.username.startsWith(lobbyWindow.prefix)) {
+        apply(data.username);
+    }
+    lastSeq = data.seq;
+}
+
+// Lobby updates are applied in the order they arrive, and wait for a page being
+// fetched
+let lobbyUpdates = Promise.resolve();
+
+function queueLobbyUpdate(update) {
+    lobbyUpdates = lobbyUpdates.then(update).catch((error) => {
+        console.error(`[ERROR] Failed to apply a lobby update: ${error}`);
+    });
+}
+
+viewport.addEventListener("scroll", render);
+searchInput.addEventListener("input", scheduleFetch);
+window.addEventListener("resize", render);
+
+// The lobby changed in a way the deltas do not cover, e.g. when the server runs in
+// "full" mode or the changes since the last broadcast were too many
+socket.on("lobby_resync", (data) => {
+    queueLobbyUpdate(() => {
+        if (lastSeq !== null && data.seq <= lastSeq) {
+            return;  // already included in the page
+        }
+        console.log(`[INFO] Lobby changed up to sequence ${data.seq}, resyncing`);
+        lastSeq = null;
+        scheduleFetch();
+    });
+});
+
+socket.on("user_joined", (data) => {
+    queueLobbyUpdate(() => {
+        applyDelta(data, addUser);
+        render();
+    });
+});
+
+socket.on("user_left", (data) => {
+    queueLobbyUpdate(() => {
+        applyDelta(data, removeUser);
+        render();
+    });
+});
+
+// Lobby changes of one broadcast window, as [seq, op, username] in sequence order
+socket.on("user_list_deltas", (data) => {
+    queueLobbyUpdate(() => {
+        data.deltas.forEach(([seq, op, user]) => {
+            applyDelta({ seq: seq, username: user }, op === "add" ? addUser : removeUser);
+        });
+        render();
     });
 });
 
@@ -73,11 +289,7 @@ socket.on("chat_request", (data) => {
         `from '${fromUser}'`
     );
 
-    socket.emit("chat_response", {
-        from_user: fromUser,
-        to_user: username,
-        accepted: accept,
-    });
+    socket.emit("chat_response", { from_user: fromUser, accepted: accept });
 });
 
 // Handle the response to a chat request
@@ -100,16 +312,29 @@ socket.on("chat_response", (data) => {
 // Handle leaving the lobby
 leaveLobbyBtn.addEventListener("click", () => {
     console.log(`[INFO] User '${username}' leaving the lobby`);
-    socket.emit("leave_server", { username: username });
+    socket.emit("leave_server");
     window.location.href = "/";
 });
 
 // Handle connection errors
 socket.on("connect_error", () => {
+    if (draining) {
+        // reached the shutting down server again, try another one after a while
+        setTimeout(() => socket.connect(), Math.random() * DRAIN_RETRY_MS);
+        return;
+    }
     console.log("[ERROR] Connection error occurred");
     alert("Connection failed. Please try again later.");
 });
 
+// The server ignored an event sent too fast
+socket.on("rate_limited", (data) => {
+    console.warn(`[WARNING] Sending '${data.event}' too fast, it was ignored`);
+    if (data.event === "fetch_lobby_page" && pendingPage) {
+        pendingPage(null);
+    }
+});
+
 // Handle any server errors
 socket.on("error", (errorMessage) => {
     console.error(`[ERROR] Server error: ${errorMessage}`);
@@ -0,0 +1,137 @@
+"""
+Shared fixtures of the backend tests. The tests import the backend modules and the
+UI's backend client directly and run against fakeredis (``pip install pytest
+fakeredis lupa``), or against a throwaway redis-server when one is on the PATH.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "app", "backend")
+UI_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "app", "ui")
+sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+# after the backend, whose modules win where the names are the same, e.g. app
+sys.path.append(os.path.abspath(UI_DIR))
+
+import pytest
+import redis
+from redis.cluster import ClusterNode, RedisCluster
+
+
+def _free_port(cluster=False):
+    while True:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        # a cluster node also listens on the port + 10000 for its cluster bus
+        if not cluster or port + 10000 <= 65535:
+            return port
+
+
+def _start_redis_server(*args):
+    if not shutil.which("redis-server"):
+        pytest.skip("redis-server not found")
+    port = _free_port(cluster="--cluster-enabled" in args)
+    directory = tempfile.mkdtemp(prefix="redis_test_")
+    process = subprocess.Popen(
+        [
+            "redis-server",
+            "--port", str(port),
+            "--dir", directory,
+            "--save", "",
+            "--appendonly", "no",
+            *args,
+        ],
+        stdout=subprocess.DEVNULL,
+    )
+    client = redis.Redis(port=port, decode_responses=True)
+    deadline = time.time() + 10
+    while True:
+        try:
+            client.ping()
+            break
+        except redis.ConnectionError:
+            if time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.05)
+    return process, port, directory
+
+
+def _stop_redis_server(process, directory):
+    process.terminate()
+    process.wait(timeout=10)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@pytest.fixture
+def redis_server():
+    """
+    Port of a standalone redis-server.
+    """
+    process, port, directory = _start_redis_server()
+    yield port
+    _stop_redis_server(process, directory)
+
+
+@pytest.fixture(scope="session")
+def _redis_cluster_process():
+    process, port, directory = _start_redis_server("--cluster-enabled", "yes")
+    client = redis.Redis(port=port, decode_responses=True)
+    client.execute_command("CLUSTER", "ADDSLOTS", *range(16384))
+    deadline = time.time() + 10
+    while "cluster_state:ok" not in client.execute_command("CLUSTER", "INFO"):
+        if time.time() > deadline:
+            raise RuntimeError("Cluster did not come up")
+        time.sleep(0.05)
+    yield port
+    _stop_redis_server(process, directory)
+
+
+@pytest.fixture
+def redis_cluster_node(_redis_cluster_process):
+    """
+    Port of a redis-server running as a single-node cluster that owns every slot. The
+    node is shared by the tests, as a cluster takes a while to come up, and emptied
+    for each of them.
+    """
+    redis.Redis(port=_redis_cluster_process).flushall()
+    return _redis_cluster_process
+
+
+def _manager(client):
+    from state_manager import RedisChatManager
+
+    manager = RedisChatManager(client=client)
+    manager.scripts.load()
+    return manager
+
+
+@pytest.fixture
+def manager():
+    """
+    Chat manager on a fresh fakeredis with its scripts loaded.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    return _manager(fakeredis.FakeRedis(decode_responses=True))
+
+
+@pytest.fixture(params=["fakeredis", "redis-cluster"])
+def cluster_manager(request):
+    """
+    Chat manager with its scripts loaded on a fresh fakeredis, and on a single-node
+    Redis cluster, which rejects commands whose keys span slots as a real one does.
+    """
+    if request.param == "fakeredis":
+        fakeredis = pytest.importorskip("fakeredis")
+        return _manager(fakeredis.FakeRedis(decode_responses=True))
+    port = request.getfixturevalue("redis_cluster_node")
+    return _manager(
+        RedisCluster(
+            startup_nodes=[ClusterNode("127.0.0.1", port)], decode_responses=True
+        )
+    )
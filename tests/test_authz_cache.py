@@ -0,0 +1,32 @@
+from authz_cache import RoomAuthorizationCache
+
+
+def test_lookups_are_timed_by_result(manager):
+    manager.add_user("alice")
+    manager.add_user("bob")
+    chatroom = manager.create_chatroom({"username": "alice"}, {"username": "bob"})
+    cache = RoomAuthorizationCache(manager)
+
+    assert cache.is_authorized("sid-1", "alice", chatroom["id"])
+    assert cache.is_authorized("sid-1", "alice", chatroom["id"])
+    assert not cache.is_authorized("sid-2", "carol", chatroom["id"])
+
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.hit_latency.count == 1
+    assert cache.miss_latency.count == 2
+    assert len(cache) == 1
+
+
+def test_invalidated_membership_is_checked_again(manager):
+    manager.add_user("alice")
+    manager.add_user("bob")
+    chatroom = manager.create_chatroom({"username": "alice"}, {"username": "bob"})
+    cache = RoomAuthorizationCache(manager)
+    cache.is_authorized("sid-1", "alice", chatroom["id"])
+
+    manager.leave_chatroom("alice", chatroom["id"])
+    cache.invalidate("alice", chatroom["id"])
+
+    assert not cache.is_authorized("sid-1", "alice", chatroom["id"])
+    assert cache.invalidations == 1
+    assert len(cache) == 0
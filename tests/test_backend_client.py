@@ -0,0 +1,52 @@
+from backend_client import BackendClient
+
+
+class StubBackend(BackendClient):
+    """
+    Answers the checks from a set of users and the rooms they are in, and records
+    the checks it was asked.
+    """
+
+    def __init__(self, users, rooms, **kwargs):
+        super().__init__("http://backend", **kwargs)
+        self.users = users
+        self.rooms = rooms
+        self.asked = []
+
+    def validate(self, checks):
+        self.asked.append([check["check"] for check in checks])
+        return [
+            check["username"] not in self.users
+            if check["check"] == "username_available"
+            else self.rooms.get(check["username"]) == check["room_id"]
+            for check in checks
+        ]
+
+
+def test_granted_pages_are_cached_until_expiry():
+    backend = StubBackend({"alice"}, {"alice": "room-1"}, room_access_ttl=60)
+
+    assert backend.check_room_page("alice", "room-1") == (True, True)
+    backend.users.clear()
+    assert backend.check_room_page("alice", "room-1") == (True, True)
+    assert backend.asked == [["username_available", "room_access"]]
+
+    backend._room_access[("alice", "room-1")] = 0
+    assert backend.check_room_page("alice", "room-1") == (False, True)
+    assert len(backend.asked) == 2
+
+
+def test_missing_users_are_not_cached():
+    backend = StubBackend(set(), {"alice": "room-1"})
+
+    assert backend.check_room_page("alice", "room-1") == (False, True)
+    backend.users.add("alice")
+    assert backend.check_room_page("alice", "room-1") == (True, True)
+
+
+def test_denials_are_not_cached():
+    backend = StubBackend({"alice"}, {})
+
+    assert backend.check_room_page("alice", "room-1") == (True, False)
+    backend.rooms["alice"] = "room-1"
+    assert backend.check_room_page("alice", "room-1") == (True, True)
@@ -0,0 +1,157 @@
+import os
+import signal
+
+import pytest
+
+import drain as drain_module
+from drain import Drain
+from sessions import SessionRegistry
+
+SPREAD = 20.0
+
+
+class RecordingServer:
+    def __init__(self):
+        self.emits = []
+        self.tasks = []
+
+    def emit(self, event, data, room=None, ignore_queue=False):
+        self.emits.append((event, data, room, ignore_queue))
+
+    def start_background_task(self, target, *args):
+        self.tasks.append(target)
+
+    def sleep(self, seconds):
+        pass
+
+
+class Recorder:
+    def __init__(self, fail=False):
+        self.calls = 0
+        self.fail = fail
+
+    def __call__(self):
+        self.calls += 1
+        if self.fail:
+            raise RuntimeError("Redis is gone")
+
+
+class LobbyBroadcaster:
+    def __init__(self, fail=False):
+        self.flush = Recorder(fail)
+
+
+class Presence:
+    def __init__(self):
+        self.heartbeat = Recorder()
+
+
+@pytest.fixture
+def exit_handlers(monkeypatch):
+    handlers = []
+    monkeypatch.setattr(drain_module.atexit, "register", handlers.append)
+    return handlers
+
+
+@pytest.fixture
+def sigterm():
+    previous = signal.getsignal(signal.SIGTERM)
+    yield
+    signal.signal(signal.SIGTERM, previous)
+
+
+def sessions_of(users):
+    sessions = SessionRegistry()
+    for i, username in enumerate(users):
+        sessions.open(f"sid-{i}", username)
+    return sessions
+
+
+def reconnect_delays(server):
+    return {
+        room: data["reconnect_delay_ms"] / 1000
+        for event, data, room, _ in server.emits
+        if event == "server_draining"
+    }
+
+
+def test_every_socket_is_told_when_to_move():
+    server = RecordingServer()
+    sessions = sessions_of(f"user-{i}" for i in range(1000))
+    drain = Drain(server, sessions, LobbyBroadcaster(), Presence(), spread=SPREAD)
+
+    assert drain.notify() == 1000
+
+    delays = reconnect_delays(server)
+    assert sorted(delays) == sorted(session.sid for session in sessions)
+    assert all(ignore_queue for *_, ignore_queue in server.emits)
+    assert all(0 <= delay <= SPREAD for delay in delays.values())
+    # the moves are spread evenly, not bunched up at the start
+    per_second = [0] * int(SPREAD)
+    for delay in delays.values():
+        per_second[min(int(delay), len(per_second) - 1)] += 1
+    assert max(per_second) <= 2 * 1000 / SPREAD
+    assert drain.notified == 1000
+
+
+def test_sigterm_drains_and_hands_over_to_previous_handler(sigterm, exit_handlers):
+    received = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: received.append(signum))
+    server = RecordingServer()
+    drain = Drain(server, sessions_of(["alice"]), LobbyBroadcaster(), Presence())
+    drain.start()
+
+    os.kill(os.getpid(), signal.SIGTERM)
+
+    assert received == [signal.SIGTERM]
+    assert server.tasks == [drain.drain]
+    server.tasks[0]()
+    assert drain.draining
+    assert [room for _, _, room, _ in server.emits] == ["sid-0"]
+    assert exit_handlers == [drain.flush]
+
+    # another SIGTERM does not drain again
+    os.kill(os.getpid(), signal.SIGTERM)
+    assert server.tasks == [drain.drain]
+
+
+def test_flush_broadcasts_lobby_changes_and_marks_users_seen():
+    lobby_broadcaster, presence = LobbyBroadcaster(), Presence()
+    drain = Drain(RecordingServer(), SessionRegistry(), lobby_broadcaster, presence)
+
+    drain.flush()
+
+    assert lobby_broadcaster.flush.calls == 1
+    assert presence.heartbeat.calls == 1
+
+
+def test_flush_failure_does_not_raise():
+    lobby_broadcaster = LobbyBroadcaster(fail=True)
+    drain = Drain(RecordingServer(), SessionRegistry(), lobby_broadcaster, Presence())
+
+    drain.flush()
+
+    assert lobby_broadcaster.flush.calls == 1
+
+
+def test_users_keep_their_lobby_and_room_while_moving(manager):
+    users = [f"user-{i}" for i in range(10)]
+    sessions = sessions_of(users)
+    for username in users:
+        manager.add_user(username)
+        manager.add_socket(username)
+    chatroom = manager.create_chatroom({"username": users[0]}, {"username": users[1]})
+    server = RecordingServer()
+    Drain(server, sessions, LobbyBroadcaster(), Presence(), spread=SPREAD).notify()
+
+    by_sid = {session.sid: session.username for session in sessions}
+    for sid, _ in sorted(reconnect_delays(server).items(), key=lambda item: item[1]):
+        username = by_sid[sid]
+        # the old socket goes away and the client connects to another pod
+        assert manager.remove_socket(username) == 0
+        manager.add_socket(username)
+
+    assert manager.get_chatroom(chatroom["id"], users[0])
+    assert manager.get_chatroom(chatroom["id"], users[1])
+    assert sorted(manager.list_users_in_lobby()) == sorted(users[2:])
+    assert all(manager.count_sockets(username) == 1 for username in users)
@@ -0,0 +1,22 @@
+import pytest
+
+from encoding import CompactCodec, valid_username
+
+
+@pytest.mark.parametrize("username", ["alice", "Ålice Ö", "a{b}c:d", "😀"])
+def test_valid_usernames(username):
+    assert valid_username(username)
+
+
+@pytest.mark.parametrize(
+    "username", ["", None, 42, "a\x1fb", "a\nb", "\x00", "a\x7fb", "a\x85b"]
+)
+def test_invalid_usernames(username):
+    assert not valid_username(username)
+
+
+def test_compact_room_keeps_valid_members_apart():
+    codec = CompactCodec()
+    room = {"id": "room-1", "users": ["a{b}c:d", "Ålice Ö"]}
+
+    assert codec.decode_room("room-1", codec.encode_room(room)) == room
@@ -0,0 +1,38 @@
+import pytest
+
+from envelopes import validate_envelope
+
+
+def session_envelope(**fields):
+    return {"epoch": 0, "iv": [1] * 12, "message": [0, 255, 7], **fields}
+
+
+def test_accepts_byte_lists_and_attachments():
+    assert validate_envelope(session_envelope(), "session") == session_envelope()
+    envelope = session_envelope(iv=bytes(12), message=b"\x00\xff")
+    assert validate_envelope(envelope, "session") == envelope
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"iv": ["x" * 10] * 12},
+        {"message": [{"a": "b" * 100000}]},
+        {"message": ["abc"]},
+        {"message": [256]},
+        {"message": [-1]},
+        {"message": [1.5]},
+        {"message": [None]},
+    ],
+)
+def test_rejects_lists_of_anything_but_byte_values(fields):
+    with pytest.raises(ValueError):
+        validate_envelope(session_envelope(**fields), "session")
+
+
+def test_limits_message_bytes():
+    envelope = session_envelope(message=[0] * 11)
+
+    assert validate_envelope(envelope, "session", max_message_bytes=11)
+    with pytest.raises(ValueError):
+        validate_envelope(envelope, "session", max_message_bytes=10)
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from legacy_state import migrate_legacy_state
+from roster import ROSTER_KEY
+
+
+# the original keys are spread over slots, which only a cluster tells apart
+@pytest.fixture
+def manager(cluster_manager):
+    return cluster_manager
+
+
+def write_legacy_state(manager):
+    """
+    The records the original backend writes for alice and bob in a room, carol in
+    the lobby with a request to dave, dave in the lobby, and a room left behind by
+    erin, who has left the server.
+    """
+    partition = manager._get_partition
+    for username, in_room in [
+        ("alice", True), ("bob", True), ("carol", False), ("dave", False)
+    ]:
+        manager.redis.hset(
+            f"connected_users{{users_partition_{partition(username)}}}",
+            username,
+            json.dumps({"username": username, "in_room": in_room}),
+        )
+    for username in ["carol", "dave"]:
+        manager.redis.sadd(
+            f"users_in_lobby{{lobby_partition_{partition(username)}}}", username
+        )
+    for room_id, users in [("room-1", ["alice", "bob"]), ("room-2", ["erin"])]:
+        manager.redis.hset(
+            f"chatrooms{{room_partition_{partition(room_id)}}}",
+            room_id,
+            json.dumps({"id": room_id, "users": users}),
+        )
+    manager.redis.hset(
+        f"pending_requests{{requests_partition_{partition('carol')}}}",
+        "carol",
+        json.dumps({"from_username": "carol", "to_username": "dave"}),
+    )
+
+
+def test_moves_state_to_current_keys(manager):
+    write_legacy_state(manager)
+
+    assert migrate_legacy_state(manager, now=1000.0) == 4
+
+    assert manager.get_user("alice") == {"username": "alice", "in_room": True}
+    assert manager.get_user("carol") == {"username": "carol", "in_room": False}
+    assert manager.get_user("erin") is None
+    assert sorted(manager.list_users_in_lobby()) == ["carol", "dave"]
+    assert set(manager.redis.smembers(ROSTER_KEY)) == {"carol", "dave"}
+    assert manager.get_chatroom("room-1", "bob")["users"] == ["alice", "bob"]
+    assert manager.user_authorized_in_room("alice", "room-1")
+    assert not manager.user_authorized_in_room("erin", "room-2")
+    assert manager.get_pending_request("carol")["to_username"] == "dave"
+    assert manager.expire_pending_requests(now=1000.0 + manager.request_ttl + 1) == [
+        ("carol", "dave")
+    ]
+    assert not [key for key in manager.redis.keys() if "_partition_" in key]
+
+    # the users go on from where they were
+    assert manager.leave_chatroom("alice", "room-1")
+    assert sorted(manager.list_users_in_lobby()) == ["alice", "carol", "dave"]
+
+
+def test_later_pods_find_nothing_to_move(manager):
+    write_legacy_state(manager)
+    migrate_legacy_state(manager)
+    manager.leave_chatroom("alice", "room-1")
+
+    assert migrate_legacy_state(manager) == 0
+    assert manager.get_user("alice") == {"username": "alice", "in_room": False}
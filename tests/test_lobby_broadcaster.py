@@ -0,0 +1,63 @@
+import fakeredis
+
+from lobby_broadcaster import (FULL_LOBBY_ROOM, PAGED_LOBBY_ROOM,
+                               LobbyBroadcaster)
+from roster import LobbyRoster
+
+
+class RecordingServer:
+    def __init__(self):
+        self.emits = []
+
+    def emit(self, event, data, room=None):
+        self.emits.append((event, data, room))
+
+    def start_background_task(self, target, *args):
+        pass
+
+
+def broadcaster(protocol, window, history_size=1024):
+    redis = fakeredis.FakeRedis(decode_responses=True)
+    roster = LobbyRoster(redis, history_size=history_size)
+    roster.load_snapshot()
+    server = RecordingServer()
+    broadcaster = LobbyBroadcaster(
+        server, roster, redis, protocol=protocol, window=window
+    )
+    roster.add_listener(broadcaster.notify)
+    return roster, server, broadcaster
+
+
+def test_full_lobby_only_goes_to_full_lobby_sockets():
+    roster, server, _ = broadcaster("full", window=0)
+
+    roster.apply([("add", "alice"), ("add", "bob")])
+
+    [(event, users, room), resync] = server.emits
+    assert (event, sorted(users), room) == (
+        "update_user_list", ["alice", "bob"], FULL_LOBBY_ROOM
+    )
+    assert resync == ("lobby_resync", {"seq": 2}, PAGED_LOBBY_ROOM)
+
+
+def test_snapshot_after_missing_history_only_goes_to_full_lobby_sockets():
+    roster, server, lobby_broadcaster = broadcaster("delta", 0.1, history_size=2)
+
+    roster.apply([("add", f"user-{i}") for i in range(5)])
+    lobby_broadcaster.flush()
+
+    [(event, snapshot, room), resync] = server.emits
+    assert (event, room) == ("user_list_snapshot", FULL_LOBBY_ROOM)
+    assert snapshot["seq"] == 5
+    assert sorted(snapshot["users"]) == [f"user-{i}" for i in range(5)]
+    assert resync == ("lobby_resync", {"seq": 5}, PAGED_LOBBY_ROOM)
+
+
+def test_deltas_go_to_every_lobby_socket():
+    roster, server, lobby_broadcaster = broadcaster("delta", 0.1)
+
+    roster.apply([("add", "alice"), ("remove", "alice")])
+    lobby_broadcaster.flush()
+
+    deltas = [(1, "add", "alice"), (2, "remove", "alice")]
+    assert server.emits == [("user_list_deltas", {"deltas": deltas}, None)]
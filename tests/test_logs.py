@@ -0,0 +1,42 @@
+import io
+import logging
+
+from logs import BackgroundHandler, EventFilter, current_event, logged
+
+
+def test_background_handler_writes_every_record_by_close():
+    stream = io.StringIO()
+    handler = BackgroundHandler(stream)
+    logger = logging.getLogger("test_logs.background")
+    logger.propagate = False
+    logger.addHandler(handler)
+
+    for i in range(100):
+        logger.warning("record %s", i)
+    handler.close()
+    handler.close()
+
+    assert stream.getvalue().splitlines() == [f"record {i}" for i in range(100)]
+
+
+def test_unsampled_calls_keep_only_warnings():
+    log_filter = EventFilter(sampling={"send_message": 0.0})
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    handler.addFilter(log_filter)
+    logger = logging.getLogger("test_logs.sampling")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    def send_message():
+        logger.info("sent")
+        logger.warning("slow")
+
+    logged(logger, log_filter, "send_message", send_message)()
+
+    assert [record.getMessage() for record in records] == ["slow"]
+    assert records[0].event == "send_message"
+    assert log_filter.sampled_out == {"send_message": 1}
+    assert current_event.get() is None
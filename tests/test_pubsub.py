@@ -0,0 +1,145 @@
+import uuid
+from queue import Empty
+
+import kombu
+import pytest
+from socketio import KombuManager
+
+from pubsub import BROADCAST_KEY, RoutedKombuManager
+
+
+class Pod:
+    """
+    A routed client manager on Kombu's in-memory transport, with a reader of its
+    queue standing in for the listener thread.
+    """
+
+    def __init__(self, exchange):
+        self.manager = RoutedKombuManager(
+            url="memory://",
+            channel=exchange,
+            exchange_options={"type": "direct", "durable": False},
+        )
+        self.reader = kombu.Connection("memory://").SimpleQueue(self.manager._queue())
+
+    def connect(self, *rooms):
+        sid = uuid.uuid4().hex
+        self.manager.basic_enter_room(sid, "/", None, eio_sid=sid)
+        self.manager.basic_enter_room(sid, "/", sid)
+        for room in rooms:
+            self.manager.basic_enter_room(sid, "/", room)
+        return sid
+
+    def routing_keys(self):
+        return {binding.routing_key for binding in self.manager._queue().bindings}
+
+    def receive(self, monkeypatch):
+        """
+        Run the queued messages through the manager's listener, handling internal
+        messages, and return the others.
+        """
+        def messages(manager):
+            while True:
+                try:
+                    message = self.reader.get(block=False)
+                except Empty:
+                    return
+                message.ack()
+                yield message.payload
+
+        monkeypatch.setattr(KombuManager, "_listen", messages)
+        return [self.manager._decode_message(m) for m in self.manager._listen()]
+
+
+@pytest.fixture
+def pods():
+    exchange = f"test-{uuid.uuid4().hex}"
+    pods = [Pod(exchange) for _ in range(2)]
+    yield pods
+    for pod in pods:
+        pod.reader.close()
+
+
+def emit(manager, room):
+    manager._publish({
+        "method": "emit",
+        "event": "receive_message",
+        "data": {"message": "hi"},
+        "namespace": "/",
+        "room": room,
+        "skip_sid": None,
+        "callback": None,
+        "host_id": manager.host_id,
+    })
+
+
+def test_room_is_bound_while_a_local_socket_is_in_it(pods):
+    pod = pods[0]
+    first = pod.connect("room-1")
+    second = pod.connect("room-1")
+
+    assert "room:room-1" in pod.routing_keys()
+    assert pod.manager.binds == 3  # the two sid rooms and room-1 once
+
+    pod.manager.basic_leave_room(first, "/", "room-1")
+    assert "room:room-1" in pod.routing_keys()
+
+    pod.manager.basic_leave_room(second, "/", "room-1")
+    assert "room:room-1" not in pod.routing_keys()
+    assert pod.manager.unbinds == 1
+    assert {BROADCAST_KEY, f"room:{second}"} <= pod.routing_keys()
+
+
+def test_routes(pods):
+    manager = pods[0].manager
+    route = manager._route
+
+    assert route({"method": "emit", "room": "room-1"}) == "room:room-1"
+    assert route({"method": "emit", "room": None}) == BROADCAST_KEY
+    # a list of rooms is broadcast rather than sent once per room
+    assert route({"method": "emit", "room": ["a", "b"]}) == BROADCAST_KEY
+    assert route({"method": "close_room", "room": "room-1"}) == "room:room-1"
+    assert route({"method": "disconnect", "sid": "sid-1"}) == "room:sid-1"
+    assert route({"method": "callback", "host_id": "pod-2"}) == "host:pod-2"
+    assert route({"method": "roster_delta", "data": []}) == BROADCAST_KEY
+    presence = {"room": "room-1", "host_id": "pod-2", "present": True}
+    assert route({
+        "method": "room_presence", "data": {**presence, "reply_to": None}
+    }) == "room:room-1"
+    assert route({
+        "method": "room_presence", "data": {**presence, "reply_to": "pod-3"}
+    }) == "host:pod-3"
+
+
+def test_room_messages_only_reach_pods_with_members(pods, monkeypatch):
+    sender, receiver = pods
+    sender.connect("alice")
+    receiver.connect("bob", "room-1")
+
+    emit(sender.manager, "room-1")
+    emit(sender.manager, "alice")
+
+    [message] = receiver.receive(monkeypatch)
+    assert message["room"] == "room-1"
+    # the emits of a pod come back to it, which is how they reach its own sockets
+    [message] = [m for m in sender.receive(monkeypatch) if m["method"] == "emit"]
+    assert message["room"] == "alice"
+
+
+def test_presence_handshake(pods, monkeypatch):
+    first, second = pods
+
+    assert first.manager.has_remote_members("room-1")  # nothing known yet
+    first.connect("room-1")
+    first.receive(monkeypatch)
+    assert not first.manager.has_remote_members("room-1")
+
+    sid = second.connect("room-1")
+    first.receive(monkeypatch)  # the announcement, answered to the second pod
+    second.receive(monkeypatch)  # the answer
+    assert first.manager.has_remote_members("room-1")
+    assert second.manager.has_remote_members("room-1")
+
+    second.manager.basic_leave_room(sid, "/", "room-1")
+    first.receive(monkeypatch)
+    assert not first.manager.has_remote_members("room-1")
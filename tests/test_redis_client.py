@@ -0,0 +1,41 @@
+from redis.cluster import ClusterNode
+
+from redis_client import (MeteredConnectionPool, RedisClientSettings,
+                          RedisPoolMetrics, create_cluster_client,
+                          create_standalone_client)
+
+SETTINGS = RedisClientSettings(max_connections=7, pool_timeout=1.5)
+
+
+def test_cluster_nodes_use_metered_pool(redis_cluster_node):
+    metrics = RedisPoolMetrics()
+    client = create_cluster_client(
+        [ClusterNode("127.0.0.1", str(redis_cluster_node))], None, SETTINGS, metrics
+    )
+    client.set("key", "value")
+    assert client.get("key") == "value"
+
+    nodes = client.get_nodes()
+    assert nodes
+    for node in nodes:
+        pool = node.redis_connection.connection_pool
+        assert isinstance(pool, MeteredConnectionPool)
+        assert pool.metrics is metrics
+        assert pool.max_connections == SETTINGS.max_connections
+        assert pool.timeout == SETTINGS.pool_timeout
+    assert metrics.command_latency.count >= 2
+    assert metrics.pool_wait.count >= 2
+    assert metrics.in_use == 0
+
+
+def test_standalone_client_uses_metered_pool(redis_server):
+    metrics = RedisPoolMetrics()
+    client = create_standalone_client(
+        f"redis://127.0.0.1:{redis_server}/0", SETTINGS, metrics
+    )
+    client.set("key", "value")
+    assert client.get("key") == "value"
+    assert isinstance(client.connection_pool, MeteredConnectionPool)
+    assert client.connection_pool.max_connections == SETTINGS.max_connections
+    assert metrics.command_latency.count == 2
+    assert metrics.in_use == 0
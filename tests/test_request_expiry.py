@@ -0,0 +1,153 @@
+import pytest
+import redis
+
+import request_expiry
+import state_manager
+from request_expiry import RequestExpiry
+from state_manager import RedisChatManager
+
+TTL = 30
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+class RecordingServer:
+    def __init__(self):
+        self.emits = []
+
+    def emit(self, event, data, room=None):
+        self.emits.append((event, data, room))
+
+    def timeouts(self):
+        return [room for event, data, room in self.emits if data.get("timed_out")]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(state_manager, "time", clock)
+    monkeypatch.setattr(request_expiry, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["fakeredis", "redis-server"])
+def client(request):
+    if request.param == "fakeredis":
+        fakeredis = pytest.importorskip("fakeredis")
+        return fakeredis.FakeRedis(decode_responses=True)
+    port = request.getfixturevalue("redis_server")
+    return redis.Redis(port=port, decode_responses=True)
+
+
+@pytest.fixture
+def manager(client, clock):
+    manager = RedisChatManager(client=client, request_ttl=TTL)
+    manager.scripts.load()
+    return manager
+
+
+def leftovers(manager):
+    """
+    Pending requests, deadlines and reverse index entries still in Redis.
+    """
+    total = 0
+    for partition in range(manager.num_partitions):
+        keys = manager._keys_of_partition(partition)
+        total += manager.redis.hlen(keys.requests)
+        total += manager.redis.zcard(keys.request_deadlines)
+        pattern = f"incoming_requests{{partition_{partition}}}:*"
+        for key in manager.redis.scan_iter(pattern):
+            total += manager.redis.scard(key)
+    return total
+
+
+def test_unanswered_request_expires_at_its_deadline(manager, clock):
+    server = RecordingServer()
+    expiry = RequestExpiry(server, manager)
+    manager.add_pending_request("alice", "bob")
+
+    clock.now += TTL - 0.1
+    assert expiry.expire() == []
+    assert manager.get_pending_request("alice")
+
+    clock.now += 0.1
+    assert expiry.expire() == [("alice", "bob")]
+
+    assert server.emits == [(
+        "chat_response",
+        {"accepted": False, "timed_out": True, "message": "Chat request timed out"},
+        "alice",
+    )]
+    assert expiry.expired == 1
+    assert manager.get_pending_request("alice") is None
+    assert leftovers(manager) == 0
+
+
+def test_requester_can_send_a_new_request_after_expiry(manager, clock):
+    server = RecordingServer()
+    expiry = RequestExpiry(server, manager)
+    manager.add_pending_request("alice", "bob")
+    clock.now += TTL
+    expiry.expire()
+
+    manager.add_pending_request("alice", "carol")
+    clock.now += TTL - 1
+    assert expiry.expire() == []
+    clock.now += 1
+    assert expiry.expire() == [("alice", "carol")]
+    assert server.timeouts() == ["alice", "alice"]
+
+
+def test_answered_requests_do_not_expire(manager, clock):
+    server = RecordingServer()
+    expiry = RequestExpiry(server, manager)
+    manager.add_user("alice")
+    manager.add_user("bob")
+    manager.add_pending_request("alice", "bob")
+    manager.add_pending_request("carol", "dave")
+
+    assert manager.accept_chat_request("alice", "bob")
+    manager.remove_pending_request("carol", "dave")
+    clock.now += 2 * TTL
+
+    assert expiry.expire() == []
+    assert server.emits == []
+    assert leftovers(manager) == 0
+
+
+def test_each_request_expires_on_one_pod(manager, clock):
+    servers = [RecordingServer(), RecordingServer()]
+    pods = [RequestExpiry(server, manager) for server in servers]
+    for i in range(20):
+        manager.add_pending_request(f"user-{i}", f"other-{i}")
+    clock.now += TTL
+
+    expired = [pod.expire() for pod in pods]
+
+    assert len(expired[0]) == 20
+    assert expired[1] == []
+    assert sorted(servers[0].timeouts()) == sorted(f"user-{i}" for i in range(20))
+    assert servers[1].emits == []
+
+
+def test_passes_expire_a_batch_at_a_time(manager, clock):
+    server = RecordingServer()
+    expiry = RequestExpiry(server, manager, batch_size=manager.num_partitions)
+    requests = 3 * manager.num_partitions
+    for i in range(requests):
+        manager.add_pending_request(f"user-{i}", f"other-{i}")
+    clock.now += TTL
+
+    passes = []
+    while len(server.timeouts()) < requests and len(passes) < requests:
+        passes.append(len(expiry.expire()))
+
+    assert max(passes) <= manager.num_partitions
+    assert len(set(server.timeouts())) == requests
+    assert leftovers(manager) == 0
@@ -0,0 +1,73 @@
+from roster import ROSTER_KEY, RosterReconciler
+
+
+class RecordingServer:
+    def start_background_task(self, target, *args):
+        pass
+
+
+def roster_users(manager):
+    return set(manager.redis.smembers(ROSTER_KEY))
+
+
+def test_leave_chatroom_does_not_bring_back_user_without_record(manager):
+    manager.add_user("alice")
+    manager.add_user("bob")
+    chatroom = manager.create_chatroom({"username": "alice"}, {"username": "bob"})
+    assert roster_users(manager) == set()
+
+    # e.g. dropped by another pod while alice was still in the room
+    manager.redis.hdel(manager._partition_keys("alice").users, "alice")
+    assert manager.leave_chatroom("alice", chatroom["id"])
+    assert manager.leave_chatroom("bob", chatroom["id"])
+
+    assert roster_users(manager) == {"bob"}
+    assert manager.list_users_in_lobby() == ["bob"]
+
+
+def test_reaping_user_in_room_leaves_roster_alone(manager):
+    manager.add_user("alice")
+    manager.add_user("bob")
+    manager.add_user("carol")
+    manager.create_chatroom({"username": "alice"}, {"username": "bob"})
+    version = manager.roster.version
+
+    reaped, _ = manager.reap_expired_users(cutoff=float("inf"), limit_per_partition=10)
+
+    assert sorted(username for username, _ in reaped) == ["alice", "bob", "carol"]
+    assert roster_users(manager) == set()
+    # only carol was in the lobby
+    assert manager.roster.version == version + 1
+
+
+def test_reconciler_repairs_differences_seen_twice(manager):
+    manager.add_user("alice")
+    manager.add_user("bob")
+    # a pod died between writing the partitions and the roster
+    manager.roster.remove("alice")
+    manager.redis.srem(manager._partition_keys("bob").lobby, "bob")
+    reconciler = RosterReconciler(RecordingServer(), manager.roster)
+
+    assert reconciler.reconcile() == []
+    assert roster_users(manager) == {"bob"}
+
+    deltas = reconciler.reconcile()
+
+    assert sorted(op for _, op, _ in deltas) == ["add", "remove"]
+    assert roster_users(manager) == {"alice"}
+    assert manager.list_users_in_lobby() == ["alice"]
+    assert reconciler.repaired == {"add": 1, "remove": 1}
+    assert reconciler.reconcile() == []
+
+
+def test_reconciler_leaves_transitions_in_flight_alone(manager):
+    manager.add_user("alice")
+    reconciler = RosterReconciler(RecordingServer(), manager.roster)
+    # the partition is written but the roster write has not arrived yet
+    manager.redis.sadd(manager._partition_keys("bob").lobby, "bob")
+
+    assert reconciler.reconcile() == []
+    manager.roster.add("bob")
+
+    assert reconciler.reconcile() == []
+    assert reconciler.repaired == {"add": 0, "remove": 0}
@@ -0,0 +1,179 @@
+import threading
+
+import pytest
+
+from roster import ROSTER_KEY
+
+
+# the transitions run a script per user partition, which only a cluster tells apart
+@pytest.fixture
+def manager(cluster_manager):
+    return cluster_manager
+
+
+def lobby(manager):
+    """
+    The users in the lobby partitions and in the shared roster, which must agree.
+    """
+    in_partitions = sorted(manager._scan_lobby_partitions())
+    assert sorted(manager.redis.smembers(ROSTER_KEY)) == in_partitions
+    return in_partitions
+
+
+def assert_in_lobby(manager, username):
+    assert manager.get_user(username) == {"username": username, "in_room": False}
+    keys = manager._partition_keys(username)
+    assert manager.redis.hget(keys.user_rooms, username) is None
+    assert username in lobby(manager)
+
+
+@pytest.mark.parametrize("room_id", [None, "", 42, ["room"]])
+def test_no_room_grants_no_access(manager, room_id):
+    manager.add_user("alice")
+
+    assert not manager.user_authorized_in_room("alice", room_id)
+    assert not manager.user_authorized_in_room("ghost", room_id)
+
+
+def test_only_members_have_access(manager):
+    manager.add_user("alice")
+    manager.add_user("bob")
+    manager.add_user("carol")
+    chatroom = manager.create_chatroom({"username": "alice"}, {"username": "bob"})
+
+    assert manager.user_authorized_in_room("alice", chatroom["id"])
+    assert manager.user_authorized_in_room("bob", chatroom["id"])
+    assert not manager.user_authorized_in_room("carol", chatroom["id"])
+    assert not manager.user_authorized_in_room("ghost", chatroom["id"])
+    assert not manager.user_authorized_in_room(None, chatroom["id"])
+
+    manager.leave_chatroom("alice", chatroom["id"])
+
+    assert not manager.user_authorized_in_room("alice", chatroom["id"])
+
+
+def test_accept_consumes_request(manager):
+    for username in ["alice", "bob"]:
+        manager.add_user(username)
+    manager.add_pending_request("alice", "bob")
+
+    chatroom = manager.accept_chat_request("alice", "bob")
+
+    assert chatroom["users"] == ["alice", "bob"]
+    assert manager.get_pending_request("alice") is None
+    assert not manager.redis.smembers(manager._partition_keys("bob").incoming_requests)
+    for username in ["alice", "bob"]:
+        assert manager.get_user(username)["in_room"]
+        assert manager.get_chatroom(chatroom["id"], username) == chatroom
+    assert lobby(manager) == []
+
+
+def test_accept_without_pending_request_opens_no_room(manager):
+    for username in ["alice", "bob"]:
+        manager.add_user(username)
+    manager.add_pending_request("alice", "bob")
+    manager.remove_pending_request("alice")
+
+    assert manager.accept_chat_request("alice", "bob") is None
+
+    # bob entered the room before alice's part failed, and was put back
+    assert_in_lobby(manager, "alice")
+    assert_in_lobby(manager, "bob")
+
+
+def test_accept_by_user_already_in_room_is_rolled_back(manager):
+    for username in ["alice", "bob", "carol"]:
+        manager.add_user(username)
+    manager.add_pending_request("alice", "bob")
+    chatroom = manager.create_chatroom({"username": "bob"}, {"username": "carol"})
+
+    assert manager.accept_chat_request("alice", "bob") is None
+
+    assert_in_lobby(manager, "alice")
+    # the request is consumed either way, and alice is told that bob is not available
+    assert manager.get_pending_request("alice") is None
+    assert not manager.redis.smembers(manager._partition_keys("bob").incoming_requests)
+    assert manager.user_authorized_in_room("bob", chatroom["id"])
+    assert manager.get_chatroom(chatroom["id"], "bob") == chatroom
+    assert lobby(manager) == ["alice"]
+
+
+def test_concurrent_accepts_open_one_room(manager):
+    senders = [f"user-{i}" for i in range(8)]
+    for username in ["target", *senders]:
+        manager.add_user(username)
+    for username in senders:
+        manager.add_pending_request(username, "target")
+    chatrooms = []
+    barrier = threading.Barrier(len(senders))
+
+    def accept(username):
+        barrier.wait()
+        chatrooms.append(manager.accept_chat_request(username, "target"))
+
+    threads = [threading.Thread(target=accept, args=(u,)) for u in senders]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    [chatroom] = [chatroom for chatroom in chatrooms if chatroom]
+    [winner] = [username for username in chatroom["users"] if username != "target"]
+    assert manager.get_chatroom(chatroom["id"], "target") == chatroom
+    for username in senders:
+        if username != winner:
+            assert_in_lobby(manager, username)
+    assert not manager.redis.smembers(
+        manager._partition_keys("target").incoming_requests
+    )
+    assert lobby(manager) == sorted(set(senders) - {winner})
+
+
+def test_rollback_drops_user_removed_meanwhile(manager, monkeypatch):
+    for username in ["alice", "bob", "carol"]:
+        manager.add_user(username)
+    manager.create_chatroom({"username": "bob"}, {"username": "carol"})
+    run = manager.scripts.run
+
+    def run_and_remove_alice(calls):
+        results = run(calls)
+        if calls[0][0] == "enter_room":
+            # alice is dropped, e.g. by another pod, before her part is undone
+            manager.redis.hdel(manager._partition_keys("alice").users, "alice")
+        return results
+
+    monkeypatch.setattr(manager.scripts, "run", run_and_remove_alice)
+
+    assert manager.create_chatroom({"username": "alice"}, {"username": "bob"}) is None
+
+    assert manager.get_user("alice") is None
+    assert lobby(manager) == []
+
+
+def test_leave_room_of_removed_user(manager):
+    for username in ["alice", "bob"]:
+        manager.add_user(username)
+    chatroom = manager.create_chatroom({"username": "alice"}, {"username": "bob"})
+    manager.redis.hdel(manager._partition_keys("alice").users, "alice")
+
+    assert manager.scripts.run([manager._leave_room_call("alice", chatroom["id"])]) == [
+        "no_user"
+    ]
+    assert manager.get_chatroom(chatroom["id"], "alice") is None
+    assert lobby(manager) == []
+
+
+def test_removed_user_is_no_longer_in_room(manager):
+    for username in ["alice", "bob"]:
+        manager.add_user(username)
+    chatroom = manager.create_chatroom({"username": "alice"}, {"username": "bob"})
+
+    manager.remove_user("alice")
+
+    assert manager.scripts.run([manager._leave_room_call("alice", chatroom["id"])]) == [
+        "not_in_room"
+    ]
+    assert not manager.leave_chatroom("alice", chatroom["id"])
+    assert not manager.user_authorized_in_room("alice", chatroom["id"])
+    assert manager.leave_chatroom("bob", chatroom["id"])
+    assert lobby(manager) == ["bob"]